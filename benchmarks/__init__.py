@@ -0,0 +1,5 @@
+# Remy Oukaour, 107122849
+# CSE 310, Group 2
+
+__all__ = ['parsing', 'allocations', 'connections', 'locking', 'queues',
+	'broadcast', 'metrics', 'micro']
@@ -0,0 +1,117 @@
+# Remy Oukaour, 107122849
+# CSE 310, Group 2
+
+"""
+Usage: python -m benchmarks.allocations [-h|--help] [-n NUMBER]
+
+Compares the objects and memory retained by Nim packets, and the time taken to
+parse them, between lazily parsed NimRequest/NimResponse packets and packets
+whose headers and body are parsed eagerly.
+"""
+
+from __future__ import print_function
+
+import argparse
+import gc
+import multiprocessing
+import os
+import timeit
+from nim.nimlib import *
+from benchmarks.parsing import regex_request, regex_response
+
+# A typical request and response, as handled by a server and a client
+request_data = "REMOVE 3 2 NIM/3.0\r\nContent-Length: 0\r\n\r\n"
+response_data = ("NIM/3.0 200 OK\r\nContent-Length: 28\r\n\r\n"
+	"alice takes 3 from set 2\n  4")
+
+class EagerRequest(object):
+	"""
+	A request whose fields are all parsed and stored in its __dict__ when it
+	is instantiated, like NimRequest before it parsed lazily.
+	"""
+	
+	def __init__(self, data):
+		"""
+		Store the parsed parts of raw packet data as fields.
+		"""
+		self.data = data
+		(self.request, self.version, self.method, self.params, self.headers,
+			self.body) = regex_request(data)
+
+class EagerResponse(object):
+	"""
+	A response whose fields are all parsed and stored in its __dict__ when it
+	is instantiated, like NimResponse before it parsed lazily.
+	"""
+	
+	def __init__(self, data):
+		"""
+		Store the parsed parts of raw packet data as fields.
+		"""
+		self.data = data
+		(self.response, self.version, self.status, self.reason, self.headers,
+			self.body) = regex_response(data)
+
+def resident_memory():
+	"""
+	Return the resident memory of this process in bytes (Linux only).
+	"""
+	with open('/proc/self/statm') as statm:
+		return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+def measure(packet_class, data, number, results):
+	"""
+	Put the number of GC-tracked objects and bytes retained by each of a
+	number of packets into a results queue.
+	"""
+	gc.disable()
+	objects, memory = len(gc.get_objects()), resident_memory()
+	# Give each packet its own copy of the raw data, as a reader would
+	packets = [packet_class(data[:-1] + data[-1]) for _ in range(number)]
+	objects = len(gc.get_objects()) - objects - 1
+	memory = resident_memory() - memory
+	results.put((float(objects) / number, float(memory) / number))
+
+def retained(packet_class, data, number):
+	"""
+	Return the number of GC-tracked objects and bytes retained by each packet,
+	measured in a separate process.
+	"""
+	results = multiprocessing.Queue()
+	process = multiprocessing.Process(target=measure,
+		args=(packet_class, data, number, results))
+	process.start()
+	result = results.get()
+	process.join()
+	return result
+
+def parse_time(packet_class, data, number):
+	"""
+	Return the microseconds taken to parse a packet.
+	"""
+	seconds = min(timeit.repeat(lambda: packet_class(data), repeat=3,
+		number=number))
+	return seconds / number * 1e6
+
+def main():
+	"""
+	Compare eagerly and lazily parsed packets.
+	"""
+	argp = argparse.ArgumentParser(
+		description='Benchmark the allocations of Nim packets.',
+		formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+	argp.add_argument('-n', '--number', type=int, default=100000,
+		help='the number of packets to parse')
+	args = argp.parse_args()
+	print('{:<14} {:>8} {:>10} {:>10}'.format('packet', 'objects', 'bytes',
+		'time (us)'))
+	for packet_class, data in [(EagerRequest, request_data),
+		(NimRequest, request_data), (EagerResponse, response_data),
+		(NimResponse, response_data)]:
+		objects, memory = retained(packet_class, data, args.number)
+		time = parse_time(packet_class, data, args.number)
+		print('{:<14} {:>8.2f} {:>10.1f} {:>10.2f}'.format(
+			packet_class.__name__, objects, memory, time))
+
+if __name__ == '__main__':
+	main()
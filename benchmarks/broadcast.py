@@ -0,0 +1,98 @@
+# Remy Oukaour, 107122849
+# CSE 310, Group 2
+
+"""
+Usage: python -m benchmarks.broadcast [-h|--help] [-m MOVES]
+	[-o OBSERVERS [OBSERVERS ...]]
+
+Compares the latency of a move in a game with many observers, between sending
+one NimMessage encoded once for every recipient and enqueueing a separately
+encoded copy for each recipient, as REMOVE requests did before.
+"""
+
+from __future__ import print_function
+
+import argparse
+import time
+from nim.server import *
+
+class NullSocket(object):
+	"""
+	A socket which discards everything sent to it, so that only the work of
+	encoding and queueing messages is measured.
+	"""
+	
+	# Like the connections of event-driven servers, it never blocks
+	blocked = False
+	
+	def sendall(self, data):
+		pass
+	
+	def send_nowait(self, data):
+		return len(data)
+
+def enqueue_each(game, body):
+	"""
+	Enqueue a move for the opponent and each observer of a game, encoding it
+	separately for every one of them.
+	"""
+	game.playing.enqueue(body)
+	game.playing.flush()
+	for observer in game.all_observers():
+		observer.enqueue(body)
+		observer.flush()
+
+def broadcast(game, body):
+	"""
+	Enqueue a move for the opponent and each observer of a game, encoding it
+	once for all of them.
+	"""
+	for user in game.broadcast(body, (game.playing,)):
+		user.flush()
+
+def move_latency(fan_out, observers, moves, pushing):
+	"""
+	Return the mean seconds taken to make a move and notify a number of
+	observers of it, for observers who queue their messages or who have them
+	pushed to them.
+	"""
+	player1 = NimUser(NullSocket(), 'alice')
+	player2 = NimUser(NullSocket(), 'bob')
+	game = NimGame(player1, player2)
+	# Make sure the game does not end during the measurement
+	game.sets = [moves] * len(game.sets)
+	for i in range(observers):
+		observer = NimUser(NullSocket(), 'observer{}'.format(i))
+		observer.pushing = pushing
+		game.add_observer(observer)
+	start = time.time()
+	for _ in range(moves):
+		status, body = game.move(game.playing, 1, 1)
+		fan_out(game, body)
+	return (time.time() - start) / moves
+
+def main():
+	"""
+	Measure the latency of moves against the number of observers.
+	"""
+	argp = argparse.ArgumentParser(
+		description='Benchmark the Nim server broadcasts to observers.',
+		formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+	argp.add_argument('-m', '--moves', type=int, default=100,
+		help='the number of moves to make for each measurement')
+	argp.add_argument('-o', '--observers', type=int, nargs='+',
+		default=[10, 1000, 10000],
+		help='the numbers of observers to measure')
+	args = argp.parse_args()
+	print('{:>9} {:>8} {:>16} {:>17} {:>8}'.format('observers', 'mode',
+		'per-user ms/move', 'broadcast ms/move', 'speedup'))
+	for observers in args.observers:
+		for pushing in (False, True):
+			times = [move_latency(fan_out, observers, args.moves, pushing)
+				* 1e3 for fan_out in (enqueue_each, broadcast)]
+			print('{:>9} {:>8} {:>16.3f} {:>17.3f} {:>7.2f}x'.format(observers,
+				'push' if pushing else 'queue', times[0], times[1],
+				times[0] / times[1]))
+
+if __name__ == '__main__':
+	main()
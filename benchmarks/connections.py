@@ -0,0 +1,116 @@
+# Remy Oukaour, 107122849
+# CSE 310, Group 2
+
+"""
+Usage: python -m benchmarks.connections [-h|--help] [-n NUMBER]
+	[ENGINE [ENGINE ...]]
+
+Measures the memory used by a Nim server for each idle, logged-in connection,
+for each server engine.
+"""
+
+from __future__ import print_function
+
+import argparse
+import multiprocessing
+import os
+import socket
+import time
+from nim.nimlib import *
+from nim.server import *
+
+# The server classes which can be measured
+engines = {
+	'threading': ThreadingNimServer,
+	'async': AsyncNimServer,
+	'epoll': EpollNimServer
+}
+
+def serve(server_class, addresses):
+	"""
+	Run a Nim server and put its address into a queue.
+	"""
+	server = server_class(('127.0.0.1', 0), BaseNimRequestHandler)
+	server.listen()
+	addresses.put(server.server_address)
+	server.serve_forever()
+
+def process_status(pid):
+	"""
+	Return the resident memory in bytes and number of threads of a process
+	(Linux only).
+	"""
+	status = {}
+	with open('/proc/{}/status'.format(pid)) as f:
+		for line in f:
+			name, _, value = line.partition(':')
+			status[name] = value.split()
+	return int(status['VmRSS'][0]) * 1024, int(status['Threads'][0])
+
+def connect(address, n):
+	"""
+	Open n connections to a server, each logged in with a unique name, and
+	return their sockets.
+	"""
+	login = 'LOGIN user{} NIM/3.0\r\nContent-Length: 0\r\n\r\n'
+	sockets = []
+	for i in range(n):
+		s = socket.create_connection(address)
+		s.sendall(login.format(i))
+		sockets.append(s)
+	# Wait for every login to be handled
+	for s in sockets:
+		s.recv(4096)
+	return sockets
+
+def measure(server_class, n):
+	"""
+	Return the memory in bytes used by a server for each of n idle
+	connections, and the number of threads it used for them.
+	"""
+	addresses = multiprocessing.Queue()
+	process = multiprocessing.Process(target=serve,
+		args=(server_class, addresses))
+	process.daemon = True
+	process.start()
+	address = addresses.get()
+	try:
+		# Warm up the server before the baseline measurement
+		for s in connect(address, 10):
+			s.close()
+		time.sleep(0.5)
+		memory, threads = process_status(process.pid)
+		sockets = connect(address, n)
+		time.sleep(0.5)
+		busy_memory, busy_threads = process_status(process.pid)
+		for s in sockets:
+			s.close()
+		return float(busy_memory - memory) / n, busy_threads - threads
+	finally:
+		process.terminate()
+		process.join()
+
+def main():
+	"""
+	Measure the memory used for each connection by each engine.
+	"""
+	argp = argparse.ArgumentParser(
+		description='Benchmark the memory used by Nim server connections.',
+		formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+	argp.add_argument('engines', metavar='ENGINE', nargs='*',
+		default=sorted(engines),
+		help='the server engines to measure ({})'.format(
+		', '.join(sorted(engines))))
+	argp.add_argument('-n', '--number', type=int, default=2000,
+		help='the number of idle connections to open')
+	args = argp.parse_args()
+	for engine in args.engines:
+		if engine not in engines:
+			argp.error('invalid engine: {!r}'.format(engine))
+	print('{:<10} {:>12} {:>8}'.format('engine', 'bytes/conn', 'threads'))
+	for engine in args.engines:
+		memory, threads = measure(engines[engine], args.number)
+		print('{:<10} {:>12.0f} {:>8}'.format(engine, memory, threads))
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,272 @@
+# Remy Oukaour, 107122849
+# CSE 310, Group 2
+
+"""
+Usage: python -m benchmarks.locking [-h|--help] [-c CLIENTS] [-d DURATION]
+	[-g GAMES [GAMES ...]] [-t TIMEOUT]
+
+Stress tests the Nim server's locks with racing PLAY, REMOVE, OBSERVE and BYE
+requests, checking for deadlocks and inconsistent state, then measures request
+throughput against the number of concurrent games with the server's locks and
+with a single global lock.
+"""
+
+from __future__ import print_function
+
+import argparse
+import multiprocessing
+import random
+import socket
+import sys
+import threading
+import time
+import traceback
+from nim.nimlib import *
+from nim.server import *
+
+# The lock held by GlobalLockNimRequestHandler for every request
+global_lock = threading.Lock()
+
+class GlobalLockNimRequestHandler(BaseNimRequestHandler):
+	"""
+	Handles each request while holding one lock for the whole server, as the
+	server did before it had per-game locks.
+	"""
+	
+	def handle_one_request(self):
+		with global_lock:
+			BaseNimRequestHandler.handle_one_request(self)
+
+# The request handlers which can be measured
+handlers = {
+	'fine': BaseNimRequestHandler,
+	'global': GlobalLockNimRequestHandler
+}
+
+class Client(object):
+	"""
+	A minimal blocking Nim client which discards queued messages.
+	"""
+	
+	def __init__(self, address):
+		self.socket = socket.create_connection(address)
+		self.reader = NimPacketReader(self.socket, NimResponse)
+	
+	def request(self, method, *params):
+		"""
+		Send a request and return its response, or None if the server
+		closed the connection.
+		"""
+		line = ' '.join((method,) + tuple(map(str, params)) + ('NIM/3.0',))
+		self.socket.sendall(line + '\r\nContent-Length: 0\r\n\r\n')
+		while True:
+			response = self.reader.read()
+			if not response or response.status != CONTINUED:
+				return response
+	
+	def close(self):
+		self.socket.close()
+
+def check_server(server):
+	"""
+	Raise an AssertionError if the server's users and games are inconsistent.
+	"""
+	with server.lock:
+		for user in server.users.values():
+			if user.name:
+				assert server.usernames[user.name] is user, user.name
+			if user.game and not user.game.over:
+				assert server.games.get(user.game.id) is user.game, user.name
+		for game in server.games.values():
+			for player in (game.player1, game.player2):
+				assert server.users.get(player.socket) is player, game.id
+				assert player.game is game, game.id
+
+def stress_client(address, index, clients, deadline, progress):
+	"""
+	Repeatedly log in, make random requests which race with the other
+	clients', and say goodbye, until the deadline.
+	"""
+	rng = random.Random(index)
+	while time.time() < deadline:
+		client = Client(address)
+		client.request('LOGIN', 'user{}'.format(index))
+		for _ in range(rng.randint(1, 20)):
+			choice = rng.random()
+			if choice < 0.3:
+				client.request('PLAY', 'user{}'.format(rng.randrange(clients)))
+			elif choice < 0.7:
+				client.request('REMOVE', 1, rng.randint(1, NIM_MIN_SETS))
+			elif choice < 0.8:
+				client.request('OBSERVE', rng.randint(1, NimGame.next_game + 8))
+			elif choice < 0.9:
+				client.request('GAMES')
+			else:
+				client.request('WHO')
+			progress[index] += 1
+		client.request('BYE')
+		client.close()
+		progress[index] += 1
+
+def dump_threads():
+	"""
+	Print the stack of every running thread.
+	"""
+	for ident, frame in sys._current_frames().items():
+		print('Thread {}:'.format(ident), file=sys.stderr)
+		traceback.print_stack(frame, file=sys.stderr)
+
+def stress(clients, duration, timeout):
+	"""
+	Run racing clients against a threading server for a duration, checking
+	its state throughout. Return the number of requests handled, or exit if
+	the server stops making progress for the timeout.
+	"""
+	server = ThreadingNimServer(('127.0.0.1', 0), BaseNimRequestHandler)
+	server.daemon_threads = True
+	server.listen()
+	server_thread = threading.Thread(target=server.serve_forever)
+	server_thread.daemon = True
+	server_thread.start()
+	deadline = time.time() + duration
+	progress = [0] * clients
+	threads = [threading.Thread(target=stress_client,
+		args=(server.server_address, i, clients, deadline, progress))
+		for i in range(clients)]
+	for thread in threads:
+		thread.daemon = True
+		thread.start()
+	# Check the server's state in another thread, which may block on its
+	# locks if they deadlock
+	errors = []
+	def checker():
+		try:
+			while any(thread.is_alive() for thread in threads):
+				check_server(server)
+				time.sleep(0.1)
+		except AssertionError as e:
+			errors.append(e)
+	checker_thread = threading.Thread(target=checker)
+	checker_thread.daemon = True
+	checker_thread.start()
+	# Watch for deadlocks while the clients run
+	handled, last_progress = 0, time.time()
+	while any(thread.is_alive() for thread in threads):
+		time.sleep(0.1)
+		if errors:
+			raise errors[0]
+		if sum(progress) != handled:
+			handled, last_progress = sum(progress), time.time()
+		elif time.time() - last_progress > timeout:
+			print('No progress for {} seconds; deadlocked?'.format(timeout),
+				file=sys.stderr)
+			dump_threads()
+			sys.exit(1)
+	# Every client said goodbye, so nothing should be left behind
+	checker_thread.join()
+	if errors:
+		raise errors[0]
+	time.sleep(0.5)
+	check_server(server)
+	assert not server.users, 'users left: {}'.format(len(server.users))
+	assert not server.games, 'games left: {}'.format(len(server.games))
+	server.shutdown()
+	server.server_close()
+	return sum(progress)
+
+def serve(handler_class, addresses):
+	"""
+	Run a Nim server and put its address into a queue.
+	"""
+	server = ThreadingNimServer(('127.0.0.1', 0), handler_class)
+	server.daemon_threads = True
+	server.listen()
+	addresses.put(server.server_address)
+	server.serve_forever()
+
+def play(address, index, deadline, counts):
+	"""
+	Play games between two clients until the deadline, listing the games
+	every so often, and put the number of requests made into a queue.
+	"""
+	player1, player2 = Client(address), Client(address)
+	player1.request('LOGIN', 'a{}'.format(index))
+	player2.request('LOGIN', 'b{}'.format(index))
+	count = 0
+	while time.time() < deadline:
+		response = player1.request('PLAY', 'b{}'.format(index))
+		# Read the set sizes from the game state
+		sizes = [line for line in response.body.split('\n')
+			if line.startswith('size')][0]
+		sets = map(int, sizes.split()[1:])
+		playing, waiting = player1, player2
+		status = OK
+		while status != END_GAME:
+			s = next(i for (i, n) in enumerate(sets) if n)
+			sets[s] -= 1
+			status = playing.request('REMOVE', 1, s + 1).status
+			playing, waiting = waiting, playing
+			count += 1
+			if not count % 10:
+				playing.request('GAMES')
+				count += 1
+		count += 1
+	player1.request('BYE')
+	player2.request('BYE')
+	counts.put(count)
+
+def throughput(handler_class, games, duration):
+	"""
+	Return the requests per second handled by a server while a number of
+	games are played concurrently.
+	"""
+	addresses = multiprocessing.Queue()
+	process = multiprocessing.Process(target=serve,
+		args=(handler_class, addresses))
+	process.daemon = True
+	process.start()
+	address = addresses.get()
+	try:
+		counts = multiprocessing.Queue()
+		deadline = time.time() + duration
+		players = [multiprocessing.Process(target=play,
+			args=(address, i, deadline, counts)) for i in range(games)]
+		for player in players:
+			player.start()
+		total = sum(counts.get() for _ in players)
+		for player in players:
+			player.join()
+		return total / float(duration)
+	finally:
+		process.terminate()
+		process.join()
+
+def main():
+	"""
+	Stress test the server's locks, then compare its throughput with that
+	of a globally locked server.
+	"""
+	argp = argparse.ArgumentParser(
+		description='Stress test and benchmark the Nim server locks.',
+		formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+	argp.add_argument('-c', '--clients', type=int, default=32,
+		help='the number of racing clients in the stress test')
+	argp.add_argument('-d', '--duration', type=float, default=5.0,
+		help='the seconds to run each test for')
+	argp.add_argument('-g', '--games', type=int, nargs='+',
+		default=[1, 2, 4, 8, 16],
+		help='the numbers of concurrent games to measure')
+	argp.add_argument('-t', '--timeout', type=float, default=5.0,
+		help='the seconds without progress before reporting a deadlock')
+	args = argp.parse_args()
+	handled = stress(args.clients, args.duration, args.timeout)
+	print('Stress test passed: {} requests from {} clients'.format(handled,
+		args.clients))
+	print('{:>6} {:>12} {:>12}'.format('games', 'global req/s', 'fine req/s'))
+	for games in args.games:
+		rates = [throughput(handlers[name], games, args.duration)
+			for name in ('global', 'fine')]
+		print('{:>6} {:>12.0f} {:>12.0f}'.format(games, *rates))
+
+if __name__ == '__main__':
+	main()
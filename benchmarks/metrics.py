@@ -0,0 +1,195 @@
+# Remy Oukaour, 107122849
+# CSE 310, Group 2
+
+"""
+Usage: python -m benchmarks.metrics [-h|--help] [-c CLIENTS] [-d DURATION]
+	[-n NUMBER] [-r ROUNDS] [-t THROUGHPUT_ROUNDS]
+
+Measures the overhead of collecting metrics, by comparing the time taken by a
+request handler to handle requests, and the request throughput of a server,
+with and without metrics.
+"""
+
+from __future__ import print_function
+
+import argparse
+import multiprocessing
+import random
+import time
+from nim.nimlib import *
+from nim.server import *
+from benchmarks.locking import Client
+
+# The requests made by clients, which do not change the server's state
+requests = ['GAMES', 'WHO', 'PING']
+
+class MeasuredServer(ThreadingNimServer):
+	"""
+	A server which collects metrics.
+	"""
+	
+	collect_metrics = True
+
+class UnmeasuredServer(ThreadingNimServer):
+	"""
+	A server which does not collect metrics.
+	"""
+	
+	collect_metrics = False
+
+# The servers which can be measured
+servers = {
+	'off': UnmeasuredServer,
+	'on': MeasuredServer
+}
+
+class MemorySocket(object):
+	"""
+	A socket which receives pipelined requests from memory and discards
+	everything sent to it, so that only the work of handling requests is
+	measured.
+	"""
+	
+	def __init__(self, data):
+		self.data = data
+		self.offset = 0
+	
+	def recv_into(self, buffer):
+		n = min(len(buffer), len(self.data) - self.offset)
+		buffer[:n] = self.data[self.offset:self.offset + n]
+		self.offset += n
+		return n
+	
+	def sendall(self, data):
+		pass
+	
+	def shutdown(self, how):
+		pass
+	
+	def close(self):
+		pass
+
+def handle_time(server, number):
+	"""
+	Return the seconds per request taken by a request handler of a server to
+	handle a number of pipelined requests and send their responses, and by
+	the server's metrics, if any, to count them.
+	"""
+	data = 'LOGIN alice NIM/3.0\r\n\r\n' + ''.join(
+		'{} NIM/3.0\r\nContent-Length: 0\r\n\r\n'.format(
+		requests[i % len(requests)]) for i in range(number))
+	connection = MemorySocket(data)
+	start = time.time()
+	BaseNimRequestHandler(connection, ('127.0.0.1', 0), server)
+	# Count the requests now instead of in the background, so that the time
+	# is charged to this server
+	if server.metrics:
+		server.metrics.count_pending()
+	elapsed = time.time() - start
+	return elapsed / (number + 1)
+
+def serve(server_class, addresses):
+	"""
+	Run a Nim server and put its address into a queue.
+	"""
+	server = server_class(('127.0.0.1', 0), BaseNimRequestHandler)
+	server.daemon_threads = True
+	server.listen()
+	addresses.put(server.server_address)
+	server.serve_forever()
+
+def request_loop(address, index, deadline, counts):
+	"""
+	Make requests until the deadline, and put the number made into a queue.
+	"""
+	client = Client(address)
+	client.request('LOGIN', 'user{}'.format(index))
+	count = 0
+	while time.time() < deadline:
+		client.request(requests[count % len(requests)])
+		count += 1
+	client.request('BYE')
+	counts.put(count)
+
+def throughput(server_class, clients, duration):
+	"""
+	Return the requests per second handled by a server for a number of
+	clients.
+	"""
+	addresses = multiprocessing.Queue()
+	process = multiprocessing.Process(target=serve,
+		args=(server_class, addresses))
+	process.daemon = True
+	process.start()
+	address = addresses.get()
+	try:
+		counts = multiprocessing.Queue()
+		deadline = time.time() + duration
+		loops = [multiprocessing.Process(target=request_loop,
+			args=(address, i, deadline, counts)) for i in range(clients)]
+		for loop in loops:
+			loop.start()
+		total = sum(counts.get() for _ in loops)
+		for loop in loops:
+			loop.join()
+		return total / float(duration)
+	finally:
+		process.terminate()
+		process.join()
+
+def median(values):
+	"""
+	Return the median of a list of numbers.
+	"""
+	values = sorted(values)
+	return values[len(values) // 2]
+
+def main():
+	"""
+	Compare the handling time and throughput with and without metrics,
+	alternating between them in random order over many rounds so that noise
+	affects both alike. The overhead is the median of the ratios within each
+	round, which is steadier than the ratio of the medians when the speed of
+	the machine drifts between rounds.
+	"""
+	argp = argparse.ArgumentParser(
+		description='Benchmark the overhead of the Nim server metrics.',
+		formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+	argp.add_argument('-c', '--clients', type=int, default=4,
+		help='the number of clients measuring throughput')
+	argp.add_argument('-d', '--duration', type=float, default=2.0,
+		help='the seconds to measure throughput for')
+	argp.add_argument('-n', '--number', type=int, default=2000,
+		help='the number of requests to measure handling time for')
+	argp.add_argument('-r', '--rounds', type=int, default=300,
+		help='the number of rounds to measure handling time for')
+	argp.add_argument('-t', '--throughput-rounds', type=int, default=9,
+		help='the number of rounds to measure throughput for')
+	args = argp.parse_args()
+	times = dict((name, []) for name in servers)
+	rates = dict((name, []) for name in servers)
+	# Reuse one server of each kind, so that starting the metrics' thread
+	# is not measured
+	instances = dict((name, server_class(('127.0.0.1', 0),
+		BaseNimRequestHandler)) for name, server_class in servers.items())
+	for _ in range(args.rounds):
+		for name in random.sample(list(servers), len(servers)):
+			times[name].append(handle_time(instances[name], args.number))
+	for server in instances.values():
+		server.server_close()
+	for _ in range(args.throughput_rounds):
+		for name in random.sample(list(servers), len(servers)):
+			rates[name].append(throughput(servers[name], args.clients,
+				args.duration))
+	print('{:<8} {:>12} {:>12}'.format('metrics', 'us/request', 'req/s'))
+	for name in ('off', 'on'):
+		print('{:<8} {:>12.2f} {:>12.0f}'.format(name,
+			median(times[name]) * 1e6, median(rates[name])))
+	print('Overhead: {:.1f}% handling time, {:.1f}% throughput'.format(
+		(median([on / off for on, off in zip(times['on'], times['off'])])
+		- 1) * 100,
+		(1 - median([on / off for on, off in zip(rates['on'],
+		rates['off'])])) * 100))
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,407 @@
+# Remy Oukaour, 107122849
+# CSE 310, Group 2
+
+"""
+Usage: python -m benchmarks.micro run [-h|--help] [-n NUMBER] [-r REPEAT]
+	[-o OUTPUT] [BENCHMARK ...]
+       python -m benchmarks.micro compare [-h|--help] [-t THRESHOLD]
+	BASELINE CURRENT
+
+Times the primitives which the server runs for every request: parsing
+requests and responses of various sizes, building and sending responses,
+making moves and describing games, queueing messages for users with long
+queues, and filtering many users. Results can be saved as a JSON baseline,
+and two baselines can be compared to find regressions.
+"""
+
+from __future__ import print_function
+
+import argparse
+import fnmatch
+import json
+import sys
+import time
+import timeit
+from nim.nimlib import *
+from nim.server import *
+from nim.matchmaker import *
+from benchmarks.metrics import MemorySocket
+
+class UnmeasuredServer(NimServer):
+	"""
+	A server which does not collect metrics, and is never started.
+	"""
+	
+	collect_metrics = False
+
+def request_data(headers=0, body=0):
+	"""
+	Return a request with a number of headers and bytes of body.
+	"""
+	return 'REMOVE 3 2 NIM/3.0\r\n{}Content-Length: {}\r\n\r\n{}'.format(
+		''.join('X-Header-{}: value {}\r\n'.format(i, i)
+		for i in range(headers)), body, 'x' * body)
+
+def response_data(headers=0, body=0):
+	"""
+	Return a response with a number of headers and bytes of body.
+	"""
+	return 'NIM/3.0 200 OK\r\n{}Content-Length: {}\r\n\r\n{}'.format(
+		''.join('X-Header-{}: value {}\r\n'.format(i, i)
+		for i in range(headers)), body, 'x' * body)
+
+def parse(packet_class, data):
+	"""
+	Return a function which parses packet data, including its lazily parsed
+	headers and body.
+	"""
+	def benchmark():
+		packet = packet_class(data)
+		packet.headers
+		packet.body
+	return benchmark
+
+def compose(body):
+	"""
+	Return a function which builds a response with a body.
+	"""
+	def benchmark():
+		NimResponse.compose(OK, body)
+	return benchmark
+
+def new_handler(users=0):
+	"""
+	Return a request handler for a logged-in user of a server which is never
+	started, with a number of other logged-in users, a third of them playing
+	games.
+	"""
+	server = UnmeasuredServer(('127.0.0.1', 0), BaseNimRequestHandler)
+	server.server_close()
+	# The handler finishes immediately with nothing to read, so add its user
+	# back to the server
+	handler = BaseNimRequestHandler(MemorySocket(''), ('127.0.0.1', 0),
+		server)
+	server.name_user(server.add_user(handler.socket), 'alice')
+	for i in range(users):
+		server.name_user(server.add_user(i), 'user{}'.format(i))
+		if i % 3 == 2:
+			server.start_game(server.usernames['user{}'.format(i - 1)],
+				server.usernames['user{}'.format(i)])
+	return handler
+
+def send_response(body):
+	"""
+	Return a function which makes a request handler build a response with a
+	body and send it, with another response of queued messages before it.
+	"""
+	handler = new_handler()
+	user = handler.server.get_user(handler.socket)
+	def benchmark():
+		user.enqueue('bob takes 1 from set 2')
+		handler.send_response(OK, body)
+		handler.flush()
+	return benchmark
+
+def dispatch_getattr(method, params):
+	"""
+	Return a function which finds the handler of a request's method by name
+	and looks up its signature to check and convert its parameters, as
+	request handlers did before they had dispatch tables.
+	"""
+	handler = new_handler()
+	def benchmark():
+		do_method = 'do_' + method
+		if hasattr(handler, do_method):
+			types = handler.signatures.get(method, ())
+			if len(params) != len(types):
+				raise ValueError('expected {} parameters'.format(len(types)))
+			tuple([t(p) for (t, p) in zip(types, params)])
+			getattr(handler, do_method)
+	return benchmark
+
+def dispatch_table(method, params):
+	"""
+	Return a function which finds the handler of a request's method in the
+	dispatch table and checks and converts its parameters with its decoder,
+	the same work as dispatch_getattr().
+	"""
+	handler = new_handler()
+	def benchmark():
+		entry = handler.dispatch.get(method)
+		if entry is not None:
+			do_method, decode = entry
+			decode(params)
+			do_method.__get__(handler)
+	return benchmark
+
+def games_page(games, limit):
+	"""
+	Return a function which lists a page of games on a server with a number
+	of games, without the cached pages.
+	"""
+	handler = new_handler(games * 3)
+	server = handler.server
+	def benchmark():
+		server.revision += 1
+		server.games_page(None, limit)
+	return benchmark
+
+def handle_request(data, users=0):
+	"""
+	Return a function which makes a request handler handle a request and send
+	its response, on a server with a number of other users. The request data
+	can include the server's revision.
+	"""
+	handler = new_handler(users)
+	request = NimRequest(data.format(revision=handler.server.revision))
+	def benchmark():
+		handler.request = request
+		handler.handle_one_request()
+	return benchmark
+
+def new_game():
+	"""
+	Return a game between two new users.
+	"""
+	return NimGame(NimUser(None, 'alice'), NimUser(None, 'bob'))
+
+def game_moves():
+	"""
+	Return a function which plays a whole game of 35 moves.
+	"""
+	game = new_game()
+	players = [game.player1, game.player2]
+	def benchmark():
+		game.sets = [NIM_MAX_OBJECTS] * NIM_MAX_SETS
+		game.playing, game.waiting = players
+		game.over = False
+		for i in range(NIM_MAX_OBJECTS * NIM_MAX_SETS):
+			game.move(players[i % 2], 1, i % NIM_MAX_SETS + 1)
+	return benchmark
+
+def game_state():
+	"""
+	Return a function which describes a game.
+	"""
+	game = new_game()
+	game.sets = [NIM_MAX_OBJECTS] * NIM_MAX_SETS
+	return game.get_state
+
+def enqueue_dequeue(length):
+	"""
+	Return a function which queues a number of messages for a user, then
+	empties their queue.
+	"""
+	user = NimUser(None, 'alice')
+	messages = [NimMessage('bob takes 1 from set {}'.format(i % 5 + 1))
+		for i in range(length)]
+	def benchmark():
+		for message in messages:
+			user.enqueue(message)
+		user.dequeue()
+	return benchmark
+
+def enqueue_full(policy):
+	"""
+	Return a function which queues as many moves as fit in a queue for a
+	user who never collects them, with a queue policy, starting with a full
+	queue. Its time is divided by the number of moves, so that a policy
+	which empties the queue when it overflows is charged for refilling it
+	as often as it does so, instead of once per overflowing move.
+	"""
+	user = NimUser(None, 'alice')
+	user.queue_policy = policy
+	user.game = new_game()
+	message = NimMessage('bob takes 1 from set 2', user.game)
+	while len(user.queue) < user.max_queue_length:
+		user.enqueue(message)
+	def benchmark():
+		for _ in xrange(user.max_queue_length):
+			user.enqueue(message)
+	benchmark.calls = user.max_queue_length
+	return benchmark
+
+def match_users(waiting):
+	"""
+	Return a function which pairs a user with one of a number of users
+	waiting for a match in different rating bands, then puts that user back.
+	"""
+	matchmaker = NimMatchmaker(100, 5.0, 5)
+	for i in range(waiting):
+		matchmaker.add(NimUser(None, 'user{}'.format(i)), i * 100, 0)
+	user = NimUser(None, 'alice')
+	rating = waiting // 2 * 100
+	def benchmark():
+		opponent = matchmaker.add(user, rating, 0)
+		matchmaker.add(opponent, rating, 0)
+	return benchmark
+
+def filter_users(count, **filters):
+	"""
+	Return a function which lists the users of a server with a number of
+	users, a third of them playing games and a third not logged in.
+	"""
+	server = UnmeasuredServer(('127.0.0.1', 0), BaseNimRequestHandler)
+	server.server_close()
+	for i in range(count):
+		user = server.add_user(i)
+		if i % 3:
+			server.name_user(user, 'user{}'.format(i))
+		if i % 3 == 2:
+			user.game = True
+	def benchmark():
+		list(server.all_users(**filters))
+	return benchmark
+
+# The benchmarks, and the functions which set them up and return a function
+# to time
+benchmarks = [
+	('parse-request', lambda: parse(NimRequest, request_data())),
+	('parse-request-8-headers',
+		lambda: parse(NimRequest, request_data(headers=8))),
+	('parse-request-32-headers',
+		lambda: parse(NimRequest, request_data(headers=32))),
+	('parse-request-1k-body',
+		lambda: parse(NimRequest, request_data(body=1024))),
+	('parse-request-64k-body',
+		lambda: parse(NimRequest, request_data(body=65536))),
+	('parse-response', lambda: parse(NimResponse, response_data())),
+	('parse-response-8-headers',
+		lambda: parse(NimResponse, response_data(headers=8))),
+	('parse-response-1k-body',
+		lambda: parse(NimResponse, response_data(body=1024))),
+	('parse-response-64k-body',
+		lambda: parse(NimResponse, response_data(body=65536))),
+	('compose-response', lambda: compose('Hello, alice!')),
+	('compose-response-1k-body', lambda: compose('x' * 1024)),
+	('send-response', lambda: send_response('Hello, alice!')),
+	('dispatch-getattr', lambda: dispatch_getattr('REMOVE', ('3', '2'))),
+	('dispatch-table', lambda: dispatch_table('REMOVE', ('3', '2'))),
+	('handle-ping', lambda: handle_request(request_data().replace(
+		'REMOVE 3 2', 'PING'))),
+	('handle-who', lambda: handle_request(request_data().replace(
+		'REMOVE 3 2', 'WHO'))),
+	('handle-games-50k-limit-100', lambda: handle_request(
+		'GAMES NIM/3.0\r\nLimit: 100\r\n\r\n', 150000)),
+	('handle-games-50k-not-modified', lambda: handle_request(
+		'GAMES NIM/3.0\r\nIf-Revision: {revision}\r\n\r\n', 150000)),
+	('games-page-50k-limit-100', lambda: games_page(50000, 100)),
+	('handle-who-50k-limit-100', lambda: handle_request(
+		'WHO NIM/3.0\r\nLimit: 100\r\n\r\n', 50000)),
+	('handle-who-50k-prefix', lambda: handle_request(
+		'WHO NIM/3.0\r\nPrefix: user4999\r\n\r\n', 50000)),
+	('game-moves', game_moves),
+	('game-state', game_state),
+	('enqueue-dequeue-10', lambda: enqueue_dequeue(10)),
+	('enqueue-dequeue-1000', lambda: enqueue_dequeue(1000)),
+	('enqueue-full-drop-oldest', lambda: enqueue_full(NimUser.DROP_OLDEST)),
+	('enqueue-full-collapse', lambda: enqueue_full(NimUser.COLLAPSE)),
+	('match-10k-waiting', lambda: match_users(10000)),
+	('all-users-10k', lambda: filter_users(10000)),
+	('all-users-10k-available',
+		lambda: filter_users(10000, logged_in=True, available=True)),
+]
+
+def calibrate(function, minimum=0.1):
+	"""
+	Return the number of calls to a function which take at least minimum
+	seconds.
+	"""
+	number = 1
+	while True:
+		if timeit.timeit(function, number=number) >= minimum:
+			return number
+		number *= 2
+
+def run(args):
+	"""
+	Time each selected benchmark, print the results, and save them as a
+	baseline.
+	"""
+	results = {}
+	for name, setup in benchmarks:
+		if args.benchmarks and not any(fnmatch.fnmatch(name, pattern)
+			for pattern in args.benchmarks):
+			continue
+		function = setup()
+		number = args.number or calibrate(function)
+		# The fastest repetition is the least disturbed by noise; benchmarks
+		# which repeat an operation report the time of each one
+		seconds = min(timeit.repeat(function, number=number,
+			repeat=args.repeat)) / number / getattr(function, 'calls', 1)
+		results[name] = seconds
+		print('{:<32} {:>12.3f} us'.format(name, seconds * 1e6))
+	if args.output:
+		with open(args.output, 'w') as file:
+			json.dump({'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+				'python': sys.version.split()[0], 'results': results},
+				file, indent=1, sort_keys=True)
+			file.write("\n")
+
+def compare(args):
+	"""
+	Compare two baselines, print the change of each benchmark, and exit with
+	status 1 if any benchmark became slower by more than the threshold.
+	"""
+	with open(args.baseline) as file:
+		baseline = json.load(file)['results']
+	with open(args.current) as file:
+		current = json.load(file)['results']
+	regressions = 0
+	print('{:<32} {:>12} {:>12} {:>8}'.format('benchmark', 'baseline us',
+		'current us', 'change'))
+	for name in sorted(set(baseline) & set(current)):
+		ratio = current[name] / baseline[name]
+		if ratio > 1 + args.threshold:
+			flag = 'slower'
+			regressions += 1
+		elif ratio < 1 / (1 + args.threshold):
+			flag = 'faster'
+		else:
+			flag = ''
+		print('{:<32} {:>12.3f} {:>12.3f} {:>+7.1f}% {}'.format(name,
+			baseline[name] * 1e6, current[name] * 1e6, (ratio - 1) * 100,
+			flag))
+	for name in sorted(set(baseline) ^ set(current)):
+		print('{:<32} only in {}'.format(name,
+			args.baseline if name in baseline else args.current))
+	if regressions:
+		print('{} benchmark{} slower by more than {:.0f}%'.format(regressions,
+			's' if regressions != 1 else '', args.threshold * 100))
+		sys.exit(1)
+
+def main():
+	"""
+	Run the micro-benchmarks, or compare two baselines.
+	"""
+	argp = argparse.ArgumentParser(
+		description='Micro-benchmarks of the Nim protocol and server.')
+	commands = argp.add_subparsers()
+	runp = commands.add_parser('run',
+		help='time the benchmarks',
+		formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+	runp.add_argument('-n', '--number', type=int, default=None,
+		help='the number of calls to time in each repetition (default: '
+		'enough to take 0.1 seconds)')
+	runp.add_argument('-r', '--repeat', type=int, default=5,
+		help='the number of repetitions, of which the fastest is reported')
+	runp.add_argument('-o', '--output', type=str, default=None,
+		help='save the results as a JSON baseline to this file')
+	runp.add_argument('benchmarks', metavar='BENCHMARK', nargs='*',
+		help='only run benchmarks matching these patterns (default: all)')
+	runp.set_defaults(command=run)
+	comparep = commands.add_parser('compare',
+		help='compare two baselines',
+		formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+	comparep.add_argument('-t', '--threshold', type=float, default=0.1,
+		help='the fraction by which a benchmark must slow down to be flagged')
+	comparep.add_argument('baseline', type=str,
+		help='the baseline to compare against')
+	comparep.add_argument('current', type=str,
+		help='the baseline to compare')
+	comparep.set_defaults(command=compare)
+	args = argp.parse_args()
+	args.command(args)
+
+if __name__ == '__main__':
+	main()
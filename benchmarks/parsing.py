@@ -0,0 +1,181 @@
+# Remy Oukaour, 107122849
+# CSE 310, Group 2
+
+"""
+Usage: python -m benchmarks.parsing [-h|--help] [-n NUMBER] [-f FUZZ]
+
+Checks that the fast-path Nim packet parser agrees with the regular expression
+parser on a corpus of packets (and random mutations of it), then compares the
+throughput of the two parsers.
+"""
+
+from __future__ import print_function
+
+import argparse
+import random
+import re
+import timeit
+from distutils.version import LooseVersion
+from nim.nimlib import *
+
+# Requests which both parsers must parse identically or reject
+request_corpus = [
+	"PING NIM/3.0\r\nContent-Length: 0\r\n\r\n",
+	"LOGIN alice NIM/3.0\r\nContent-Length: 0\r\n\r\n",
+	"REMOVE 3 2 NIM/3.0\r\nContent-Length: 0\r\n\r\n",
+	" \tREMOVE\t3  2 NIM/3.0\r\nContent-Length: 0\r\n\r\n",
+	"WHO NIM/3.0\r\n\r\n",
+	"WHO NIM/3.0\r\n\r\nbody\r\n\r\nmore body\n",
+	"GAMES NIM/3.1.2\r\nA: 1\r\nB:2\r\nC:\t 3 \t\r\nD:\r\nA: 4\r\n\r\n",
+	"GAMES NIM/3.0\r\nX-Value: a:b: c\r\nContent-Length: 3\r\n\r\nabc",
+	"GAMES NIM/3.0\r\nX-Value: a\nb\r\n\r\n",
+	"GAMES NIM/3.0\r\nX: 1\r\nbad header\r\n\r\n",
+	"GAMES NIM/3.0\r\n X: 1\r\n\r\n",
+	"GAMES NIM/3.0\r\n: 1\r\n\r\n",
+	"GAMES NIM/3.0 \r\n\r\n",
+	"games NIM/3.0\r\n\r\n",
+	"GAMES NIM/\r\n\r\n",
+	"GAMES NIM/3.N\r\n\r\n",
+	"GAMES NIM/3.0",
+	"GAMES nim/3.0\r\n\r\n",
+	"GAMES a/b NIM/3.0\r\n\r\n",
+	"GAMESNIM/3.0\r\n\r\n",
+	"NIM/3.0\r\n\r\n",
+	"GAMES NIM/3.0\r\nA: 1\r\n\r\nB: 2\r\n\r\n",
+	"",
+]
+
+# Responses which both parsers must parse identically or reject
+response_corpus = [
+	"NIM/3.0 200 OK\r\nContent-Length: 0\r\n\r\n",
+	"NIM/3.0 201 Hello\r\nContent-Length: 13\r\n\r\nHello, alice!",
+	"NIM/3.0 505 Nim Version Not Supported\r\nContent-Length: 0\r\n\r\n",
+	"  NIM/3.0\t300  Continued \t\r\n\r\n\nqueued\r\n\r\nmessages",
+	"NIM/3.0 418 I'm A Teapot\r\n\r\n",
+	"NIM/3.0 200 \r\n\r\n",
+	"NIM/3.0 200\r\n\r\n",
+	"NIM/3.0 2x0 OK\r\n\r\n",
+	"NIM/3.0 200 OK/Fine\r\n\r\n",
+	"NIM/3.0200 OK\r\n\r\n",
+	"NIM/3.0 200 OK\r\nA: 1\r\nB:  two words  \r\n\r\n",
+	"NIM/3.0 200 OK\r\nA: 1\r\nB\r\n\r\n",
+	"HTTP/1.1 200 OK\r\n\r\n",
+	"",
+]
+
+# The characters used to randomly mutate packets in the corpus
+mutations = "AMNZaz09_-+./: \t\r\n'\x0b"
+
+def regex_request(data):
+	"""
+	Return the fields of a NimRequest as parsed by the regular expressions.
+	"""
+	match = re.match(NimRequest.request_regex, data)
+	if not match:
+		raise NimException('malformed request: {!r}'.format(data))
+	parts = match.groupdict()
+	headers = dict(re.findall(NimPacket.header_regex, parts['headers']))
+	version = LooseVersion(parts['version'])
+	params = tuple(parts['params'].split())
+	return (data.split("\r\n")[0], version, parts['method'], params,
+		headers, parts['body'])
+
+def regex_response(data):
+	"""
+	Return the fields of a NimResponse as parsed by the regular expressions.
+	"""
+	match = re.match(NimResponse.response_regex, data)
+	if not match:
+		raise NimException('malformed response: {!r}'.format(data))
+	parts = match.groupdict()
+	headers = dict(re.findall(NimPacket.header_regex, parts['headers']))
+	version = LooseVersion(parts['version'])
+	return (data.split("\r\n")[0], version, int(parts['status']),
+		parts['reason'], headers, parts['body'])
+
+def fast_request(data):
+	"""
+	Return the fields of a NimRequest as parsed by the fast path.
+	"""
+	packet = NimRequest(data)
+	return (packet.request, packet.version, packet.method,
+		packet.params, packet.headers, packet.body)
+
+def fast_response(data):
+	"""
+	Return the fields of a NimResponse as parsed by the fast path.
+	"""
+	packet = NimResponse(data)
+	return (packet.response, packet.version,
+		packet.status, packet.reason, packet.headers, packet.body)
+
+def parse_or_none(parser, data):
+	"""
+	Return the fields parsed from packet data, or None if it is malformed.
+	"""
+	try:
+		return parser(data)
+	except (NimException, ValueError) as e:
+		return None
+
+def mutate(data):
+	"""
+	Return packet data with a random character inserted, deleted, or replaced.
+	"""
+	i = random.randint(0, len(data))
+	c = random.choice(mutations)
+	return random.choice([data[:i] + c + data[i:], data[:i] + data[i+1:],
+		data[:i] + c + data[i+1:]])
+
+def check(corpus, fast, regex, fuzz):
+	"""
+	Check that the two parsers agree on every packet in the corpus and on fuzz
+	random mutations of it. Return the number of packets checked.
+	"""
+	packets = list(corpus)
+	for _ in range(fuzz):
+		packets.append(mutate(mutate(random.choice(corpus))))
+	for data in packets:
+		expected = parse_or_none(regex, data)
+		actual = parse_or_none(fast, data)
+		if expected != actual:
+			raise AssertionError('parsers disagree on {!r}:\n{!r}\n{!r}'.format(
+				data, expected, actual))
+	return len(packets)
+
+def throughput(parser, packets, number):
+	"""
+	Return the number of packets parsed per second.
+	"""
+	packets = [p for p in packets if parse_or_none(parser, p)]
+	seconds = min(timeit.repeat(lambda: [parser(p) for p in packets],
+		repeat=3, number=number))
+	return len(packets) * number / seconds
+
+def main():
+	"""
+	Check and benchmark the packet parsers.
+	"""
+	argp = argparse.ArgumentParser(
+		description='Benchmark the Nim packet parsers.',
+		formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+	argp.add_argument('-n', '--number', type=int, default=2000,
+		help='the number of times to parse the corpus')
+	argp.add_argument('-f', '--fuzz', type=int, default=20000,
+		help='the number of random mutations to check')
+	args = argp.parse_args()
+	# Check that the parsers agree
+	n = check(request_corpus, fast_request, regex_request, args.fuzz)
+	n += check(response_corpus, fast_response, regex_response, args.fuzz)
+	print('{} packets parsed identically'.format(n))
+	# Compare the parsers' throughput
+	for name, corpus, fast, regex in [
+		('requests', request_corpus, fast_request, regex_request),
+		('responses', response_corpus, fast_response, regex_response)]:
+		slow = throughput(regex, corpus, args.number)
+		quick = throughput(fast, corpus, args.number)
+		print('{:<10} regex {:>10.0f}/s  fast {:>10.0f}/s  ({:.2f}x)'.format(
+			name, slow, quick, quick / slow))
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,102 @@
+# Remy Oukaour, 107122849
+# CSE 310, Group 2
+
+"""
+Usage: python -m benchmarks.queues [-h|--help] [-n NUMBER [NUMBER ...]]
+
+Compares the time taken to queue messages for a user who never collects them,
+between NimUser's bounded deque and the unbounded string it used to append to,
+and shows what is left in the queue under each of its overflow policies.
+"""
+
+from __future__ import print_function
+
+import argparse
+import socket
+import time
+from nim.server import *
+
+# A typical message about a move, as queued for an opponent or observer
+message = "alice takes 3 from set 2\n      4  0  5  7"
+
+class StringQueueUser(object):
+	"""
+	A user whose queue is a string which each message is appended to, like
+	NimUser before it used a deque.
+	"""
+	
+	def __init__(self):
+		"""
+		Instantiate a user with no queued messages.
+		"""
+		self.queue = ''
+	
+	def enqueue(self, message):
+		"""
+		Add a message to the queue.
+		"""
+		self.queue += "\n" + message
+
+class UnboundedUser(NimUser):
+	"""
+	A NimUser whose queue can grow as large as the string queue.
+	"""
+	
+	max_queue_length = max_queue_size = float('inf')
+
+def enqueue_time(user, number):
+	"""
+	Return the seconds per message taken to queue a number of messages for
+	a user.
+	"""
+	start = time.time()
+	for _ in range(number):
+		user.enqueue(message)
+	return (time.time() - start) / number
+
+def overflow(policy, number):
+	"""
+	Queue a number of messages for an observer of a game whose queue uses a
+	policy, and return the user.
+	"""
+	connection, other_end = socket.socketpair()
+	user = NimUser(connection, 'carol')
+	user.queue_policy = policy
+	game = NimGame(NimUser(None, 'alice'), NimUser(None, 'bob'))
+	game.add_observer(user)
+	update = NimMessage(message, game)
+	for _ in range(number):
+		user.enqueue(update)
+	other_end.close()
+	return user
+
+def main():
+	"""
+	Measure the time to queue messages, then apply each overflow policy.
+	"""
+	argp = argparse.ArgumentParser(
+		description='Benchmark the Nim server message queues.',
+		formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+	argp.add_argument('-n', '--number', type=int, nargs='+',
+		default=[1000, 10000, 100000],
+		help='the numbers of messages to queue')
+	args = argp.parse_args()
+	print('{:>8} {:>14} {:>14} {:>14}'.format('messages', 'string us/msg',
+		'deque us/msg', 'bounded us/msg'))
+	for number in args.number:
+		times = [enqueue_time(user, number) * 1e6 for user in
+			(StringQueueUser(), UnboundedUser(None), NimUser(None))]
+		print('{:>8} {:>14.2f} {:>14.2f} {:>14.2f}'.format(number, *times))
+	number = max(args.number)
+	print()
+	print('After queueing {} messages (limits: {} messages, {} bytes):'.format(
+		number, NimUser.max_queue_length, NimUser.max_queue_size))
+	print('{:<12} {:>8} {:>8} {:>8} {:>13}'.format('policy', 'messages',
+		'bytes', 'dropped', 'disconnected'))
+	for policy in (NimUser.DROP_OLDEST, NimUser.COLLAPSE, NimUser.DISCONNECT):
+		user = overflow(policy, number)
+		print('{:<12} {:>8} {:>8} {:>8} {:>13}'.format(policy, len(user.queue),
+			user.queue_size, user.dropped, str(user.disconnected)))
+
+if __name__ == '__main__':
+	main()
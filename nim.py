@@ -90,6 +90,9 @@ class NimTextClient(object):
 	# A mapping from command names to their methods
 	commands = Commands()
 	
+	# The most seconds the server waits for a message before answering a PING
+	wait = 30
+	
 	def __init__(self, ps='> '):
 		"""
 		Instantiate a Nim text client.
@@ -176,14 +179,17 @@ class NimTextClient(object):
 		Send PING requests periodically until the client stops running.
 		"""
 		while self.running:
-			# Check that the client is not handling a command
-			if not self.prompting:
+			# Check that the client is not handling a command, and that the
+			# server is not already pushing messages
+			if not self.prompting or self.pushing():
 				# Wait for one second before PINGing again
 				time.sleep(1)
 				continue
 			try:
-				# Send a PING request to the server
-				response = self.client.ping()
+				# Send a PING request to the server, which answers when a
+				# message is queued or the wait is over
+				start = time.time()
+				response = self.client.ping(self.wait)
 				# Print the response if it is non-empty
 				if response.body:
 					print(response.body, self.ps,
@@ -193,12 +199,31 @@ class NimTextClient(object):
 					if response.body:
 						print(response.body, self.ps,
 							sep="\n", end='')
-				# Wait for one second before PINGing again
-				time.sleep(1)
+				# Wait for one second before PINGing again if the server
+				# answered at once without waiting
+				elapsed = time.time() - start
+				if not response.body and elapsed < 1:
+					time.sleep(1 - elapsed)
 			except nimlib.NimException as e:
 				print(e.message)
 				break
 	
+	def pushing(self):
+		"""
+		Return True if the server is pushing messages to the client, False
+		otherwise.
+		"""
+		client = self.client
+		return bool(client and client.conn and client.conn.pushing)
+	
+	def pushed(self, response):
+		"""
+		Print a message pushed by the server.
+		"""
+		if response.body:
+			print(response.body, self.ps if self.prompting else '',
+				sep="\n", end='')
+	
 	def exit(self):
 		"""
 		Disconnect from the server and exit the client.
@@ -251,8 +276,8 @@ class NimTextClient(object):
 		if not is_nim_username(name):
 			print('Invalid name; must be 1 to 32 characters from A-Z a-z 0-9 _ - + .')
 			return
-		# Send a LOGIN request to the server
-		response = self.client.login(name)
+		# Send a LOGIN request to the server, asking it to push messages
+		response = self.client.login(name, self.pushed)
 		# Print the response
 		print(response.body)
 		self.continued(response)
@@ -1,4 +1,5 @@
 # Remy Oukaour, 107122849
 # CSE 310, Group 2
 
-__all__ = ['nimlib', 'client', 'server']
+__all__ = ['nimlib', 'client', 'server', 'accesslog', 'metrics',
+	'profiler', 'matchmaker']
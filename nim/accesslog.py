@@ -0,0 +1,182 @@
+# Remy Oukaour, 107122849
+# CSE 310, Group 2
+
+"""
+This module defines an access log which Nim request handlers can add records
+to without waiting for them to be formatted or written.
+"""
+
+__all__ = ['NimAccessLog']
+
+import collections
+import json
+import os
+import random
+import sys
+import threading
+import time
+from nimlib import *
+
+class NimAccessLog(object):
+	"""
+	Represents a log of connections and requests. Request handlers add
+	compact records to a queue without locking it (a deque's append and
+	popleft are atomic), and a background thread formats the queued records,
+	and writes them in batches to a file which is rotated when it grows too
+	large, or to standard output.
+	"""
+	
+	# The kinds of records
+	CONNECT, DISCONNECT, REQUEST = 'connect', 'disconnect', 'request'
+	
+	# The most records which can wait to be written; more are dropped
+	max_pending = 100000
+	
+	def __init__(self, path=None, sample=1.0, json_lines=False,
+		max_bytes=10 * 1024 * 1024, backups=5, flush_interval=0.5):
+		"""
+		Instantiate an access log which writes to a file, or to standard
+		output if path is None, and start its writer thread. Only a random
+		sample of requests are logged, at the given rate. Each record is
+		written as a JSON object if json_lines is True, otherwise as text.
+		Once the file would grow past max_bytes, it is renamed with a numbered
+		suffix, keeping the given number of backups.
+		"""
+		self.path = path
+		self.sample = sample
+		self.json_lines = json_lines
+		self.max_bytes = max_bytes
+		self.backups = backups
+		self.flush_interval = flush_interval
+		# Initially no records are waiting to be written
+		self.pending = collections.deque()
+		# Initially no records have been dropped
+		self.dropped = 0
+		# Open the log file, or use standard output
+		self.file = open(path, 'a') if path else sys.stdout
+		self.size = self.file.tell() if path else 0
+		# Start the writer thread
+		self.running = True
+		self.writer = threading.Thread(target=self.write_forever)
+		self.writer.daemon = True
+		self.writer.start()
+	
+	def log(self, kind, *fields):
+		"""
+		Add a record of a connection, disconnection, or request to the queue,
+		unless it is a request which is not sampled.
+		"""
+		if kind == self.REQUEST and self.sample < 1.0:
+			if random.random() >= self.sample:
+				return
+		if len(self.pending) >= self.max_pending:
+			self.dropped += 1
+			return
+		self.pending.append((kind, time.time()) + fields)
+	
+	def connected(self, host, port, fileno, thread):
+		"""
+		Log a new connection.
+		"""
+		self.log(self.CONNECT, host, port, fileno, thread)
+	
+	def disconnected(self, host, port, fileno, thread):
+		"""
+		Log a closed connection.
+		"""
+		self.log(self.DISCONNECT, host, port, fileno, thread)
+	
+	def requested(self, host, port, request, response, duration):
+		"""
+		Log a request, its response, and the seconds taken to handle it.
+		"""
+		self.log(self.REQUEST, host, port, request, response, duration)
+	
+	def format(self, record):
+		"""
+		Return a line describing a record.
+		"""
+		kind, timestamp = record[:2]
+		if self.json_lines:
+			return self.format_json(record) + "\n"
+		if kind == self.CONNECT:
+			return 'Connection from {}:{} on socket {}, thread {}\n'.format(
+				*record[2:])
+		if kind == self.DISCONNECT:
+			return 'Disconnection by {}:{} on socket {}, thread {}\n'.format(
+				*record[2:])
+		host, port, request, response, duration = record[2:]
+		return '{}:{} [{}] "{}" {} {} {!r} {:.3f}ms\n'.format(host, port,
+			time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(timestamp)),
+			request.request, response.status, responses[response.status],
+			response.body, duration * 1e3)
+	
+	def format_json(self, record):
+		"""
+		Return a JSON object describing a record.
+		"""
+		kind, timestamp = record[:2]
+		if kind in (self.CONNECT, self.DISCONNECT):
+			host, port, fileno, thread = record[2:]
+			return json.dumps({'event': kind, 'time': timestamp,
+				'host': host, 'port': port, 'socket': fileno,
+				'thread': thread})
+		host, port, request, response, duration = record[2:]
+		return json.dumps({'event': kind, 'time': timestamp, 'host': host,
+			'port': port, 'method': request.method,
+			'params': list(request.params if request.args is None
+				else request.args), 'status': response.status,
+			'reason': responses[response.status], 'body': response.body,
+			'duration': duration})
+	
+	def write_forever(self):
+		"""
+		Write the queued records every flush_interval seconds, until the log
+		is closed.
+		"""
+		while self.running:
+			time.sleep(self.flush_interval)
+			self.write_pending()
+	
+	def write_pending(self):
+		"""
+		Format every queued record and write them all at once.
+		"""
+		lines = []
+		pending = self.pending
+		while pending:
+			lines.append(self.format(pending.popleft()))
+		if not lines:
+			return
+		data = ''.join(lines)
+		if self.path and self.size and self.size + len(data) > self.max_bytes:
+			self.rotate()
+		self.file.write(data)
+		self.file.flush()
+		self.size += len(data)
+	
+	def rotate(self):
+		"""
+		Rename the log file and its backups with the next numbered suffixes,
+		deleting the oldest, and start a new log file.
+		"""
+		self.file.close()
+		for n in range(self.backups - 1, 0, -1):
+			backup = '{}.{}'.format(self.path, n)
+			if os.path.exists(backup):
+				os.rename(backup, '{}.{}'.format(self.path, n + 1))
+		if self.backups:
+			os.rename(self.path, self.path + '.1')
+		self.file = open(self.path, 'w')
+		self.size = 0
+	
+	def close(self):
+		"""
+		Stop the writer thread, write any queued records, and close the log
+		file.
+		"""
+		self.running = False
+		self.writer.join()
+		self.write_pending()
+		if self.path:
+			self.file.close()
@@ -9,6 +9,9 @@ __all__ = ['is_natural', 'is_nim_username', 'NimConnection', 'NimClient']
 
 import socket
 import re
+import threading
+import time
+import Queue
 from nimlib import *
 
 def is_natural(n):
@@ -32,6 +35,10 @@ class NimConnection(object):
 	Modeled after Python's built-in httplib.HTTPConnection class.
 	"""
 	
+	# The format of a game snapshot or delta line in a response body
+	update_regex = re.compile(
+		r'^(snapshot|delta) ([0-9]+) ([0-9]+)((?: [0-9]+)+)$')
+	
 	def __init__(self, host, port=NIM_PORT):
 		"""
 		Instantiate a connection with a Nim server.
@@ -41,20 +48,50 @@ class NimConnection(object):
 		self.port = port
 		# Initially not waiting for a response
 		self.waiting = False
+		# Initially not waiting for a response to a PING request which waits
+		# for messages
+		self.polling = False
+		# Responses are read in the order their requests were sent, even by
+		# different threads
+		self.turn = threading.Condition(threading.Lock())
+		self.sent = self.answered = 0
+		self.ticket = threading.local()
 		# Connect to server
 		try:
 			self.socket = socket.create_connection((self.host, self.port))
 		except socket.error as e:
 			raise NimException(e.strerror)
+		# Frame the responses received from the server
+		self.reader = NimPacketReader(self.socket, NimResponse)
+		# Initially the server does not push messages
+		self.pushing = False
+		# The callback for pushed messages, once push mode is requested
+		self.on_push = None
+		# The responses received by the push mode reader thread
+		self.responses = None
+		# Initially the server describes moves in full instead of as deltas
+		self.delta = False
+		# The boards of games, as (moves, sizes) tuples, kept up to date
+		# with the snapshots and deltas sent by the server
+		self.boards = {}
+		# The IDs of games whose boards missed a delta and need a snapshot
+		self.stale = set()
 	
 	def close(self):
 		"""
 		Close the connection to the server.
 		"""
 		# Close connection
-		if self.socket:
-			self.socket.close()
+		connection = self.socket
 		self.socket = None
+		if connection:
+			# Wake up the push mode reader thread so that it stops
+			if self.pushing:
+				try:
+					connection.shutdown(socket.SHUT_RDWR)
+				except socket.error as e:
+					pass
+			connection.close()
 	
 	def request(self, method, params='', body='', headers=None):
 		"""
@@ -65,9 +102,6 @@ class NimConnection(object):
 		# Do not make requests after connection is closed
 		if not self.socket:
 			raise ValueError('operation on closed connection')
-		# Do not send request if a response is pending
-		if self.waiting:
-			raise NimException('waiting for response to prior request')
 		# Check that request method is valid
 		if method not in methods:
 			raise ValueError("no such method: '{}'".format(method))
@@ -75,16 +109,28 @@ class NimConnection(object):
 		params = ' ' + params.strip() if params else ''
 		# Convert header dictionary to CRLF-separated string
 		headers = headers or dict()
+		polling = method == 'PING' and 'Wait' in headers
 		headers['Content-Length'] = len(body)
 		headers = ''.join("{}: {}\r\n".format(k, headers[k]) for k in headers)
 		# Send constructed packet to server
 		data = "{}{} NIM/{}\r\n{}\r\n{}".format(method, params, NIM_VERSION, headers, body)
-		try:
-			self.socket.sendall(data)
-		except socket.error as e:
-			raise NimException(e.strerror)
-		# Wait for response from server
-		self.waiting = True
+		with self.turn:
+			# Do not send request if a response is pending, unless it is to a
+			# waiting PING request, which the server answers as soon as it
+			# receives this one
+			if self.waiting and not (self.polling and
+				self.sent - self.answered == 1):
+				raise NimException('waiting for response to prior request')
+			try:
+				self.socket.sendall(data)
+			except socket.error as e:
+				raise NimException(e.strerror)
+			# Wait for response from server
+			if not self.waiting:
+				self.polling = polling
+			self.waiting = True
+			self.ticket.number = self.sent
+			self.sent += 1
 	
 	def getresponse(self, requested=True):
 		"""
@@ -94,26 +140,130 @@ class NimConnection(object):
 		# Do not take responses after connection is closed
 		if not self.socket:
 			raise ValueError('operation on closed connection')
-		# Do not receive response if no request was made
-		if requested and not self.waiting:
-			raise NimException('no request was made')
-		# Read response from server
-		try:
-			data = self.socket.recv(4096)
-		except socket.error as e:
-			raise NimException(e.strerror)
-		# Stop waiting for response to prior request
-		if requested:
-			self.waiting = False
-		# Return response parsed into a NimResponse object
-		try:
-			response = NimResponse(data)
+		ticket = getattr(self.ticket, 'number', None)
+		with self.turn:
+			# Do not receive response if no request was made
+			if requested and not self.waiting:
+				raise NimException('no request was made')
+			# Wait until the responses to earlier requests have been read
+			while ticket is not None and ticket > self.answered:
+				self.turn.wait()
+		# Take response from the push mode reader thread
+		if self.pushing:
+			response = self.responses.get()
+		else:
+			# Read response from server, parsed into a NimResponse object
+			try:
+				response = self.reader.read()
+			except socket.error as e:
+				raise NimException(e.strerror)
+			except NimException as e:
+				response = None
+			self.update_boards(response)
+		with self.turn:
 			# Wait for continued response
-			if response.status == CONTINUED:
+			if response and response.status == CONTINUED:
 				self.waiting = True
-			return response
-		except NimException as e:
-			return None
+				return response
+			# Stop waiting for response to prior request
+			if self.answered < self.sent:
+				self.answered += 1
+			self.polling = False
+			self.waiting = self.answered < self.sent
+			self.turn.notify_all()
+		# Switch to delta mode if it was requested and the server agreed
+		if response and response.getheader('Updates') == 'delta':
+			self.delta = True
+		# Switch to push mode if it was requested and the server agreed
+		if (response and self.on_push and not self.pushing and
+			response.getheader('Push') == 'on'):
+			self.start_pushing()
+		return response
+	
+	def update_boards(self, response):
+		"""
+		Apply the snapshots and deltas in a response to the boards of their
+		games. A delta which does not follow the last move of its game's
+		board marks the board as stale until the next snapshot.
+		"""
+		if not self.delta or not response:
+			return
+		for line in response.body.split("\n"):
+			match = self.update_regex.match(line)
+			if not match:
+				continue
+			kind = match.group(1)
+			id, moves = int(match.group(2)), int(match.group(3))
+			numbers = map(int, match.group(4).split())
+			if kind == 'snapshot':
+				self.boards[id] = (moves, numbers)
+				self.stale.discard(id)
+				continue
+			board = self.boards.get(id)
+			# Ignore deltas already included in the board's snapshot
+			if board and moves <= board[0]:
+				continue
+			# Check that the delta follows the board's last move
+			if not board or moves != board[0] + 1 or len(numbers) != 2:
+				self.boards.pop(id, None)
+				self.stale.add(id)
+				continue
+			s, size = numbers
+			sizes = list(board[1])
+			sizes[s-1] = size
+			self.boards[id] = (moves, sizes)
+	
+	def request_deltas(self):
+		"""
+		Ask the server to describe moves as deltas in the next request,
+		instead of in full, and return the header to send with it.
+		"""
+		return {'Updates': 'delta'}
+	
+	def request_push(self, callback):
+		"""
+		Ask the server to push messages in the next request, instead of
+		queueing them until the client's next request. If the server agrees,
+		callback will be called with each pushed 300 Continued response,
+		from another thread.
+		"""
+		self.on_push = callback
+		return {'Push': 'on'}
+	
+	def start_pushing(self):
+		"""
+		Start a thread which reads every response from the server, passing
+		pushed messages to the callback and keeping the rest for
+		getresponse().
+		"""
+		self.responses = Queue.Queue()
+		self.pushing = True
+		pushd = threading.Thread(target=self.read_pushed)
+		pushd.daemon = True
+		pushd.start()
+	
+	def read_pushed(self):
+		"""
+		Read responses from the server until the connection closes.
+		"""
+		reader = self.reader
+		while True:
+			try:
+				response = reader.read()
+			except (socket.error, NimException) as e:
+				response = None
+			self.update_boards(response)
+			# Pass pushed messages to the callback
+			if response and response.status == CONTINUED:
+				self.on_push(response)
+				continue
+			# Keep other responses for getresponse(), including None when
+			# the server closes the connection
+			if response is None and not self.socket:
+				return
+			self.responses.put(response)
+			if response is None:
+				return
 
 class NimClient(object):
 	"""
@@ -121,14 +271,21 @@ class NimClient(object):
 	Provides an abstraction over the NimConnection class.
 	"""
 	
-	def __init__(self, client_address):
+	def __init__(self, client_address, cache_ttl=None):
 		"""
-		Instantiate a Nim client ready to connect to a server.
+		Instantiate a Nim client ready to connect to a server. If cache_ttl
+		is given, the responses to WHO and GAMES requests are reused for that
+		many seconds, after which they are revalidated with the server if
+		they have a revision.
 		"""
 		# Initialize the server's host and port
 		self.host, self.port = client_address
 		# Initially has no connection to the server
 		self.conn = None
+		# Initially no responses are cached, or waiting to be cached
+		self.cache_ttl = cache_ttl
+		self.cache = {}
+		self.pending = None
 	
 	def connect(self):
 		"""
@@ -148,10 +305,58 @@ class NimClient(object):
 		if self.conn:
 			self.conn.close()
 		self.conn = None
+		self.invalidate()
 	
-	def login(self, name):
+	def invalidate(self):
+		"""
+		Forget the cached responses to WHO and GAMES requests.
+		"""
+		self.cache.clear()
+		self.pending = None
+	
+	def cached_request(self, key, method, headers):
+		"""
+		Send a WHO or GAMES request and return the response, or return the
+		cached response to the same request if it is less than cache_ttl
+		seconds old. If an older cached response has a Revision header, ask
+		the server if it has changed, and renew it if the server responds
+		304 Not Modified.
+		"""
+		entry = self.cache.get(key)
+		now = time.time()
+		if entry and now < entry[1]:
+			return entry[0]
+		revision = entry[0].getheader('Revision') if entry else None
+		if revision is not None:
+			headers['If-Revision'] = revision
+		self.conn.request(method, headers=headers)
+		# The response may follow 300 Continued responses with queued
+		# messages, which are returned first
+		self.pending = (key, entry, now)
+		response = self.conn.getresponse()
+		if response and response.status == CONTINUED:
+			return response
+		return self.cache_response(response)
+	
+	def cache_response(self, response):
+		"""
+		Cache the response to the pending WHO or GAMES request, and return
+		it, or the cached response it renewed if it is 304 Not Modified.
+		"""
+		key, entry, sent = self.pending
+		self.pending = None
+		if response and response.status == NOT_MODIFIED and entry:
+			response = entry[0]
+		if response and response.status == OK:
+			self.cache[key] = (response, sent + self.cache_ttl)
+		return response
+	
+	def login(self, name, on_push=None, delta=False):
 		"""
 		Send a LOGIN request with the given name and return the response.
+		If on_push is given, ask the server to push messages, which will be
+		passed to on_push from another thread. If delta is True, ask the
+		server to describe moves as deltas, which keep board() up to date.
 		"""
 		# Do not send request on closed connection
 		if not self.conn:
@@ -159,39 +364,75 @@ class NimClient(object):
 		# Check that name is valid
 		if not is_nim_username(name):
 			raise ValueError('{!r} is not a valid username'.format(name))
+		# Ask for messages to be pushed if requested
+		headers = self.conn.request_push(on_push) if on_push else {}
+		# Ask for moves to be described as deltas if requested
+		if delta:
+			headers.update(self.conn.request_deltas())
 		# Send request and return response
 		try:
-			self.conn.request('LOGIN', name)
+			self.conn.request('LOGIN', name, headers=headers)
 			response = self.conn.getresponse()
 			return response
 		except (NimException, ValueError) as e:
 			raise NimException(e.message)
 	
-	def games(self):
+	def games(self, after=None, limit=None, revision=None):
 		"""
-		Send a GAMES request and return the response.
+		Send a GAMES request and return the response. If given, only games
+		whose IDs come after the ID given as after are listed, at most limit
+		of them; if there are more, the response's Next header is the ID to
+		list them after. If the games have not changed since the given
+		revision, the response is 304 Not Modified with no body. The
+		response's Revision header is the current revision.
 		"""
 		# Do not send request on closed connection
 		if not self.conn:
 			raise ValueError('operation on closed connection')
-		# Send request and return response
+		# Ask the server for part of the list, or for changes, if requested
+		headers = {}
+		if after is not None:
+			headers['After'] = after
+		if limit:
+			headers['Limit'] = limit
+		# Send request and return response, using the cache unless the caller
+		# gave its own revision
 		try:
-			self.conn.request('GAMES')
+			if self.cache_ttl and revision is None:
+				return self.cached_request(('GAMES', after, limit), 'GAMES',
+					headers)
+			if revision is not None:
+				headers['If-Revision'] = revision
+			self.conn.request('GAMES', headers=headers)
 			response = self.conn.getresponse()
 			return response
 		except (NimException, ValueError) as e:
 			raise NimException(e.message)
 	
-	def who(self):
+	def who(self, prefix=None, after=None, limit=None):
 		"""
-		Send a WHO request and return the response.
+		Send a WHO request and return the response. If given, only players
+		whose names start with the prefix and come after the name given as
+		after are listed, at most limit of them; if there are more, the
+		response's Next header is the name to list them after.
 		"""
 		# Do not send request on closed connection
 		if not self.conn:
 			raise ValueError('operation on closed connection')
-		# Send request and return response
+		# Ask the server for part of the list if requested
+		headers = {}
+		if prefix:
+			headers['Prefix'] = prefix
+		if after:
+			headers['After'] = after
+		if limit:
+			headers['Limit'] = limit
+		# Send request and return response, using the cache if enabled
 		try:
-			self.conn.request('WHO')
+			if self.cache_ttl:
+				return self.cached_request(('WHO', prefix, after, limit), 'WHO',
+					headers)
+			self.conn.request('WHO', headers=headers)
 			response = self.conn.getresponse()
 			return response
 		except (NimException, ValueError) as e:
@@ -207,6 +448,8 @@ class NimClient(object):
 		# Check that name is valid
 		if not is_nim_username(name):
 			raise ValueError('{!r} is not a valid username'.format(name))
+		# The lists of players and games are about to change
+		self.invalidate()
 		# Send request and return response
 		try:
 			self.conn.request('PLAY', name)
@@ -215,6 +458,27 @@ class NimClient(object):
 		except (NimException, ValueError) as e:
 			raise NimException(e.message)
 	
+	def match(self, rating=None):
+		"""
+		Send a MATCH request, with the given rating if any, and return the
+		response. The response starts a game if another user was waiting for
+		an opponent; otherwise the game starts later, with a message.
+		"""
+		# Do not send request on closed connection
+		if not self.conn:
+			raise ValueError('operation on closed connection')
+		# Ask to be matched with opponents near a rating if requested
+		headers = {'Rating': rating} if rating is not None else None
+		# The lists of players and games are about to change
+		self.invalidate()
+		# Send request and return response
+		try:
+			self.conn.request('MATCH', headers=headers)
+			response = self.conn.getresponse()
+			return response
+		except (NimException, ValueError) as e:
+			raise NimException(e.message)
+	
 	def remove(self, n, s):
 		"""
 		Send a REMOVE request with the given parameters and return the response.
@@ -280,6 +544,8 @@ class NimClient(object):
 		# Do not send request on closed connection
 		if not self.conn:
 			raise ValueError('operation on closed connection')
+		# The lists of players and games are about to change
+		self.invalidate()
 		# Send request and return response
 		try:
 			self.conn.request('BYE')
@@ -291,16 +557,54 @@ class NimClient(object):
 		finally:
 			self.disconnect()
 	
-	def ping(self):
+	def ping(self, wait=None):
+		"""
+		Send a PING request and return the response. If wait is given, the
+		server may wait that many seconds for a message to be queued before
+		responding. Other requests can be sent while waiting.
+		"""
+		# Do not send request on closed connection
+		if not self.conn:
+			raise ValueError('operation on closed connection')
+		# Ask the server to wait for a message if requested
+		headers = {'Wait': wait} if wait else None
+		# Send request and return response
+		try:
+			self.conn.request('PING', headers=headers)
+			response = self.conn.getresponse()
+			return response
+		except (NimException, ValueError) as e:
+			raise NimException(e.message)
+	
+	def stats(self):
+		"""
+		Send a STATS request and return the response.
+		"""
+		# Do not send request on closed connection
+		if not self.conn:
+			raise ValueError('operation on closed connection')
+		# Send request and return response
+		try:
+			self.conn.request('STATS')
+			response = self.conn.getresponse()
+			return response
+		except (NimException, ValueError) as e:
+			raise NimException(e.message)
+	
+	def sync(self, id):
 		"""
-		Send a PING request and return the response.
+		Send a SYNC request with the given game ID and return the response,
+		which has a snapshot of the game's board.
 		"""
 		# Do not send request on closed connection
 		if not self.conn:
 			raise ValueError('operation on closed connection')
+		# Check that game ID is valid
+		if not is_natural(id):
+			raise ValueError('{!r} is not a valid game ID'.format(id))
 		# Send request and return response
 		try:
-			self.conn.request('PING')
+			self.conn.request('SYNC', str(id))
 			response = self.conn.getresponse()
 			return response
 		except (NimException, ValueError) as e:
@@ -313,9 +617,24 @@ class NimClient(object):
 		# Do not get response on closed connection
 		if not self.conn:
 			raise ValueError('operation on closed connection')
-		# Return response
+		# Return response, caching it if it answers a WHO or GAMES request
 		try:
 			response = self.conn.getresponse()
+			if self.pending and not (response and
+				response.status == CONTINUED):
+				return self.cache_response(response)
 			return response
 		except (NimException, ValueError) as e:
 			raise NimException(e.message)
+	
+	def board(self, id):
+		"""
+		Return the sizes of the sets of a game as last described by the server,
+		or None if it has not sent a snapshot of the game, or if the board
+		missed a delta and needs a new snapshot from sync().
+		"""
+		# Do not get board on closed connection
+		if not self.conn:
+			raise ValueError('operation on closed connection')
+		board = self.conn.boards.get(id)
+		return list(board[1]) if board else None
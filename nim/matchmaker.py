@@ -0,0 +1,145 @@
+# Remy Oukaour, 107122849
+# CSE 310, Group 2
+
+"""
+This module defines a matchmaking queue which pairs Nim users who are waiting
+for an opponent.
+"""
+
+__all__ = ['NimMatchmaker']
+
+import bisect
+
+class NimMatchmaker(object):
+	"""
+	Pairs users who are waiting for an opponent. Users are grouped into
+	bands of ratings band_width wide, and a user is paired as soon as another
+	user is waiting in the same band. A user who has waited longer also
+	accepts opponents one band further away every widen_interval seconds, up
+	to max_widening bands away, and two users in different bands are paired
+	once both of them accept each other; users waiting without a rating are
+	given the default rating. Without a band width, any two users are
+	paired.
+	
+	Two users waiting in the same band are always paired, so at most one
+	user waits in each band. The waiting users are kept in a dictionary by
+	band, with a sorted list of the bands, so adding or removing a user
+	costs O(log n), and finding an opponent only looks at the bands within
+	max_widening of the user's own. Callers should hold a lock around every
+	method.
+	"""
+	
+	# The rating of users who do not give one
+	default_rating = 1500
+	
+	def __init__(self, band_width=None, widen_interval=5.0, max_widening=5):
+		"""
+		Instantiate an empty matchmaking queue.
+		"""
+		self.band_width = band_width
+		self.widen_interval = widen_interval
+		self.max_widening = max_widening if band_width else 0
+		# Initially no users are waiting; each entry is a (user, band, time
+		# waiting since) tuple
+		self.entries = {}
+		self.bands = {}
+		self.band_keys = []
+	
+	def __contains__(self, user):
+		"""
+		Return True if a user is waiting for an opponent, False otherwise.
+		"""
+		return user in self.entries
+	
+	def __len__(self):
+		"""
+		Return the number of users waiting for an opponent.
+		"""
+		return len(self.entries)
+	
+	def band(self, rating):
+		"""
+		Return the band of a rating.
+		"""
+		if not self.band_width:
+			return 0
+		if rating is None:
+			rating = self.default_rating
+		return rating // self.band_width
+	
+	def widening(self, entry, now):
+		"""
+		Return how many bands away a waiting user accepts opponents from.
+		"""
+		if not self.widen_interval:
+			return self.max_widening
+		return min(int((now - entry[2]) / self.widen_interval),
+			self.max_widening)
+	
+	def add(self, user, rating, now):
+		"""
+		Pair a user with a rating with a waiting user in the same band,
+		remove that user from the queue, and return them; a user who has just
+		arrived only accepts opponents in their own band. If there is none,
+		add the user to the queue and return None.
+		"""
+		band = self.band(rating)
+		entry = self.nearest(band, 0, now)
+		if entry:
+			self.remove(entry[0])
+			return entry[0]
+		self.entries[user] = self.bands[band] = (user, band, now)
+		bisect.insort(self.band_keys, band)
+		return None
+	
+	def nearest(self, band, widening, now, exclude=None):
+		"""
+		Return the entry of the waiting user in the nearest band to a band,
+		if both that user and one accepting opponents within widening bands
+		accept each other, or None if there is none. Ties go to the user who
+		has waited longest.
+		"""
+		keys = self.band_keys
+		i = bisect.bisect_left(keys, band - self.max_widening)
+		best = None
+		while i < len(keys) and keys[i] <= band + self.max_widening:
+			entry = self.bands[keys[i]]
+			i += 1
+			if entry[0] is exclude:
+				continue
+			distance = abs(entry[1] - band)
+			if distance > min(widening, self.widening(entry, now)):
+				continue
+			if best is None or (distance, entry[2]) < (abs(best[1] - band),
+				best[2]):
+				best = entry
+		return best
+	
+	def remove(self, user):
+		"""
+		Remove a user from the queue, if they are waiting.
+		"""
+		entry = self.entries.pop(user, None)
+		if not entry:
+			return
+		del self.bands[entry[1]]
+		del self.band_keys[bisect.bisect_left(self.band_keys, entry[1])]
+	
+	def widened(self, now):
+		"""
+		Pair the waiting users who accept each other now that they have
+		waited longer, longest-waiting first, remove them from the queue, and
+		return a list of the (user, opponent) pairs.
+		"""
+		pairs = []
+		for entry in sorted(self.entries.values(), key=lambda e: e[2]):
+			# Skip users already paired in this sweep
+			if entry[0] not in self.entries:
+				continue
+			other = self.nearest(entry[1], self.widening(entry, now), now,
+				entry[0])
+			if other:
+				self.remove(entry[0])
+				self.remove(other[0])
+				pairs.append((entry[0], other[0]))
+		return pairs
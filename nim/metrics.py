@@ -0,0 +1,415 @@
+# Remy Oukaour, 107122849
+# CSE 310, Group 2
+
+"""
+This module defines classes for collecting metrics about a Nim server and
+reporting them, as a summary or in the Prometheus text format.
+"""
+
+__all__ = ['NimHistogram', 'NimMetrics', 'NimMetricsServer']
+
+import BaseHTTPServer
+import bisect
+import collections
+import threading
+import time
+from nimlib import *
+
+class NimHistogram(object):
+	"""
+	Represents a histogram of durations, counted in buckets like an
+	HdrHistogram: each power of two microseconds is divided into 16 buckets,
+	so any duration is counted within 1/16 of its value. Also counts the
+	durations of requests which failed.
+	"""
+	
+	__slots__ = ('counts', 'count', 'errors', 'sum', 'max')
+	
+	# The number of buckets for each power of two
+	sub_buckets = 16
+	
+	# The number of buckets, enough for durations up to about 70 minutes
+	size = sub_buckets * 28
+	
+	# The durations in seconds of the cumulative buckets reported in the
+	# Prometheus text format, from 1 microsecond to about 16 seconds
+	limits = [4 ** n / 1e6 for n in range(13)]
+	
+	def __init__(self):
+		"""
+		Instantiate an empty histogram.
+		"""
+		self.counts = [0] * self.size
+		self.count = 0
+		self.errors = 0
+		self.sum = 0.0
+		self.max = 0.0
+	
+	@classmethod
+	def bucket(cls, us):
+		"""
+		Return the index of the bucket for a whole number of microseconds.
+		"""
+		if us < cls.sub_buckets:
+			return max(us, 0)
+		shift = us.bit_length() - 5
+		return min(cls.sub_buckets * shift + (us >> shift), cls.size - 1)
+	
+	@classmethod
+	def bucket_max(cls, index):
+		"""
+		Return the most whole microseconds counted in a bucket.
+		"""
+		if index < cls.sub_buckets:
+			return index
+		shift, m = divmod(index, cls.sub_buckets)
+		return ((cls.sub_buckets + m + 1) << (shift - 1)) - 1
+	
+	def record(self, seconds):
+		"""
+		Count a duration.
+		"""
+		self.counts[self.bucket(int(seconds * 1e6))] += 1
+		self.count += 1
+		self.sum += seconds
+		if seconds > self.max:
+			self.max = seconds
+	
+	def record_sorted(self, durations):
+		"""
+		Count a sorted list of durations, finding where each bucket's run of
+		durations ends instead of the bucket of each one.
+		"""
+		if not durations:
+			return
+		self.count += len(durations)
+		self.sum += sum(durations)
+		self.max = max(self.max, durations[-1])
+		counts = self.counts
+		limits = self.bucket_limits
+		index = self.bucket(int(durations[0] * 1e6))
+		i = 0
+		while i < len(durations):
+			j = bisect.bisect_left(durations, limits[index], i)
+			counts[index] += j - i
+			i = j
+			index += 1
+	
+	def percentile(self, q):
+		"""
+		Return the duration in seconds which a fraction q of the counted
+		durations do not exceed.
+		"""
+		rank = q * self.count
+		seen = 0
+		for index, n in enumerate(self.counts):
+			seen += n
+			if n and seen >= rank:
+				return min(self.bucket_max(index) / 1e6, self.max)
+		return self.max
+	
+	def cumulative(self):
+		"""
+		Return a list of (limit, count) pairs, counting the durations which
+		do not exceed each limit in seconds.
+		"""
+		pairs = []
+		seen = index = 0
+		counts = self.counts
+		for limit in self.limits:
+			us = int(limit * 1e6)
+			while index < len(counts) and self.bucket_max(index) <= us:
+				seen += counts[index]
+				index += 1
+			pairs.append((limit, seen))
+		return pairs
+
+# The least duration in seconds which is not counted in each bucket, so that
+# the buckets of sorted durations can be found by bisecting them
+NimHistogram.bucket_limits = [(NimHistogram.bucket_max(index) + 1) / 1e6
+	for index in range(NimHistogram.size - 1)] + [float('inf')]
+
+class NimMetrics(object):
+	"""
+	Represents the metrics collected by a Nim server: the number of requests,
+	errors, and a histogram of the time taken to handle them for each method,
+	and histograms of the time spent waiting for and holding the server's
+	lock. Gauges of the users, games and queues are read from the server
+	when reported.
+	
+	Like NimAccessLog, request handlers record requests in queues without
+	locking them: the duration of each request is added to the queue of its
+	method, and the method of each failed request to the queue of errors. A
+	background thread counts the queued requests in batches, so that
+	recording a request costs little more than appending to a queue. The
+	same thread asks the server's lock to time some of its acquisitions
+	before each batch.
+	"""
+	
+	# The name used for methods which are not supported
+	other_method = 'OTHER'
+	
+	# The number of acquisitions of the server's lock of each kind to time
+	# for each batch
+	lock_samples = 64
+	
+	def __init__(self, count_interval=1.0):
+		"""
+		Instantiate metrics with nothing recorded, and start the thread which
+		counts recorded requests every count_interval seconds.
+		"""
+		self.count_interval = count_interval
+		# Initially no requests have been handled
+		self.requests = {}
+		self.durations = dict((method, collections.deque())
+			for method in list(methods) + [self.other_method])
+		self.errors = collections.deque()
+		# Recording a request appends its duration to the queue of its
+		# method, or of other_method if the method is not supported, and its
+		# method to the queue of errors if it failed, without the cost of
+		# calling a method to do so
+		self.record_duration = dict((method, durations.append)
+			for method, durations in self.durations.items())
+		self.record_other = self.record_duration[self.other_method]
+		self.record_error = self.errors.append
+		# Only one batch of requests can be counted at a time
+		self.counting = threading.Lock()
+		# Initially there is no server's lock to time, and it has not been
+		# acquired
+		self.lock = None
+		self.lock_waits = {'exclusive': NimHistogram(),
+			'shared': NimHistogram()}
+		self.lock_holds = {'exclusive': NimHistogram(),
+			'shared': NimHistogram()}
+		# Start the counting thread
+		self.running = True
+		self.counter = threading.Thread(target=self.count_forever)
+		self.counter.daemon = True
+		self.counter.start()
+	
+	def count_forever(self):
+		"""
+		Count the recorded requests every count_interval seconds, until the
+		metrics are closed.
+		"""
+		while self.running:
+			time.sleep(self.count_interval)
+			if self.lock:
+				self.lock.sample(self.lock_samples)
+			self.count_pending()
+	
+	def count_pending(self):
+		"""
+		Count the recorded requests in the histograms of their methods.
+		"""
+		with self.counting:
+			for method, durations in self.durations.items():
+				if not durations:
+					continue
+				popleft = durations.popleft
+				batch = [popleft() for _ in xrange(len(durations))]
+				batch.sort()
+				self.histogram(method).record_sorted(batch)
+			errors = self.errors
+			for _ in xrange(len(errors)):
+				method = errors.popleft()
+				if method not in self.durations:
+					method = self.other_method
+				self.histogram(method).errors += 1
+	
+	def histogram(self, method):
+		"""
+		Return the histogram of the requests for a method, creating it if
+		none have been counted yet.
+		"""
+		histogram = self.requests.get(method)
+		if histogram is None:
+			histogram = self.requests[method] = NimHistogram()
+		return histogram
+	
+	def close(self):
+		"""
+		Stop the counting thread. Requests recorded afterward are still
+		counted when the metrics are reported.
+		"""
+		self.running = False
+	
+	def record_lock(self, mode, waited, held):
+		"""
+		Record the seconds spent waiting to acquire the server's lock for
+		writing ('exclusive') or reading ('shared'), and then holding it.
+		"""
+		self.lock_waits[mode].record(waited)
+		self.lock_holds[mode].record(held)
+	
+	def gauges(self, server):
+		"""
+		Return a dictionary of the server's connected and logged-in users,
+		active games, observers of each game, and queue statistics.
+		"""
+		with server.lock.shared:
+			gauges = {'users': len(server.users),
+				'logged_in': len(server.usernames),
+				'games': len(server.games),
+				'observers': dict((game.id, len(game.observers))
+					for game in server.all_games())}
+			gauges['queues'] = server.queue_stats()
+		return gauges
+	
+	def summary(self, server):
+		"""
+		Return a plain text summary of the metrics, as sent in response to a
+		STATS request.
+		"""
+		lines = ['{:<10} {:>8} {:>7} {:>9} {:>9} {:>9}'.format('method',
+			'requests', 'errors', 'p50 ms', 'p99 ms', 'max ms')]
+		self.count_pending()
+		for method in sorted(self.requests):
+			histogram = self.requests[method]
+			lines.append('{:<10} {:>8} {:>7} {:>9.3f} {:>9.3f} {:>9.3f}'.format(
+				method, histogram.count, histogram.errors,
+				histogram.percentile(0.5) * 1e3,
+				histogram.percentile(0.99) * 1e3, histogram.max * 1e3))
+		for mode in ('exclusive', 'shared'):
+			waits, holds = self.lock_waits[mode], self.lock_holds[mode]
+			lines.append('lock {} {} timed acquisitions, waited p99 {:.3f} ms '
+				'max {:.3f} ms, held p99 {:.3f} ms max {:.3f} ms'.format(mode,
+				waits.count, waits.percentile(0.99) * 1e3, waits.max * 1e3,
+				holds.percentile(0.99) * 1e3, holds.max * 1e3))
+		gauges = self.gauges(server)
+		queues = gauges['queues']
+		observers = gauges['observers'].values()
+		lines.append('{} users, {} logged in, {} games, {} observers '
+			'(max {} per game)'.format(gauges['users'], gauges['logged_in'],
+			gauges['games'], sum(observers), max(observers or [0])))
+		lines.append('{} queued messages, {} bytes (max {} messages, {} bytes '
+			'per user), {} dropped'.format(queues['messages'],
+			queues['bytes'], queues['max_messages'], queues['max_bytes'],
+			queues['dropped']))
+		return "\n".join(lines)
+	
+	def prometheus(self, server):
+		"""
+		Return the metrics in the Prometheus text exposition format.
+		"""
+		lines = []
+		def metric(name, kind, description):
+			lines.append('# HELP {} {}'.format(name, description))
+			lines.append('# TYPE {} {}'.format(name, kind))
+		def histogram(name, labels, histogram):
+			for limit, count in histogram.cumulative():
+				lines.append('{}_bucket{{{},le="{:g}"}} {}'.format(name,
+					labels, limit, count))
+			lines.append('{}_bucket{{{},le="+Inf"}} {}'.format(name, labels,
+				histogram.count))
+			lines.append('{}_sum{{{}}} {!r}'.format(name, labels,
+				histogram.sum))
+			lines.append('{}_count{{{}}} {}'.format(name, labels,
+				histogram.count))
+		self.count_pending()
+		names = sorted(self.requests)
+		metric('nim_requests_total', 'counter',
+			'Requests handled, by method.')
+		for method in names:
+			lines.append('nim_requests_total{{method="{}"}} {}'.format(
+				method, self.requests[method].count))
+		metric('nim_request_errors_total', 'counter',
+			'Requests answered with an error, by method.')
+		for method in names:
+			lines.append('nim_request_errors_total{{method="{}"}} {}'
+				.format(method, self.requests[method].errors))
+		metric('nim_request_duration_seconds', 'histogram',
+			'Seconds taken to handle requests, by method.')
+		for method in names:
+			histogram('nim_request_duration_seconds',
+				'method="{}"'.format(method), self.requests[method])
+		metric('nim_lock_wait_seconds', 'histogram',
+			"Seconds spent waiting to acquire the server's lock, for a "
+			'sample of acquisitions.')
+		for mode in ('exclusive', 'shared'):
+			histogram('nim_lock_wait_seconds', 'mode="{}"'.format(mode),
+				self.lock_waits[mode])
+		metric('nim_lock_hold_seconds', 'histogram',
+			"Seconds for which the server's lock was held, for a sample of "
+			'acquisitions.')
+		for mode in ('exclusive', 'shared'):
+			histogram('nim_lock_hold_seconds', 'mode="{}"'.format(mode),
+				self.lock_holds[mode])
+		gauges = self.gauges(server)
+		queues = gauges['queues']
+		for name, value, description in (
+			('nim_users', gauges['users'], 'Connected users.'),
+			('nim_logged_in_users', gauges['logged_in'], 'Logged-in users.'),
+			('nim_games', gauges['games'], 'Active games.'),
+			('nim_queued_messages', queues['messages'],
+				"Messages in users' queues."),
+			('nim_queued_bytes', queues['bytes'], "Bytes in users' queues."),
+			('nim_max_queued_messages', queues['max_messages'],
+				"Messages in the longest user's queue."),
+			('nim_max_queued_bytes', queues['max_bytes'],
+				"Bytes in the largest user's queue."),
+			('nim_queueing_users', queues['users'],
+				'Users with queued messages.')):
+			metric(name, 'gauge', description)
+			lines.append('{} {}'.format(name, value))
+		metric('nim_dropped_messages_total', 'counter',
+			'Messages dropped from full queues.')
+		lines.append('nim_dropped_messages_total {}'.format(queues['dropped']))
+		metric('nim_game_observers', 'gauge', 'Observers of each game.')
+		for id, observers in sorted(gauges['observers'].items()):
+			lines.append('nim_game_observers{{game="{}"}} {}'.format(id,
+				observers))
+		return "\n".join(lines) + "\n"
+
+class NimMetricsServer(BaseHTTPServer.HTTPServer):
+	"""
+	Serves the metrics of a Nim server in the Prometheus text format over
+	HTTP, from a separate thread, only to clients on the same machine.
+	"""
+	
+	def __init__(self, port, nim_server):
+		"""
+		Instantiate a metrics server listening on a localhost port.
+		"""
+		BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', port),
+			NimMetricsRequestHandler)
+		self.nim_server = nim_server
+	
+	def verify_request(self, request, client_address):
+		"""
+		Return True if a client is on the same machine, False otherwise.
+		"""
+		return client_address[0].startswith('127.')
+	
+	def start(self):
+		"""
+		Serve the metrics from a new thread.
+		"""
+		thread = threading.Thread(target=self.serve_forever)
+		thread.daemon = True
+		thread.start()
+
+class NimMetricsRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+	"""
+	Responds to requests for a Nim server's metrics.
+	"""
+	
+	def do_GET(self):
+		"""
+		Respond with the metrics in the Prometheus text format.
+		"""
+		if self.path.split('?')[0] not in ('/', '/metrics'):
+			self.send_error(404)
+			return
+		server = self.server.nim_server
+		body = server.metrics.prometheus(server)
+		self.send_response(200)
+		self.send_header('Content-Type', 'text/plain; version=0.0.4')
+		self.send_header('Content-Length', str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+	
+	def log_message(self, format, *args):
+		"""
+		Do not log requests for metrics.
+		"""
@@ -9,12 +9,14 @@ Client- and server-specific functions are located in their own modules.
 
 __all__ = ['NIM_VERSION', 'NIM_PORT', 'NIM_MIN_SETS', 'NIM_MAX_SETS',
 	'NIM_MIN_OBJECTS', 'NIM_MAX_OBJECTS', 'methods', 'OK', 'HELLO', 'BYE',
-	'BEGIN_GAME', 'END_GAME', 'CONTINUED', 'ERROR', 'IMPOSSIBLE',
-	'ILLEGAL_MOVE', 'FORBIDDEN', 'NOT_FOUND', 'METHOD_NOT_ALLOWED',
-	'INTERNAL_ERROR', 'NOT_IMPLEMENTED', 'NIM_VERSION_NOT_SUPPORTED',
-	'responses', 'NimException', 'NimPacket', 'NimRequest', 'NimResponse']
+	'BEGIN_GAME', 'END_GAME', 'CONTINUED', 'NOT_MODIFIED', 'ERROR',
+	'IMPOSSIBLE', 'ILLEGAL_MOVE', 'FORBIDDEN', 'NOT_FOUND',
+	'METHOD_NOT_ALLOWED', 'INTERNAL_ERROR', 'NOT_IMPLEMENTED',
+	'NIM_VERSION_NOT_SUPPORTED', 'responses', 'NimException', 'NimPacket',
+	'NimRequest', 'NimResponse', 'NimPacketReader']
 
 import re
+import string
 from distutils.version import LooseVersion
 
 # The version of the Nim protocol supported by this library
@@ -39,7 +41,10 @@ methods = {
 	'PLAY': (str,),
 	'OBSERVE': (int,),
 	'UNOBSERVE': (int,),
-	'PING': ()
+	'PING': (),
+	'SYNC': (int,),
+	'STATS': (),
+	'MATCH': ()
 }
 
 # The response status codes supported by Nim
@@ -49,6 +54,7 @@ BYE = 202
 BEGIN_GAME = 203
 END_GAME = 204
 CONTINUED = 300
+NOT_MODIFIED = 304
 ERROR = 400
 IMPOSSIBLE = 401
 ILLEGAL_MOVE = 402
@@ -69,6 +75,7 @@ responses = {
 	BEGIN_GAME: 'Begin Game',
 	END_GAME: 'End Game',
 	CONTINUED: 'Continued',
+	NOT_MODIFIED: 'Not Modified',
 	ERROR: 'Error',
 	IMPOSSIBLE: 'Impossible',
 	ILLEGAL_MOVE: 'Illegal Move',
@@ -91,8 +98,13 @@ class NimPacket(object):
 	"""
 	The base class of the Nim request and response packet classes. Contains
 	shared aspects of the two packet types, namely header and body data.
+	Packets keep the offsets of their headers and body within the raw data,
+	and only parse them when they are first accessed.
 	"""
 	
+	__slots__ = ('data', 'version', 'header_start', 'header_end', 'body_start',
+		'parsed_headers', 'parsed_body')
+	
 	# The format of all Nim request or response packets
 	packet_regex_template = r'''
 		^[ \t]*                   # ignore leading whitespace
@@ -120,6 +132,19 @@ class NimPacket(object):
 		\r\n                    # terminating CRLF
 		''', re.DOTALL | re.VERBOSE)
 	
+	# The characters allowed in header names and method parameters
+	token_chars = string.ascii_letters + string.digits + '_-+.'
+	
+	# The characters allowed in protocol versions
+	version_chars = string.digits + '.'
+	
+	# Parsed protocol versions, shared by all packets with the same version
+	versions = {str(NIM_VERSION): NIM_VERSION}
+	
+	# The most parsed versions which are cached, since clients can send any
+	# number of different ones
+	max_cached_versions = 16
+	
 	@staticmethod
 	def packet_regex(initial):
 		"""
@@ -135,13 +160,86 @@ class NimPacket(object):
 		"""
 		raise NotImplementedError('cannot instantiate abstract NimPacket')
 	
-	def initialize(self, data, parts):
+	@staticmethod
+	def parse_headers(data, start, end):
+		"""
+		Return a dictionary of the CRLF-terminated header lines between two
+		offsets of raw packet data. Equivalent to matching header_regex, which
+		is only used for lines that are not single headers.
+		"""
+		headers = {}
+		for line in data[start:end-2].split("\r\n") if end > start else ():
+			name, colon, value = line.partition(':')
+			if not colon or not name or name.translate(None,
+				NimPacket.token_chars):
+				return dict(re.findall(NimPacket.header_regex, data[start:end]))
+			headers[name] = value.strip(' \t')
+		return headers
+	
+	@staticmethod
+	def parse_version(version):
+		"""
+		Return a version string parsed as a LooseVersion. Versions are cached
+		until the cache is full, after which new ones are parsed every time.
+		"""
+		versions = NimPacket.versions
+		parsed = versions.get(version)
+		if parsed is None:
+			parsed = LooseVersion(version)
+			if len(versions) < NimPacket.max_cached_versions:
+				versions[version] = parsed
+		return parsed
+	
+	def split(self, data):
+		"""
+		Store the raw packet data and the offsets of its headers and body.
+		Return the initial line, or None if the packet has no header
+		terminator or any of its header lines are not single headers.
+		"""
+		i = data.find("\r\n")
+		j = data.find("\r\n\r\n", i)
+		if i < 0 or j < 0:
+			return None
+		# Check each header line for a valid header name
+		start, end = i + 2, j + 2
+		while start < end:
+			line_end = data.find("\r\n", start, end)
+			colon = data.find(':', start, line_end)
+			if colon <= start or data[start:colon].translate(None,
+				self.token_chars):
+				return None
+			start = line_end + 2
+		self.store(data, i + 2, j + 2, j + 4)
+		return data[:i]
+	
+	def store(self, data, header_start, header_end, body_start):
 		"""
-		Store the raw packet data, parsed headers, and body data as fields.
+		Store the raw packet data and the offsets of its headers and body.
 		"""
 		self.data = data
-		self.headers = dict(re.findall(self.header_regex, parts['headers']))
-		self.body = parts['body']
+		self.header_start = header_start
+		self.header_end = header_end
+		self.body_start = body_start
+		self.parsed_headers = self.parsed_body = None
+	
+	@property
+	def headers(self):
+		"""
+		A dictionary of the packet's headers, parsed when first accessed.
+		"""
+		if self.parsed_headers is None:
+			self.parsed_headers = self.parse_headers(self.data,
+				self.header_start, self.header_end)
+		return self.parsed_headers
+	
+	@property
+	def body(self):
+		"""
+		The packet's body data, copied from the raw data when first accessed.
+		"""
+		if self.parsed_body is None:
+			self.parsed_body = self.data[self.body_start:]
+		return self.parsed_body
 	
 	def getheader(self, name, default=None):
 		"""
@@ -160,6 +258,8 @@ class NimRequest(NimPacket):
 	The class of a Nim request packet (sent by clients).
 	"""
 	
+	__slots__ = ('method', 'params', 'args')
+	
 	# Regular expression matching parts of a Nim request packet
 	request_regex = NimPacket.packet_regex(r'''
 		(?P<method>[A-Z]+)           # method name
@@ -171,30 +271,75 @@ class NimRequest(NimPacket):
 		NIM/(?P<version>[0-9\.]+)    # protocol version
 		''')
 	
+	# The characters allowed in a request line
+	request_chars = NimPacket.token_chars + ' \t/'
+	
 	def __init__(self, data):
 		"""
-		Store the parsed parts of raw packet data as fields.
+		Store the parsed parts of raw packet data as fields. The parameters
+		are stored in params as strings; request handlers store them in args
+		converted to the types in their method's signature, which is None
+		until then (or if they cannot be converted).
+		"""
+		# Parse raw packet data, matching it against the request regex only
+		# if necessary
+		if not self.scan(data):
+			self.match(data)
+		# Initially the parameters have not been converted
+		self.args = None
+	
+	def scan(self, data):
+		"""
+		Store the parts of raw request data as fields, parsed without the
+		request regex. Return True if the data could be parsed this way (with
+		the same result as the regex), False otherwise.
+		"""
+		request = self.split(data)
+		# Check that the request line has no unexpected characters, and that
+		# its only slash belongs to the protocol version
+		if (not request or request[-1] in ' \t' or request.count('/') != 1
+			or request.translate(None, self.request_chars)):
+			return False
+		tokens = request.split()
+		method, version = tokens[0], tokens[-1]
+		# Check the method name and protocol version
+		if (len(tokens) < 2 or method.translate(None, string.ascii_uppercase)
+			or version[:4] != 'NIM/' or not version[4:]
+			or version[4:].translate(None, self.version_chars)):
+			return False
+		self.version = self.parse_version(version[4:])
+		self.method = method
+		self.params = tuple(tokens[1:-1])
+		return True
+	
+	def match(self, data):
+		"""
+		Store the parts of raw request data as fields, parsed by matching the
+		request regex. Raise a NimException if it does not match.
 		"""
-		# Match raw packet data against request regex
 		match = re.match(self.request_regex, data)
 		if not match:
 			raise NimException('malformed request: {!r}'.format(data))
-		parts = match.groupdict()
-		# Store the headers and body
-		self.initialize(data, parts)
-		# Store the other parts of the request
-		self.request = data.split("\r\n")[0]
-		self.version = LooseVersion(parts['version'])
-		self.method = parts['method']
-		params = parts['params'].split()
-		types = methods.get(self.method, [str] * len(params))
-		self.params = tuple(t(p) for (t, p) in zip(types, params))
+		self.store(data, match.start('headers'), match.end('headers'),
+			match.start('body'))
+		self.version = self.parse_version(match.group('version'))
+		self.method = match.group('method')
+		self.params = tuple(match.group('params').split())
+	
+	@property
+	def request(self):
+		"""
+		The request line of the packet.
+		"""
+		return self.data[:self.header_start-2]
 
 class NimResponse(NimPacket):
 	"""
 	The class of a Nim response packet (sent by servers).
 	"""
 	
+	__slots__ = ('status', 'reason')
+	
 	# Regular expression matching parts of a Nim response packet
 	response_regex = NimPacket.packet_regex(r'''
 		NIM/(?P<version>[0-9\.]+)            # protocol version
@@ -204,19 +349,231 @@ class NimResponse(NimPacket):
 		(?P<reason>[A-Za-z0-9_\-+\. \t]+)    # reason phrase
 		''')
 	
+	# The characters allowed in a status line
+	response_chars = NimPacket.token_chars + ' \t/'
+	
+	# The status line for each status code supported by this library
+	status_lines = dict((status, 'NIM/{} {} {}\r\n'.format(NIM_VERSION,
+		status, reason)) for (status, reason) in responses.items())
+	
 	def __init__(self, data):
 		"""
 		Store the parsed parts of raw packet data as fields.
 		"""
-		# Match raw packet data against response regex
+		# Parse raw packet data, matching it against the response regex only
+		# if necessary
+		if not self.scan(data):
+			self.match(data)
+	
+	@classmethod
+	def compose(cls, status, body='', headers=None):
+		"""
+		Return a response with the given status code, body, and headers, built
+		from its parts instead of parsed. Its raw data is ready to be sent.
+		The Content-Length header is automatically set to the correct value.
+		"""
+		# Check that status code is valid
+		if status not in responses:
+			raise ValueError('no such status: {}'.format(status))
+		status_line = cls.status_lines[status]
+		# Convert header dictionary to CRLF-separated string
+		headers = ''.join("{}: {}\r\n".format(h, headers[h])
+			for h in headers) if headers else ''
+		headers += 'Content-Length: {}\r\n'.format(len(body))
+		data = ''.join((status_line, headers, "\r\n", body))
+		# Store the parts of the response without parsing the raw data
+		response = cls.__new__(cls)
+		header_start = len(status_line)
+		header_end = header_start + len(headers)
+		response.store(data, header_start, header_end, header_end + 2)
+		response.parsed_body = body
+		response.version = NIM_VERSION
+		response.status = status
+		response.reason = responses[status]
+		return response
+	
+	def scan(self, data):
+		"""
+		Store the parts of raw response data as fields, parsed without the
+		response regex. Return True if the data could be parsed this way (with
+		the same result as the regex), False otherwise.
+		"""
+		response = self.split(data)
+		# Check that the status line has no unexpected characters, and that
+		# its only slash belongs to the protocol version
+		if (response is None or response.count('/') != 1 or
+			response.translate(None, self.response_chars)):
+			return False
+		tokens = response.split(None, 2)
+		if len(tokens) < 3:
+			return False
+		version, status, reason = tokens
+		# Check the protocol version and status code
+		if (version[:4] != 'NIM/' or not version[4:]
+			or version[4:].translate(None, self.version_chars)
+			or status.translate(None, string.digits)):
+			return False
+		self.version = self.parse_version(version[4:])
+		self.status = int(status)
+		self.reason = reason
+		return True
+	
+	def match(self, data):
+		"""
+		Store the parts of raw response data as fields, parsed by matching the
+		response regex. Raise a NimException if it does not match.
+		"""
 		match = re.match(self.response_regex, data)
 		if not match:
 			raise NimException('malformed response: {!r}'.format(data))
-		parts = match.groupdict()
-		# Store the headers and body
-		self.initialize(data, parts)
-		# Store the other parts of the response
-		self.response = data.split("\r\n")[0]
-		self.version = LooseVersion(parts['version'])
-		self.status = int(parts['status'])
-		self.reason = parts['reason']
+		self.store(data, match.start('headers'), match.end('headers'),
+			match.start('body'))
+		self.version = self.parse_version(match.group('version'))
+		self.status = int(match.group('status'))
+		self.reason = match.group('reason')
+	
+	@property
+	def response(self):
+		"""
+		The status line of the packet.
+		"""
+		return self.data[:self.header_start-2]
+
+class NimPacketReader(object):
+	"""
+	Frames a stream of Nim packets received on a socket. Data is received into
+	a reusable buffer, and complete packets are extracted using the header
+	terminator and the Content-Length header, so packets that are split or
+	coalesced by TCP are still parsed one at a time.
+	"""
+	
+	# The initial size of the receive buffer
+	buffer_size = 4096
+	
+	# The largest initial line and headers accepted for a single packet
+	max_header_size = 65536
+	
+	def __init__(self, socket, packet_class):
+		"""
+		Instantiate a reader of packet_class objects (NimRequest or
+		NimResponse) from a socket.
+		"""
+		self.socket = socket
+		self.packet_class = packet_class
+		# Initially the receive buffer is empty
+		self.buffer = bytearray(self.buffer_size)
+		self.view = memoryview(self.buffer)
+		# The buffer offsets of the first unread byte and the last received byte
+		self.start = self.end = 0
+	
+	def __iter__(self):
+		"""
+		Return a generator for the packets received until the connection closes.
+		"""
+		while True:
+			packet = self.read()
+			if packet is None:
+				return
+			yield packet
+	
+	def fill(self):
+		"""
+		Receive more data from the socket into the buffer. Return the number
+		of bytes received, which is 0 if the connection was closed.
+		"""
+		if self.end == len(self.buffer):
+			self.reserve(len(self.buffer) // 4)
+		n = self.socket.recv_into(self.view[self.end:])
+		self.end += n
+		return n
+	
+	def reserve(self, n):
+		"""
+		Make room in the buffer to receive at least n more bytes.
+		"""
+		size = self.end - self.start
+		# Grow the buffer if the unread data and n bytes cannot fit
+		if size + n > len(self.buffer):
+			capacity = len(self.buffer)
+			while size + n > capacity:
+				capacity *= 2
+			buffer = bytearray(capacity)
+			buffer[:size] = self.view[self.start:self.end]
+			self.buffer = buffer
+			self.view = memoryview(buffer)
+		# Otherwise move the unread data to the front of the buffer
+		elif self.start:
+			self.buffer[:size] = self.buffer[self.start:self.end]
+		self.start, self.end = 0, size
+	
+	def content_length(self, header_end):
+		"""
+		Return the value of the Content-Length header of the packet whose
+		headers end at an offset in the buffer, or 0 if it has none. Raise a
+		NimException if it has more than one, since they could be framed
+		with one length and parsed with another.
+		"""
+		i = self.buffer.find(b'\r\nContent-Length:', self.start, header_end)
+		if i < 0:
+			return 0
+		i += len(b'\r\nContent-Length:')
+		j = self.buffer.find(b'\r\n', i, header_end)
+		if self.buffer.find(b'\r\nContent-Length:', j, header_end) >= 0:
+			raise NimException('duplicate Content-Length headers')
+		try:
+			length = int(self.view[i:j].tobytes())
+		except ValueError:
+			length = -1
+		if length < 0:
+			raise NimException('malformed Content-Length: {!r}'.format(
+				self.view[i:j].tobytes()))
+		return length
+	
+	def next_packet(self):
+		"""
+		Remove and return the raw data of the next complete packet in the
+		buffer, or None if no complete packet has been received yet.
+		"""
+		# Find the end of the headers
+		i = self.buffer.find(b'\r\n\r\n', self.start, self.end)
+		if i < 0:
+			if self.end - self.start > self.max_header_size:
+				raise NimException('packet headers are too large')
+			return None
+		header_end = i + 4
+		# Find the end of the body
+		packet_end = header_end + self.content_length(header_end)
+		if packet_end > self.end:
+			# Make sure the rest of the body will fit in the buffer
+			if packet_end - self.start > len(self.buffer):
+				self.reserve(packet_end - self.end)
+			return None
+		data = self.view[self.start:packet_end].tobytes()
+		# Reset the buffer offsets when all the received data has been read
+		if packet_end == self.end:
+			self.start = self.end = 0
+		else:
+			self.start = packet_end
+		return data
+	
+	def read(self):
+		"""
+		Return the next packet received, parsed as a packet_class object.
+		Return None if the connection is closed before a complete packet is
+		received. Raise a NimException if the packet is malformed.
+		"""
+		while True:
+			packet = self.read_buffered()
+			if packet is not None:
+				return packet
+			if not self.fill():
+				return None
+	
+	def read_buffered(self):
+		"""
+		Return the next packet that has already been received, parsed as a
+		packet_class object, or None if no complete packet is in the buffer.
+		Raise a NimException if the packet is malformed.
+		"""
+		data = self.next_packet()
+		return None if data is None else self.packet_class(data)
@@ -0,0 +1,216 @@
+# Remy Oukaour, 107122849
+# CSE 310, Group 2
+
+"""
+This module defines a profiler which a running Nim server can turn on and off
+around the handling of its requests.
+"""
+
+__all__ = ['NimProfiler']
+
+import cProfile
+import collections
+import os
+import pstats
+import sys
+import thread
+import threading
+import time
+
+class NimProfiler(object):
+	"""
+	Profiles the requests handled by a Nim server for a number of seconds or
+	requests, then writes the results to a file. Only the handling of
+	requests is profiled, not the server's event loop or idle threads.
+	
+	In CPROFILE mode, each thread handling requests enables its own
+	cProfile.Profile object around each request, and their statistics are
+	merged and written in the pstats format. In SAMPLE mode, a background
+	thread samples the stacks of the threads handling requests every
+	interval seconds, and the counts of each stack are written in the
+	collapsed format read by flame graph tools. Sampling costs much less than
+	cProfile, which traces every function call, but only estimates where the
+	time is spent.
+	"""
+	
+	# The profiling modes
+	CPROFILE, SAMPLE = 'cprofile', 'sample'
+	
+	def __init__(self, path, mode=CPROFILE, seconds=None, requests=None,
+		interval=0.005, callback=None):
+		"""
+		Instantiate a profiler which writes its results to a file at path,
+		after profiling for the given number of seconds or requests,
+		whichever comes first, or until stop() is called if neither is given.
+		The callback is called with the profiler once it stops.
+		"""
+		if mode not in (self.CPROFILE, self.SAMPLE):
+			raise ValueError('unknown profiling mode: {}'.format(mode))
+		self.path = path
+		self.mode = mode
+		self.seconds = seconds
+		self.requests = requests
+		self.interval = interval
+		self.callback = callback
+		# Initially no requests have been profiled
+		self.profiled = 0
+		# The cProfile.Profile object of each thread
+		self.profiles = {}
+		# The frame which started handling the current request of each thread,
+		# and the number of times each stack was sampled
+		self.active = {}
+		self.stacks = collections.Counter()
+		# Only stop once, and write the results once no requests are being
+		# profiled
+		self.lock = threading.Lock()
+		self.stopped = False
+		self.calls = 0
+		self.started = None
+		self.timer = None
+		self.sampler = None
+	
+	def start(self):
+		"""
+		Start profiling requests, and stop after the given number of seconds.
+		"""
+		self.started = time.time()
+		if self.seconds is not None:
+			self.timer = threading.Timer(self.seconds, self.stop)
+			self.timer.daemon = True
+			self.timer.start()
+		if self.mode == self.SAMPLE:
+			self.sampler = threading.Thread(target=self.sample_forever)
+			self.sampler.daemon = True
+			self.sampler.start()
+	
+	def call(self, function):
+		"""
+		Call a function which handles a request, profiling it, and stop after
+		the given number of requests.
+		"""
+		if self.stopped:
+			return function()
+		with self.lock:
+			profiling = not self.stopped
+			if profiling:
+				self.calls += 1
+		if not profiling:
+			return function()
+		ident = thread.get_ident()
+		try:
+			if self.mode == self.CPROFILE:
+				profile = self.profiles.get(ident)
+				if profile is None:
+					profile = self.profiles[ident] = cProfile.Profile()
+				profile.enable()
+				try:
+					return function()
+				finally:
+					profile.disable()
+			# Mark where the sampled stacks of this thread start
+			self.active[ident] = sys._getframe()
+			try:
+				return function()
+			finally:
+				del self.active[ident]
+		finally:
+			self.profiled += 1
+			if self.requests is not None and self.profiled >= self.requests:
+				self.stop()
+			# The last request being profiled when the profiler stopped
+			# writes the results
+			with self.lock:
+				self.calls -= 1
+				finished = self.stopped and not self.calls
+			if finished:
+				self.finish()
+	
+	def sample_forever(self):
+		"""
+		Sample the stacks of the threads handling requests every interval
+		seconds, until the profiler stops.
+		"""
+		while not self.stopped:
+			time.sleep(self.interval)
+			self.sample()
+	
+	def sample(self):
+		"""
+		Count the current stack of each thread handling a request.
+		"""
+		frames = sys._current_frames()
+		for ident, start in self.active.items():
+			frame = frames.get(ident)
+			stack = []
+			while frame is not None and frame is not start:
+				code = frame.f_code
+				stack.append('{} ({}:{})'.format(code.co_name,
+					os.path.basename(code.co_filename), code.co_firstlineno))
+				frame = frame.f_back
+			# Ignore threads which finished their request before the sample
+			if frame is start and stack:
+				stack.reverse()
+				self.stacks[';'.join(stack)] += 1
+	
+	def stop(self):
+		"""
+		Stop profiling new requests, then write the results and call the
+		callback once the requests being profiled have been handled, so that
+		no thread is still adding to the results while they are merged. If
+		requests are being profiled, the thread handling the last of them
+		does so instead of this one, which does not wait.
+		"""
+		with self.lock:
+			if self.stopped:
+				return
+			self.stopped = True
+			finished = not self.calls
+		if self.timer:
+			self.timer.cancel()
+		if finished:
+			self.finish()
+	
+	def finish(self):
+		"""
+		Write the results and call the callback.
+		"""
+		if self.mode == self.CPROFILE:
+			self.write_stats()
+		else:
+			self.write_stacks()
+		if self.callback:
+			self.callback(self)
+	
+	def write_stats(self):
+		"""
+		Write the merged statistics of every thread's profile in the pstats
+		format. Every thread must have disabled its profile.
+		"""
+		profiles = list(self.profiles.values())
+		if not profiles:
+			cProfile.Profile().dump_stats(self.path)
+			return
+		stats = pstats.Stats(profiles[0])
+		for profile in profiles[1:]:
+			stats.add(profile)
+		stats.dump_stats(self.path)
+	
+	def write_stacks(self):
+		"""
+		Write the count of each sampled stack in the collapsed format.
+		"""
+		with open(self.path, 'w') as file:
+			for stack, count in sorted(self.stacks.items()):
+				file.write('{} {}\n'.format(stack, count))
+	
+	def summary(self):
+		"""
+		Return a line describing what was profiled and where it was written.
+		"""
+		elapsed = time.time() - self.started if self.started else 0
+		if self.mode == self.CPROFILE:
+			return 'Profiled {} requests in {:.1f} seconds to {}'.format(
+				self.profiled, elapsed, self.path)
+		return ('Sampled {} stacks of {} requests in {:.1f} seconds to '
+			'{}'.format(sum(self.stacks.values()), self.profiled, elapsed,
+			self.path))
@@ -5,20 +5,285 @@
 This module defines classes for implementing Nim servers.
 """
 
-__all__ = ['NimUser', 'NimGame', 'NimServer', 'ForkingNimServer',
-	'ThreadingNimServer', 'BaseNimRequestHandler']
+__all__ = ['ReadWriteLock', 'MeasuredReadWriteLock', 'NimMessage', 'NimUser',
+	'NimGame', 'NimServer', 'ForkingNimServer', 'ThreadingNimServer',
+	'AsyncNimServer', 'EpollNimServer', 'FrontEndNimServer',
+	'BaseNimRequestHandler']
 
+import asyncore
+import bisect
+import collections
+import errno
+import heapq
+import itertools
+import multiprocessing
+import select
+import signal
 import socket
 import SocketServer
 import random
+import struct
+import sys
+import thread
 import threading
+import time
 from nimlib import *
+from metrics import *
+from profiler import *
+from matchmaker import *
+
+class ReadWriteLock(object):
+	"""
+	A lock which can be held by one writer, or shared by any number of
+	readers. Waiting writers take priority over new readers. Acquiring it
+	directly (or with the with statement) acquires it for writing; its
+	shared attribute acquires it for reading.
+	"""
+	
+	def __init__(self):
+		"""
+		Instantiate an unlocked lock.
+		"""
+		self.condition = threading.Condition(threading.Lock())
+		# Initially no threads hold or are waiting for the lock
+		self.readers = 0
+		self.writing = False
+		self.writers_waiting = 0
+		# Acquire and release the lock for reading
+		self.shared = SharedLock(self)
+	
+	def __enter__(self):
+		self.acquire()
+		return self
+	
+	def __exit__(self, *exc_info):
+		self.release()
+	
+	def acquire(self):
+		"""
+		Wait until no other threads hold the lock, then acquire it for
+		writing.
+		"""
+		with self.condition:
+			self.writers_waiting += 1
+			while self.writing or self.readers:
+				self.condition.wait()
+			self.writers_waiting -= 1
+			self.writing = True
+	
+	def release(self):
+		"""
+		Release the lock after writing.
+		"""
+		with self.condition:
+			self.writing = False
+			self.condition.notify_all()
+	
+	def acquire_shared(self):
+		"""
+		Wait until no threads hold or are waiting to hold the lock for
+		writing, then acquire it for reading.
+		"""
+		with self.condition:
+			while self.writing or self.writers_waiting:
+				self.condition.wait()
+			self.readers += 1
+	
+	def release_shared(self):
+		"""
+		Release the lock after reading.
+		"""
+		with self.condition:
+			self.readers -= 1
+			if not self.readers:
+				self.condition.notify_all()
+
+class SharedLock(object):
+	"""
+	Acquires and releases a ReadWriteLock for reading.
+	"""
+	
+	def __init__(self, lock):
+		self.lock = lock
+	
+	def __enter__(self):
+		self.lock.acquire_shared()
+		return self
+	
+	def __exit__(self, *exc_info):
+		self.lock.release_shared()
+	
+	def acquire(self):
+		self.lock.acquire_shared()
+	
+	def release(self):
+		self.lock.release_shared()
+
+class MeasuredSharedLock(SharedLock):
+	"""
+	Extends SharedLock to time the acquisitions of a MeasuredReadWriteLock
+	for reading, until it has timed as many as it was asked to.
+	"""
+	
+	def __init__(self, lock):
+		SharedLock.__init__(self, lock)
+		# Initially no acquisitions are due to be timed (a decrement lost
+		# between threads only times one more)
+		self.samples = 0
+		# The times a timed acquisition by each thread started waiting and
+		# acquired the lock
+		self.acquired = {}
+	
+	def __enter__(self):
+		lock = self.lock
+		self.samples -= 1
+		# Stop timing acquisitions once enough have been
+		if self.samples <= 0:
+			lock.shared = lock.untimed_shared
+		start = time.time()
+		lock.acquire_shared()
+		self.acquired[thread.get_ident()] = (start, time.time())
+		return self
+	
+	def __exit__(self, *exc_info):
+		timed = self.acquired.pop(thread.get_ident(), None)
+		released = time.time()
+		self.lock.release_shared()
+		if timed:
+			start, acquired = timed
+			self.lock.metrics.record_lock('shared', acquired - start,
+				released - acquired)
+
+class MeasuredReadWriteLock(ReadWriteLock):
+	"""
+	Extends ReadWriteLock to record the time spent waiting for and holding
+	it in a NimMetrics object. Timing every acquisition would cost more than
+	the uncontended lock itself, so the metrics ask it to time a number of
+	acquisitions of each kind whenever they count the recorded requests. The
+	lock's shared attribute is a plain SharedLock until then, so acquiring it
+	for reading costs the same as acquiring a ReadWriteLock.
+	"""
+	
+	def __init__(self, metrics):
+		"""
+		Instantiate an unlocked lock which records its timings in metrics.
+		"""
+		ReadWriteLock.__init__(self)
+		self.metrics = metrics
+		metrics.lock = self
+		# Initially no acquisitions for writing are due to be timed
+		self.samples = 0
+		# The times a timed acquisition started waiting and acquired the lock
+		self.acquired = None
+		# Acquire and release the lock for reading without timing it, unless
+		# acquisitions are due to be timed
+		self.untimed_shared = self.shared
+		self.timed_shared = MeasuredSharedLock(self)
+	
+	def sample(self, samples):
+		"""
+		Time the next number of acquisitions of each kind.
+		"""
+		self.samples = samples
+		self.timed_shared.samples = samples
+		self.shared = self.timed_shared
+	
+	def __enter__(self):
+		if not self.samples:
+			ReadWriteLock.acquire(self)
+			return self
+		self.samples -= 1
+		start = time.time()
+		ReadWriteLock.acquire(self)
+		self.acquired = (start, time.time())
+		return self
+	
+	def __exit__(self, *exc_info):
+		timed = self.acquired
+		if timed is None:
+			ReadWriteLock.release(self)
+			return
+		self.acquired = None
+		released = time.time()
+		ReadWriteLock.release(self)
+		start, acquired = timed
+		self.metrics.record_lock('exclusive', acquired - start,
+			released - acquired)
+	
+	def acquire(self):
+		self.__enter__()
+	
+	def release(self):
+		self.__exit__()
+
+class NimUpdate(str):
+	"""
+	An encoded message describing a move in a game, which a user's queue can
+	replace with the game's state.
+	"""
+	
+	def __new__(cls, data, game):
+		"""
+		Mark encoded data as an update of a game.
+		"""
+		update = str.__new__(cls, data)
+		update.game = game
+		return update
+
+class NimMessage(object):
+	"""
+	A message encoded once for all of its recipients. Every user's queue
+	shares the same queued form, and every user in push mode is sent the
+	same 300 Continued response, instead of each encoding a copy.
+	"""
+	
+	__slots__ = ('queued', 'pushed_data', 'game')
+	
+	def __init__(self, message, game=None):
+		"""
+		Encode a message as it will be queued, marked as an update of a game
+		if it describes a move in one.
+		"""
+		self.game = game
+		self.queued = "\n" + message
+		if game:
+			self.queued = NimUpdate(self.queued, game)
+		self.pushed_data = None
+	
+	@property
+	def pushed(self):
+		"""
+		The message as a 300 Continued response, composed when first
+		accessed.
+		"""
+		if self.pushed_data is None:
+			data = NimResponse.compose(CONTINUED, self.queued).data
+			self.pushed_data = NimUpdate(data, self.game) if self.game else data
+		return self.pushed_data
 
 class NimUser(object):
 	"""
-	Represents a user connected to a server.
+	Represents a user connected to a server. Messages for the user are
+	queued by enqueue(), and the ones which are pushed to them or answer
+	their waiting PING request are sent by flush(), without blocking and
+	without holding any game's lock or the server's lock, so that a client
+	which stops reading cannot stall other users.
 	"""
 	
+	# The policies for a message which would overflow the queue: drop the
+	# oldest queued messages, replace the queued moves of a game with its
+	# state, or disconnect the user
+	DROP_OLDEST, COLLAPSE, DISCONNECT = 'drop-oldest', 'collapse', 'disconnect'
+	
+	# The policy used when the queue is full
+	queue_policy = DROP_OLDEST
+	
+	# The most messages that can be queued
+	max_queue_length = 1000
+	
+	# The most bytes of messages that can be queued
+	max_queue_size = 256 * 1024
+	
 	def __init__(self, socket, name=None):
 		"""
 		Instantiate a user.
@@ -31,32 +296,316 @@ class NimUser(object):
 		self.game = None
 		# Initially the user is not observing a game
 		self.observing = None
-		# Initially the user has no queued messages
-		self.queue = ''
+		# Initially the user has no queued messages, and no data taken from
+		# the queue is waiting to be sent
+		self.queue = collections.deque()
+		self.queue_size = 0
+		self.unsent = ''
+		# Initially no messages have been dropped from the queue
+		self.dropped = 0
+		# Initially the user has not been disconnected for a full queue, and
+		# their connection has not been closed for it
+		self.disconnected = False
+		self.closed = False
+		# Initially messages are queued until the user's next request
+		self.pushing = False
+		# Initially moves are described in full instead of as deltas
+		self.delta = False
+		# The deadline of the user's waiting PING request, if any, and its
+		# request handler, request and the time it was received, to record
+		# it when it is answered
+		self.polling = None
+		self.poll_request = None
+		# The time of the user's last request, or of their connection
+		self.active = time.time()
+		# Initialize the lock for the user's queue, and the lock for writing
+		# to their socket, which is never held while waiting for the other
+		self.lock = threading.Lock()
+		self.write_lock = threading.Lock()
+		# Initially no thread is waiting to write to a blocked socket
+		self.writer = None
 	
 	def enqueue(self, message):
 		"""
-		Add a message to the queue.
+		Add a message, or a NimMessage shared with other users, to the queue,
+		encoded as a 300 Continued response if the user is in push mode. If
+		the queue is full, apply the queue policy. Callers queueing a move in
+		a game should hold the game's lock. Callers should call flush()
+		once they no longer hold any game's lock or the server's lock, to
+		push the message or answer a waiting PING request with it.
+		"""
+		# Encode the message as it will be sent, unless it already is
+		if not isinstance(message, NimMessage):
+			message = NimMessage(message)
+		with self.lock:
+			if self.disconnected:
+				self.dropped += 1
+				return
+			data = message.pushed if self.pushing else message.queued
+			if not self.fits(data):
+				self.overflow(data, message.game)
+			else:
+				self.append(data)
+	
+	def start_pushing(self):
+		"""
+		Push messages to the user from now on, including the ones already
+		queued, which are sent together in one 300 Continued response.
+		"""
+		with self.lock:
+			queued = self.clear()
+			self.pushing = True
+			if queued:
+				self.append(NimResponse.compose(CONTINUED, queued).data)
+	
+	def encode(self, message):
+		"""
+		Return a message encoded as it is queued for the user. The caller must
+		hold the user's lock.
+		"""
+		if self.pushing:
+			return NimResponse.compose(CONTINUED, "\n" + message).data
+		return "\n" + message
+	
+	def fits(self, message):
+		"""
+		Return True if an encoded message fits in the queue, False otherwise.
+		"""
+		return (len(self.queue) < self.max_queue_length and
+			self.queue_size + len(message) <= self.max_queue_size)
+	
+	def append(self, message):
+		"""
+		Add an encoded message to the queue. The caller must hold the user's
+		lock.
+		"""
+		self.queue.append(message)
+		self.queue_size += len(message)
+	
+	def overflow(self, message, game=None):
+		"""
+		Apply the queue policy to an encoded message which does not fit in
+		the queue, and which describes a move in a game if one is given. The
+		caller must hold the user's lock, and the game's lock if one is given.
+		"""
+		if self.queue_policy == self.DISCONNECT:
+			# Drop every message, and close the connection when the user is
+			# next flushed
+			self.dropped += len(self.queue) + 1
+			self.clear()
+			self.disconnected = True
+			return
+		if self.queue_policy == self.COLLAPSE and game and not game.over:
+			# Replace the queued moves in the game, and this one, with its
+			# state, which already includes their effects; other messages
+			# are kept in order
+			kept = [data for data in self.queue
+				if not (isinstance(data, NimUpdate) and data.game is game)]
+			self.dropped += len(self.queue) - len(kept) + 1
+			self.clear()
+			for data in kept:
+				self.append(data)
+			message = NimUpdate(self.encode(game.get_snapshot() if self.delta
+				else game.get_state()), game)
+		# Drop the oldest messages until the new one fits
+		while self.queue and not self.fits(message):
+			self.queue_size -= len(self.queue.popleft())
+			self.dropped += 1
+		if self.fits(message):
+			self.append(message)
+		else:
+			self.dropped += 1
+	
+	def flush(self):
+		"""
+		Send the queued messages if the user is in push mode, answer their
+		waiting PING request if messages are queued, or close their connection
+		if they were disconnected for a full queue. Nothing is sent while
+		another thread is writing to the socket, since it sends these messages
+		when it is done, and nothing blocks: what the socket cannot take now
+		is sent by a separate thread, or by an event-driven server when the
+		socket can be written to. Closing a connection can remove its user
+		from the server, so callers should not hold the user's lock, any
+		game's lock, or the server's lock.
+		"""
+		# Most users have nothing to send when they are flushed
+		if not (self.pushing or self.polling or self.unsent or
+			self.disconnected):
+			return
+		if self.disconnected:
+			with self.lock:
+				if self.closed:
+					return
+				self.closed = True
+			try:
+				self.socket.shutdown(socket.SHUT_RDWR)
+			except socket.error as e:
+				pass
+			return
+		# A thread writing to a blocked socket sends everything
+		if self.writer:
+			return
+		while self.write_lock.acquire(False):
+			try:
+				# An event-driven server's connection tells its request
+				# handler when it is no longer blocked, and the messages stay
+				# in the queue until then
+				if getattr(self.socket, 'blocked', False):
+					return
+				with self.lock:
+					data = self.take_output()
+				if not data:
+					return
+				try:
+					sent = self.send_nowait(data)
+				except socket.error as e:
+					# The user's own request handler will notice the
+					# disconnection
+					return
+				if sent < len(data):
+					with self.lock:
+						self.unsent = data[sent:] + self.unsent
+						self.start_writer()
+					return
+			finally:
+				self.write_lock.release()
+			# Send the messages queued by other threads while writing, which
+			# they left for this thread to send
+			if not (self.queue or self.unsent):
+				return
+	
+	def take_output(self):
+		"""
+		Empty and return the data waiting to be sent to the user outside of
+		their responses: the data which could not be sent before, the queued
+		messages if the user is in push mode, and the answer to their waiting
+		PING request if messages are queued. The caller must hold the user's
+		lock.
+		"""
+		data = self.unsent
+		self.unsent = ''
+		if self.pushing:
+			if self.queue:
+				data += self.clear()
+		elif self.polling and self.queue:
+			data += self.answer()
+		return data
+	
+	def send_nowait(self, data):
+		"""
+		Send as much data as possible to the user's socket without blocking,
+		and return the number of bytes sent. The connections of event-driven
+		servers do this themselves.
+		"""
+		if hasattr(self.socket, 'send_nowait'):
+			return self.socket.send_nowait(data)
+		# Sending blocks on a socket with a timeout until it can be written
+		# to, so check that it can be first
+		poller = select.poll()
+		poller.register(self.socket, select.POLLOUT)
+		if not poller.poll(0):
+			return 0
+		try:
+			return self.socket.send(data, socket.MSG_DONTWAIT)
+		except socket.error as e:
+			if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+				return 0
+			raise
+	
+	def start_writer(self):
+		"""
+		Start a thread which sends the data waiting to be sent to the user
+		while it blocks, unless the socket belongs to an event-driven server,
+		which sends it when the socket can be written to. The caller must hold
+		the user's lock.
+		"""
+		if self.writer or hasattr(self.socket, 'send_nowait'):
+			return
+		self.writer = threading.Thread(target=self.write_blocked)
+		self.writer.daemon = True
+		self.writer.start()
+	
+	def write_blocked(self):
+		"""
+		Send the data waiting to be sent to the user, blocking until the
+		socket can be written to, until none is left.
+		"""
+		while True:
+			with self.write_lock:
+				with self.lock:
+					data = self.take_output()
+					if not data:
+						self.writer = None
+						return
+				try:
+					self.socket.sendall(data)
+				except socket.error as e:
+					# The user's own request handler will notice the
+					# disconnection
+					with self.lock:
+						self.writer = None
+					return
+	
+	def clear(self):
+		"""
+		Empty the queue and return the queued messages. The caller must hold
+		the user's lock.
 		"""
-		self.queue += "\n" + message
+		queued = ''.join(self.queue)
+		self.queue.clear()
+		self.queue_size = 0
+		return queued
 	
 	def get_queue(self):
 		"""
 		Return the queued messages.
 		"""
-		return self.queue
+		with self.lock:
+			return ''.join(self.queue)
+	
+	def answer_poll(self, deadline=None):
+		"""
+		Answer the user's waiting PING request with the queued messages, if
+		it has not been answered yet. If a deadline is given, only answer the
+		request if it was waiting until then. Callers should not hold any
+		locks.
+		"""
+		with self.lock:
+			if not self.polling:
+				return
+			if deadline is not None and deadline != self.polling:
+				return
+			self.unsent += self.answer()
+		self.flush()
+	
+	def answer(self):
+		"""
+		Empty the queue and return the response to the user's waiting PING
+		request with the queued messages, and record the request with the
+		time it waited. The caller must hold the user's lock.
+		"""
+		response = NimResponse.compose(OK, self.clear())
+		self.polling = None
+		if self.poll_request:
+			handler, request, started = self.poll_request
+			self.poll_request = None
+			handler.answered(request, response, time.time() - started)
+		return response.data
 	
 	def dequeue(self):
 		"""
-		Empty and return the queued messages.
+		Empty and return the queued messages, unless they are pushed to the
+		user by flush().
 		"""
-		queued = self.queue
-		self.queue = ''
-		return queued
+		with self.lock:
+			if self.pushing:
+				return ''
+			return self.clear()
 
 class NimGame(object):
 	"""
-	Represents an ongoing game of Nim.
+	Represents an ongoing game of Nim. Callers should hold the game's lock
+	while making moves or changing its observers.
 	"""
 	
 	# The game ID for the next NimGame instance
@@ -79,8 +628,14 @@ class NimGame(object):
 		self.player1 = self.playing = player1
 		# Player 2 waits for their turn
 		self.player2 = self.waiting = player2
+		# Initially no moves have been made
+		self.moves = 0
 		# Initially no users are observing the game
 		self.observers = set()
+		# Initially the game is not over
+		self.over = False
+		# Initialize the lock for the game's moves and observers
+		self.lock = threading.Lock()
 	
 	def get_state(self):
 		"""
@@ -96,6 +651,36 @@ class NimGame(object):
 		state += '  '.join(map(str, self.sets))
 		return state
 	
+	def get_snapshot(self):
+		"""
+		Return a compact description of the game state, for users who are
+		sent deltas: the game ID, the number of moves made, and the size of
+		each set.
+		"""
+		return 'snapshot {} {} {}'.format(self.id, self.moves,
+			' '.join(map(str, self.sets)))
+	
+	def get_start(self, user):
+		"""
+		Return the description of the start of the game sent to a player:
+		its state, followed by a snapshot for users who are sent deltas.
+		"""
+		if user.delta:
+			return "{}\n{}".format(self.get_state(), self.get_snapshot())
+		return self.get_state()
+	
+	def get_delta(self, s):
+		"""
+		Return a compact description of the last move, which changed a set,
+		for users who are sent deltas: the game ID, the number of moves made,
+		the set ID, and its new size. If the move ended the game, say who won.
+		"""
+		delta = 'delta {} {} {} {}'.format(self.id, self.moves, s,
+			self.sets[s-1])
+		if self.over:
+			delta += "\n{} wins.".format(self.waiting.name)
+		return delta
+	
 	def move(self, player, n, s):
 		"""
 		Apply a player's move and return a tuple of the Nim status code and
@@ -114,6 +699,7 @@ class NimGame(object):
 				n, 's' if n != 1 else '', s))
 		# Remove the objects from the set
 		self.sets[s-1] -= n
+		self.moves += 1
 		# Switch whose turn it is
 		self.playing, self.waiting = self.waiting, self.playing
 		# Create a description of the move
@@ -123,6 +709,7 @@ class NimGame(object):
 		# Check if the move removed the last objects and ended the game
 		if not sum(self.sets):
 			message += "\n{} wins.".format(player.name)
+			self.over = True
 			return (END_GAME, message)
 		return (OK, message)
 	
@@ -158,13 +745,79 @@ class NimGame(object):
 		"""
 		for observer in self.observers:
 			yield observer
+	
+	def broadcast(self, message, users=(), delta=None, move=False):
+		"""
+		Encode a message once and add it to the queue of some users and every
+		observer of this game. Users who are sent deltas get the delta
+		instead, if there is one. If the message describes a move, a full
+		queue can replace it with the game's state. Return a list of the
+		users, who should be flushed once no locks are held.
+		"""
+		game = self if move else None
+		message = NimMessage(message, game)
+		delta = NimMessage(delta, game) if delta else message
+		recipients = list(users)
+		recipients.extend(self.observers)
+		for user in recipients:
+			user.enqueue(delta if user.delta else message)
+		return recipients
 
 class NimServer(SocketServer.TCPServer):
 	"""
 	Represents a Nim server which can accept connections from clients and
 	send responses. Modeled after Python 3's http.server.HTTPServer class.
+	Callers should hold the server's lock for reading while looking through
+	its users and games, and for writing while changing them.
 	"""
 	
+	# Whether request handlers are passed requests by the server's event loop,
+	# instead of reading requests from their own sockets until disconnection
+	event_driven = False
+	
+	# The maximum number of connections waiting to be accepted
+	request_queue_size = socket.SOMAXCONN
+	
+	# Whether to collect metrics about requests and the server's lock
+	collect_metrics = True
+	
+	# The seconds a connection can go without sending a request before the
+	# reaper drops its user and closes it, or None to keep idle connections
+	# open; this should be longer than the clients' waiting PING requests
+	idle_timeout = None
+	
+	# The seconds between the reaper's checks for idle connections
+	reap_interval = 5
+	
+	# The seconds a request handler of a non-event-driven server can block
+	# sending to or receiving from its connection before closing it, or None
+	# to block indefinitely; since it blocks until each request is received,
+	# this also closes connections which are idle for longer
+	read_timeout = None
+	
+	# The seconds a connection can be idle before TCP keepalive probes are
+	# sent, the seconds between probes, and the number of unanswered probes
+	# before the connection is dropped, so that the users of clients which
+	# vanished without closing their connections are removed; set
+	# keepalive_idle to None to disable keepalive
+	keepalive_idle = 60
+	keepalive_interval = 10
+	keepalive_count = 5
+	
+	# The most pages of the list of games which are cached for a revision
+	max_cached_pages = 256
+	
+	# The seconds event-driven servers stop accepting connections for after
+	# running out of file descriptors or buffers for them
+	accept_pause = 1.0
+	
+	# The width of the rating bands in which users waiting for a match are
+	# paired (None to pair any users), the seconds between widening the
+	# bands they accept by one, and the most bands they can widen by
+	match_band_width = 100
+	match_widen_interval = 5.0
+	match_max_widening = 5
+	
 	def __init__(self, server_address, RequestHandlerClass):
 		"""
 		Instantiate a Nim server. Binds a TCP socket to the server address.
@@ -176,16 +829,45 @@ class NimServer(SocketServer.TCPServer):
 			self.server_bind()
 		except socket.error as e:
 			raise NimException(e.strerror)
-		# Initialize the server's lock
-		self.lock = threading.Lock()
+		# Initialize the metrics and the lock for the server's users and
+		# games, which records its timings in the metrics
+		self.metrics = NimMetrics() if self.collect_metrics else None
+		self.lock = (MeasuredReadWriteLock(self.metrics) if self.metrics
+			else ReadWriteLock())
 		# Initialize the server's host and port
 		self.host, self.port = self.server_address
 		# Initially the socket:NimUser map is empty
 		self.users = {}
 		# Initially the username:NimUser map is empty
 		self.usernames = {}
+		# Initially no logged-in users are available to play; their names are
+		# kept sorted
+		self.available = []
 		# Initially the id:NimGame map is empty
 		self.games = {}
+		# Initially there are no game IDs, which are kept sorted
+		self.game_ids = []
+		# The revision of the games, which increases whenever one starts or
+		# ends; it starts at random so that revisions from an earlier server
+		# are unlikely to match
+		self.revision = random.randint(0, 1 << 30)
+		# Initially no pages of the list of games are cached
+		self.games_pages = {}
+		self.games_pages_revision = self.revision
+		# Initially no callbacks are scheduled
+		self.timers = []
+		self.timer_ids = itertools.count()
+		# Initially no messages have been dropped from removed users' queues
+		self.dropped = 0
+		# Initially the reaper is not stopped
+		self.reaper_stopped = threading.Event()
+		# Initially no requests are profiled
+		self.profiler = None
+		# Initially no users are waiting for a match, and the matchmaker is
+		# not stopped
+		self.matchmaker = NimMatchmaker(self.match_band_width,
+			self.match_widen_interval, self.match_max_widening)
+		self.matchmaker_stopped = threading.Event()
 	
 	def listen(self):
 		"""
@@ -196,6 +878,232 @@ class NimServer(SocketServer.TCPServer):
 		except socket.error as e:
 			raise NimException(e.strerror)
 	
+	def get_request(self):
+		"""
+		Accept a connection and return its socket and client address.
+		Disables Nagle's algorithm on the socket, since each request's
+		responses are already sent in a single write, and messages pushed
+		to the client should not wait for its acknowledgement of them.
+		"""
+		connection, client_address = self.socket.accept()
+		connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+		# Detect clients which vanished without closing their connections
+		if self.keepalive_idle is not None:
+			connection.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+			if hasattr(socket, 'TCP_KEEPIDLE'):
+				connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE,
+					self.keepalive_idle)
+				connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL,
+					self.keepalive_interval)
+				connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT,
+					self.keepalive_count)
+		# Event-driven servers never block on their connections
+		if self.read_timeout is not None and not self.event_driven:
+			connection.settimeout(self.read_timeout)
+		return connection, client_address
+	
+	def serve_forever(self, poll_interval=0.5):
+		"""
+		Start the reaper and the matchmaker, then handle connections until
+		shutdown() is called.
+		"""
+		self.start_reaper()
+		self.start_matchmaker()
+		SocketServer.TCPServer.serve_forever(self, poll_interval)
+	
+	def shutdown(self):
+		"""
+		Stop the reaper, the matchmaker and the serve_forever() loop, and wait
+		until the loop stops.
+		"""
+		self.reaper_stopped.set()
+		self.matchmaker_stopped.set()
+		SocketServer.TCPServer.shutdown(self)
+	
+	def server_close(self):
+		"""
+		Stop collecting metrics and close the socket.
+		"""
+		if self.metrics:
+			self.metrics.close()
+		SocketServer.TCPServer.server_close(self)
+	
+	def start_profiling(self, path, mode=NimProfiler.CPROFILE, seconds=None,
+		requests=None, callback=None):
+		"""
+		Profile the handling of requests for a number of seconds or requests,
+		or until stop_profiling() is called, then write the results to a file
+		and call the callback with the NimProfiler. Return the profiler, or
+		None if requests are already being profiled.
+		"""
+		if self.profiler:
+			return None
+		def stopped(profiler):
+			if self.profiler is profiler:
+				self.profiler = None
+			if callback:
+				callback(profiler)
+		profiler = NimProfiler(path, mode, seconds, requests,
+			callback=stopped)
+		profiler.start()
+		self.profiler = profiler
+		return profiler
+	
+	def stop_profiling(self):
+		"""
+		Stop profiling requests and write the results, if they are being
+		profiled.
+		"""
+		profiler = self.profiler
+		if profiler:
+			profiler.stop()
+	
+	def start_reaper(self):
+		"""
+		Start dropping idle users every reap_interval seconds, if there is an
+		idle timeout. Event-driven servers do so from their event loops, and
+		other servers from a separate thread.
+		"""
+		if self.idle_timeout is None:
+			return
+		if self.event_driven:
+			self.call_later(self.reap_interval, self.reap_periodically)
+			return
+		self.reaper_stopped.clear()
+		reaper = threading.Thread(target=self.reap_periodically)
+		reaper.daemon = True
+		reaper.start()
+	
+	def reap_periodically(self):
+		"""
+		Drop idle users, then schedule the next check, or keep checking until
+		the reaper is stopped.
+		"""
+		if self.event_driven:
+			self.reap()
+			self.call_later(self.reap_interval, self.reap_periodically)
+			return
+		while True:
+			time.sleep(self.reap_interval)
+			if self.reaper_stopped.is_set():
+				return
+			self.reap()
+	
+	def reap(self):
+		"""
+		Drop every user who has not sent a request for longer than the idle
+		timeout, unless they are waiting for the response to a PING request,
+		and close their connections.
+		"""
+		deadline = time.time() - self.idle_timeout
+		with self.lock.shared:
+			idle = [user for user in self.users.values()
+				if user.active < deadline and not user.polling]
+		for user in idle:
+			self.drop_user(user)
+			# The user's request handler will notice the disconnection
+			try:
+				user.socket.shutdown(socket.SHUT_RDWR)
+			except socket.error as e:
+				pass
+	
+	def start_matchmaker(self):
+		"""
+		Start pairing the users waiting for a match who accept each other
+		after waiting longer every match_widen_interval seconds, if the bands
+		can widen. Event-driven servers do so from their event loops, and
+		other servers from a separate thread.
+		"""
+		if not self.match_band_width or not self.match_widen_interval:
+			return
+		if self.event_driven:
+			self.call_later(self.match_widen_interval,
+				self.match_periodically)
+			return
+		self.matchmaker_stopped.clear()
+		matchmaker = threading.Thread(target=self.match_periodically)
+		matchmaker.daemon = True
+		matchmaker.start()
+	
+	def match_periodically(self):
+		"""
+		Pair the waiting users, then schedule the next check, or keep
+		checking until the matchmaker is stopped.
+		"""
+		if self.event_driven:
+			self.match_waiting()
+			self.call_later(self.match_widen_interval,
+				self.match_periodically)
+			return
+		while True:
+			time.sleep(self.match_widen_interval)
+			if self.matchmaker_stopped.is_set():
+				return
+			self.match_waiting()
+	
+	def match_waiting(self):
+		"""
+		Start games between the waiting users who accept each other now that
+		they have waited longer, and notify them of their games.
+		"""
+		if len(self.matchmaker) < 2:
+			return
+		with self.lock:
+			games = [self.start_game(user, opponent) for (user, opponent)
+				in self.matchmaker.widened(time.time())]
+		for game in games:
+			for player in (game.player1, game.player2):
+				player.enqueue(game.get_start(player))
+				player.flush()
+	
+	def match_user(self, user, rating=None):
+		"""
+		Start a game between a user and a waiting user in the same rating
+		band, who moves first, and return the NimGame instance; or add the
+		user to the users waiting for a match and return None. Callers should
+		hold the server's lock.
+		"""
+		opponent = self.matchmaker.add(user, rating, time.time())
+		if not opponent:
+			return None
+		return self.start_game(opponent, user)
+	
+	def accept_failed(self, error):
+		"""
+		Called when a connection cannot be accepted because the server has
+		run out of file descriptors or buffers, with the socket.error. The
+		default implementation writes it to standard error.
+		"""
+		sys.stderr.write('Unable to accept connections: {}\n'.format(
+			error.strerror))
+	
+	def call_later(self, delay, callback, *args):
+		"""
+		Schedule a callback to be called with some arguments after a delay
+		in seconds. Only event-driven servers call scheduled callbacks, from
+		their event loops.
+		"""
+		heapq.heappush(self.timers, (time.time() + delay, next(self.timer_ids),
+			callback, args))
+	
+	def run_timers(self):
+		"""
+		Call every scheduled callback that is due.
+		"""
+		now = time.time()
+		while self.timers and self.timers[0][0] <= now:
+			_, _, callback, args = heapq.heappop(self.timers)
+			callback(*args)
+	
+	def next_timeout(self, timeout):
+		"""
+		Return the seconds until the next scheduled callback is due, or the
+		given timeout if it is sooner.
+		"""
+		if not self.timers:
+			return timeout
+		return max(0, min(timeout, self.timers[0][0] - time.time()))
+	
 	def add_user(self, socket, name=None):
 		"""
 		Add a new user to the server and return their NimUser instance.
@@ -222,6 +1130,7 @@ class NimServer(SocketServer.TCPServer):
 		"""
 		user.name = name
 		self.usernames[name] = user
+		self.make_available(user)
 	
 	def remove_user(self, user):
 		"""
@@ -230,8 +1139,61 @@ class NimServer(SocketServer.TCPServer):
 		del self.users[user.socket]
 		if user.name:
 			del self.usernames[user.name]
+			self.make_unavailable(user)
 		if user.observing:
-			user.observing.remove_observer(user)
+			with user.observing.lock:
+				user.observing.remove_observer(user)
+		self.matchmaker.remove(user)
+		self.dropped += user.dropped
+	
+	def drop_user(self, user):
+		"""
+		Remove a user who said goodbye, disconnected, or was idle for too
+		long. If they were playing a game, notify its players and observers of
+		their departure and end it. Does nothing if the user has already been
+		removed. Callers should not hold the server's lock.
+		"""
+		recipients = ()
+		with self.lock:
+			# Check that the user was not already removed
+			if self.users.get(user.socket) is not user:
+				return
+			this_game = user.game
+			# Check if the user was playing a game
+			if this_game:
+				with this_game.lock:
+					# Notify the opponent and observers of the departure
+					if not this_game.over:
+						message = '{} has quit.'.format(user.name)
+						recipients = this_game.broadcast(message,
+							(this_game.player1, this_game.player2))
+				# End the game
+				self.end_game(this_game)
+			# Remove user from server
+			self.remove_user(user)
+		# Send the notifications now that no locks are held
+		for recipient in recipients:
+			recipient.flush()
+	
+	def queue_stats(self):
+		"""
+		Return a dictionary with the number of users with queued messages,
+		the total and largest number of queued messages and bytes, and the
+		total number of messages dropped from full queues.
+		"""
+		stats = {'users': 0, 'messages': 0, 'bytes': 0, 'max_messages': 0,
+			'max_bytes': 0, 'dropped': self.dropped}
+		for user in self.users.values():
+			depth = len(user.queue)
+			size = user.queue_size + len(user.unsent)
+			if depth or size:
+				stats['users'] += 1
+				stats['messages'] += depth
+				stats['bytes'] += size
+				stats['max_messages'] = max(stats['max_messages'], depth)
+				stats['max_bytes'] = max(stats['max_bytes'], size)
+			stats['dropped'] += user.dropped
+		return stats
 	
 	def all_users(self, logged_in=None, available=None):
 		"""
@@ -249,6 +1211,48 @@ class NimServer(SocketServer.TCPServer):
 				continue
 			yield user
 	
+	def make_available(self, user):
+		"""
+		Add a logged-in user to the index of users available to play, if they
+		are not already in it.
+		"""
+		i = bisect.bisect_left(self.available, user.name)
+		if i == len(self.available) or self.available[i] != user.name:
+			self.available.insert(i, user.name)
+	
+	def make_unavailable(self, user):
+		"""
+		Remove a logged-in user from the index of users available to play, if
+		they are in it.
+		"""
+		i = bisect.bisect_left(self.available, user.name)
+		if i < len(self.available) and self.available[i] == user.name:
+			del self.available[i]
+	
+	def available_users(self, prefix='', after=None, limit=None,
+		exclude=None):
+		"""
+		Return a list of the names of logged-in users not playing games, in
+		sorted order, which start with a prefix and come after a name, if
+		given, at most limit of them, and excluding one name; and whether
+		there are more. Only the returned names are visited.
+		"""
+		names = self.available
+		start = bisect.bisect_left(names, prefix)
+		if after is not None:
+			start = max(start, bisect.bisect_right(names, after))
+		players = []
+		for i in xrange(start, len(names)):
+			name = names[i]
+			if not name.startswith(prefix):
+				break
+			if name == exclude:
+				continue
+			if limit is not None and len(players) == limit:
+				return (players, True)
+			players.append(name)
+		return (players, False)
+	
 	def username_taken(self, name):
 		"""
 		Return True if a name is assigned to a user, False otherwise.
@@ -261,14 +1265,34 @@ class NimServer(SocketServer.TCPServer):
 		"""
 		game = NimGame(player1, player2)
 		self.games[game.id] = player1.game = player2.game = game
+		bisect.insort(self.game_ids, game.id)
+		self.revision += 1
+		self.make_unavailable(player1)
+		self.make_unavailable(player2)
+		self.matchmaker.remove(player1)
+		self.matchmaker.remove(player2)
 		return game
 	
 	def end_game(self, game):
 		"""
-		End a game and remove it from the server.
+		End a game and remove it from the server, if it has not already
+		been removed. Ending a game again does nothing, even if its players
+		have since started other games.
 		"""
-		game.player1.game = game.player2.game = None
-		del self.games[game.id]
+		with game.lock:
+			game.over = True
+		# Once the game has been removed, its players may be in other games
+		if not self.games.pop(game.id, None):
+			return
+		del self.game_ids[bisect.bisect_left(self.game_ids, game.id)]
+		self.revision += 1
+		# The players are available again, unless they were removed
+		for player in (game.player1, game.player2):
+			if player.game is not game:
+				continue
+			player.game = None
+			if self.users.get(player.socket) is player:
+				self.make_available(player)
 	
 	def get_game(self, id):
 		"""
@@ -276,6 +1300,37 @@ class NimServer(SocketServer.TCPServer):
 		"""
 		return self.games.get(id, None)
 	
+	def games_page(self, after=None, limit=None):
+		"""
+		Return a page of the list of ongoing games, in order of their IDs,
+		after an ID if given and with at most limit of them, as a tuple of
+		its text and the ID to list the next page after, or None if there are
+		no more. Pages are cached until a game starts or ends. Callers should
+		hold the server's lock.
+		"""
+		# Forget the cached pages of earlier revisions
+		if self.games_pages_revision != self.revision:
+			self.games_pages = {}
+			self.games_pages_revision = self.revision
+		page = self.games_pages.get((after, limit))
+		if page:
+			return page
+		ids = self.game_ids
+		start = bisect.bisect_right(ids, after) if after is not None else 0
+		end = len(ids) if limit is None else min(start + limit, len(ids))
+		games = []
+		for id in ids[start:end]:
+			game = self.games[id]
+			games.append('{} - {} vs. {}'.format(id, game.player1.name,
+				game.player2.name))
+		if not games:
+			games.append('There are no ongoing games.')
+		page = ("\n".join(games), ids[end-1] if start < end < len(ids)
+			else None)
+		if len(self.games_pages) < self.max_cached_pages:
+			self.games_pages[(after, limit)] = page
+		return page
+	
 	def all_games(self):
 		"""
 		Return a generator for all the games on the server.
@@ -285,7 +1340,10 @@ class NimServer(SocketServer.TCPServer):
 
 class ForkingNimServer(SocketServer.ForkingMixIn, NimServer):
 	"""
-	Extends NimServer to start a new process for each connection.
+	Extends NimServer to start a new process for each connection. Each process
+	has its own copy of the users and games, so clients connected to different
+	processes cannot see each other; FrontEndNimServer does not have this
+	problem, but still handles every request in one process.
 	"""
 
 class ThreadingNimServer(SocketServer.ThreadingMixIn, NimServer):
@@ -293,136 +1351,800 @@ class ThreadingNimServer(SocketServer.ThreadingMixIn, NimServer):
 	Extends NimServer to start a new thread for each connection.
 	"""
 
-class BaseNimRequestHandler(SocketServer.BaseRequestHandler):
+class AsyncNimServer(NimServer):
 	"""
-	Represents a connection to a NimServer. An instance of this class is created
-	for each request.
+	Extends NimServer to handle every connection in a single thread with an
+	asyncore event loop, instead of starting a new thread for each connection.
 	"""
 	
-	def __init__(self, socket, client_address, server):
+	# Request handlers are passed requests by the event loop
+	event_driven = True
+	
+	def __init__(self, server_address, RequestHandlerClass):
 		"""
-		Instantiate a Nim request handler and handle requests until finished.
-		Identical to SocketServer.BaseRequestHandler.__init__ except for
-		renaming self.request to self.socket, since self.request is
-		defined in setup() to hold the NimRequest object.
+		Instantiate an asynchronous Nim server.
 		"""
-		self.socket = socket
-		self.client_address = client_address
-		self.server = server
-		self.setup()
+		NimServer.__init__(self, server_address, RequestHandlerClass)
+		# Initially the event loop has no sockets to dispatch
+		self.socket_map = {}
+		# Initially the event loop is not running
+		self.running = False
+		self.stopped = threading.Event()
+		self.stopped.set()
+	
+	def listen(self):
+		"""
+		Start listening on the socket for incoming connections.
+		"""
+		NimServer.listen(self)
+		AsyncNimAcceptor(self)
+	
+	def serve_forever(self, poll_interval=0.5):
+		"""
+		Handle connections and requests until shutdown() is called.
+		"""
+		self.running = True
+		self.stopped.clear()
+		self.start_reaper()
+		self.start_matchmaker()
 		try:
-			self.handle()
+			while self.running:
+				asyncore.loop(self.next_timeout(poll_interval), True,
+					self.socket_map, 1)
+				self.run_timers()
 		finally:
-			self.finish()
+			self.stopped.set()
 	
-	def setup(self):
+	def shutdown(self):
 		"""
-		Called before the handle() method to initialize the handler.
-		The default implementation initializes some instance variables
-		and adds a NimUser object to the server.
+		Stop the serve_forever() loop and wait until it stops.
 		"""
-		# Initialize the client's host and port
-		self.host, self.port = self.client_address
-		# Initially there is no stored NimRequest object
-		self.request = None
-		# Initially there is no stored NimResponse object
-		self.response = None
-		# Add the user of this connection to the server
-		self.server.lock.acquire()
-		self.server.add_user(self.socket)
-		self.server.lock.release()
+		self.running = False
+		self.stopped.wait()
 	
-	def handle(self):
+	def server_close(self):
 		"""
-		Service a request by a client.
+		Close the listening socket and every connection.
 		"""
-		# Repeatedly parse and handle client requests until disconnection
-		while self.parse_request():
-			method_method = None
-			# Check that the client supports this version of Nim
-			if self.request.version > NIM_VERSION:
-				method_method = self.unsupported_version
-			else:
-				do_method = 'do_' + self.request.method
-				# Check that the request method is supported
-				if not hasattr(self, do_method):
-					method_method = self.unsupported_method
-				else:
-					method_method = getattr(self, do_method)
-			# Call the appropriate method to handle this request
-			try:
-				self.server.lock.acquire()
-				method_method()
-				self.server.lock.release()
-			except Exception as e:
-				raise NimException(e.message)
+		asyncore.close_all(self.socket_map)
+		NimServer.server_close(self)
+
+class AsyncNimAcceptor(asyncore.dispatcher):
+	"""
+	Accepts connections to an AsyncNimServer in its event loop.
+	"""
 	
-	def finish(self):
+	def __init__(self, server):
 		"""
-		Called after the handle() method to clean up after the handler.
-		The default implementation does nothing.
+		Dispatch the server's listening socket in its event loop.
 		"""
+		asyncore.dispatcher.__init__(self, server.socket, server.socket_map)
+		self.server = server
+		self.accepting = True
+		# Initially accepting is not paused
+		self.paused = False
 	
-	def parse_request(self):
+	def readable(self):
 		"""
-		Receive a request from the client and store it as a NimRequest object.
-		Return True if the request could be parsed, False otherwise.
+		Return True unless accepting is paused, False otherwise.
+		"""
+		return not self.paused
+	
+	def handle_accept(self):
+		"""
+		Accept every pending connection. If the server runs out of file
+		descriptors or buffers, stop accepting for accept_pause seconds,
+		instead of failing or retrying in a busy loop.
+		"""
+		while True:
+			try:
+				connection, client_address = self.server.get_request()
+			except socket.error as e:
+				if e.errno == errno.ECONNABORTED:
+					continue
+				if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+					return
+				if e.errno in (errno.EMFILE, errno.ENFILE, errno.ENOBUFS,
+					errno.ENOMEM):
+					self.server.accept_failed(e)
+					self.paused = True
+					self.server.call_later(self.server.accept_pause,
+						self.resume)
+					return
+				raise
+			AsyncNimConnection(connection, client_address, self.server)
+	
+	def resume(self):
+		"""
+		Accept connections again after a pause.
+		"""
+		self.paused = False
+
+class AsyncNimConnection(asyncore.dispatcher):
+	"""
+	Represents a connection to an AsyncNimServer in its event loop. Passes
+	requests to a request handler, and buffers its responses until they can
+	be sent without blocking. Request handlers use this in place of a socket.
+	"""
+	
+	def __init__(self, socket, client_address, server):
+		"""
+		Dispatch a connection in the server's event loop.
+		"""
+		asyncore.dispatcher.__init__(self, socket, server.socket_map)
+		# Initially there is no data waiting to be sent, and sending has not
+		# blocked
+		self.pending = collections.deque()
+		self.blocked = False
+		self.handler = server.RequestHandlerClass(self, client_address, server)
+	
+	def fileno(self):
+		"""
+		Return the file descriptor of the socket.
+		"""
+		return self.socket.fileno()
+	
+	def recv_into(self, buffer):
+		"""
+		Receive data from the socket into a buffer.
+		"""
+		return self.socket.recv_into(buffer)
+	
+	def sendall(self, data):
+		"""
+		Send data to the socket as soon as possible without blocking.
+		"""
+		self.pending.append(data)
+		self.handle_write()
+	
+	def send_nowait(self, data):
+		"""
+		Send data to the socket as soon as possible without blocking, unless
+		other data is already waiting to be sent, and return the number of
+		bytes accepted. The request handler is told when the waiting data has
+		been sent.
+		"""
+		if not self.handler:
+			return len(data)
+		if self.pending:
+			return 0
+		self.sendall(data)
+		return len(data)
+	
+	def shutdown(self, how):
+		"""
+		Shut down the socket, so the event loop will close the connection.
+		"""
+		self.socket.shutdown(how)
+	
+	def writable(self):
+		"""
+		Return True if there is data waiting to be sent, False otherwise.
+		"""
+		return bool(self.pending)
+	
+	def handle_read(self):
+		"""
+		Receive data and handle every complete request received.
 		"""
-		# Do not receive responses after connection is closed
-		if not self.socket:
-			raise ValueError('operation on closed connection')
-		# Read request from client
 		try:
-			data = self.socket.recv(4096)
+			received = self.handler.reader.fill()
 		except socket.error as e:
-			self.request = None
-			return False
+			if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+				return
+			received = 0
+		if not received:
+			self.handle_close()
+			return
+		try:
+			self.handler.handle_buffered()
+		except NimException as e:
+			self.handle_close()
+	
+	def handle_write(self):
+		"""
+		Send as much waiting data as possible without blocking.
+		"""
+		while self.pending:
+			data = self.pending[0]
+			sent = self.send(data)
+			if sent < len(data):
+				if sent:
+					self.pending[0] = data[sent:]
+				self.blocked = True
+				return
+			self.pending.popleft()
+		# Tell the request handler that the socket is no longer blocked
+		if self.blocked and self.handler:
+			self.blocked = False
+			self.handler.written()
+	
+	def handle_close(self):
+		"""
+		Finish the request handler and close the connection.
+		"""
+		if self.handler:
+			self.handler.finish()
+			self.handler = None
+		self.pending.clear()
+		self.close()
+
+class EpollNimServer(NimServer):
+	"""
+	Extends NimServer to handle every connection in a single thread with an
+	edge-triggered epoll reactor (Linux only). Avoids both the per-connection
+	threads of ThreadingNimServer and the dispatching overhead of
+	AsyncNimServer's asyncore loop.
+	"""
+	
+	# Request handlers are passed requests by the reactor
+	event_driven = True
+	
+	def __init__(self, server_address, RequestHandlerClass):
+		"""
+		Instantiate an epoll Nim server.
+		"""
+		if not hasattr(select, 'epoll'):
+			raise NimException('epoll is not supported on this platform')
+		NimServer.__init__(self, server_address, RequestHandlerClass)
+		# Initially the reactor has no sockets to poll
+		self.epoll = None
+		# Initially the file descriptor:EpollNimConnection map is empty
+		self.connections = {}
+		# Initially the reactor is not running
+		self.running = False
+		self.stopped = threading.Event()
+		self.stopped.set()
+	
+	def listen(self):
+		"""
+		Start listening on the socket for incoming connections.
+		"""
+		NimServer.listen(self)
+		self.socket.setblocking(False)
+		self.epoll = select.epoll()
+		self.epoll.register(self.socket.fileno(), select.EPOLLIN |
+			select.EPOLLET)
+	
+	def serve_forever(self, poll_interval=0.5):
+		"""
+		Handle connections and requests until shutdown() is called.
+		"""
+		self.running = True
+		self.stopped.clear()
+		self.start_reaper()
+		self.start_matchmaker()
+		listener = self.socket.fileno()
+		try:
+			while self.running:
+				try:
+					events = self.epoll.poll(self.next_timeout(poll_interval))
+				except IOError as e:
+					if e.errno == errno.EINTR:
+						continue
+					raise
+				for fd, event in events:
+					if fd == listener:
+						self.accept_all()
+						continue
+					connection = self.connections.get(fd)
+					if connection:
+						connection.handle_event(event)
+				self.run_timers()
+				self.service_actions()
+		finally:
+			self.stopped.set()
+	
+	def service_actions(self):
+		"""
+		Called by the serve_forever() loop after each batch of events is
+		handled. The default implementation does nothing.
+		"""
+	
+	def shutdown(self):
+		"""
+		Stop the serve_forever() loop and wait until it stops.
+		"""
+		self.running = False
+		self.stopped.wait()
+	
+	def server_close(self):
+		"""
+		Close the listening socket and every connection.
+		"""
+		for connection in self.connections.values():
+			connection.close()
+		if self.epoll:
+			self.epoll.close()
+		NimServer.server_close(self)
+	
+	def accept_all(self):
+		"""
+		Accept every pending connection. If the server runs out of file
+		descriptors or buffers, stop polling the listening socket for
+		accept_pause seconds, instead of failing or retrying in a busy loop.
+		"""
+		while True:
+			try:
+				connection, client_address = self.get_request()
+			except socket.error as e:
+				if e.errno == errno.ECONNABORTED:
+					continue
+				if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+					return
+				if e.errno in (errno.EMFILE, errno.ENFILE, errno.ENOBUFS,
+					errno.ENOMEM):
+					self.accept_failed(e)
+					self.epoll.unregister(self.socket.fileno())
+					self.call_later(self.accept_pause, self.resume_accepting)
+					return
+				raise
+			connection.setblocking(False)
+			fd = connection.fileno()
+			self.connections[fd] = EpollNimConnection(connection,
+				client_address, self)
+			self.epoll.register(fd, select.EPOLLIN | select.EPOLLOUT |
+				select.EPOLLET)
+	
+	def resume_accepting(self):
+		"""
+		Poll the listening socket again after a pause, and accept the
+		connections which arrived during it.
+		"""
+		self.epoll.register(self.socket.fileno(), select.EPOLLIN |
+			select.EPOLLET)
+		self.accept_all()
+	
+	def remove_connection(self, connection):
+		"""
+		Stop polling a connection's socket.
+		"""
+		fd = connection.fileno()
+		del self.connections[fd]
+		self.epoll.unregister(fd)
+
+class EpollNimConnection(object):
+	"""
+	Represents a connection to an EpollNimServer. Passes requests to a
+	request handler, and buffers its responses until they can be sent without
+	blocking. Request handlers use this in place of a socket.
+	"""
+	
+	def __init__(self, socket, client_address, server):
+		"""
+		Instantiate a connection and its request handler.
+		"""
+		self.socket = socket
+		self.server = server
+		self.closed = False
+		# Initially there is no data waiting to be sent, and sending has not
+		# blocked
+		self.pending = collections.deque()
+		self.blocked = False
+		self.handler = server.RequestHandlerClass(self, client_address, server)
+	
+	def fileno(self):
+		"""
+		Return the file descriptor of the socket.
+		"""
+		return self.socket.fileno()
+	
+	def recv_into(self, buffer):
+		"""
+		Receive data from the socket into a buffer.
+		"""
+		return self.socket.recv_into(buffer)
+	
+	def sendall(self, data):
+		"""
+		Send data to the socket as soon as possible without blocking.
+		"""
+		self.pending.append(data)
+		self.write()
+	
+	def send_nowait(self, data):
+		"""
+		Send data to the socket as soon as possible without blocking, unless
+		other data is already waiting to be sent, and return the number of
+		bytes accepted. The request handler is told when the waiting data has
+		been sent.
+		"""
+		if self.closed:
+			return len(data)
+		if self.pending:
+			return 0
+		self.sendall(data)
+		return len(data)
+	
+	def shutdown(self, how):
+		"""
+		Shut down the socket, so the reactor will close the connection.
+		"""
+		self.socket.shutdown(how)
+	
+	def handle_event(self, event):
+		"""
+		Respond to the events reported by epoll for the socket.
+		"""
+		if event & select.EPOLLIN:
+			self.read()
+		if event & select.EPOLLOUT:
+			self.write()
+		if event & (select.EPOLLERR | select.EPOLLHUP):
+			self.close()
+	
+	def read(self):
+		"""
+		Receive data until none is left, and handle every complete request
+		received.
+		"""
+		# Edge-triggered polling only reports new data once, so read until
+		# the socket would block
+		while not self.closed:
+			try:
+				received = self.handler.reader.fill()
+			except socket.error as e:
+				if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+					return
+				received = 0
+			if not received:
+				self.close()
+				return
+			try:
+				self.handler.handle_buffered()
+			except NimException as e:
+				self.close()
+	
+	def write(self):
+		"""
+		Send as much waiting data as possible without blocking.
+		"""
+		while self.pending and not self.closed:
+			data = self.pending[0]
+			try:
+				sent = self.socket.send(data)
+			except socket.error as e:
+				if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+					self.blocked = True
+					return
+				self.close()
+				return
+			if sent < len(data):
+				self.pending[0] = data[sent:]
+				self.blocked = True
+				return
+			self.pending.popleft()
+		# Tell the request handler that the socket is no longer blocked
+		if self.blocked and not self.closed:
+			self.blocked = False
+			self.handler.written()
+	
+	def close(self):
+		"""
+		Finish the request handler and close the connection.
+		"""
+		if self.closed:
+			return
+		self.closed = True
+		self.handler.finish()
+		self.pending.clear()
+		self.server.remove_connection(self)
+		self.socket.close()
+
+class BaseNimRequestHandler(SocketServer.BaseRequestHandler):
+	"""
+	Represents a connection to a NimServer. An instance of this class is created
+	for each request.
+	"""
+	
+	# The most seconds a PING request can wait for a message to be queued
+	max_wait = 60
+	
+	# The parameter signature of each method, which subclasses can extend
+	# for methods they add; do_* methods read the parameters converted to it
+	# from self.request.args
+	signatures = methods
+	
+	# The dispatch table of each handler class, built by get_dispatch()
+	dispatch = None
+	
+	def __init__(self, socket, client_address, server):
+		"""
+		Instantiate a Nim request handler and handle requests until finished.
+		Identical to SocketServer.BaseRequestHandler.__init__ except for
+		renaming self.request to self.socket, since self.request is
+		defined in setup() to hold the NimRequest object.
+		"""
+		self.socket = socket
+		self.client_address = client_address
+		self.server = server
+		self.setup()
+		# Event-driven servers call handle_buffered() as requests arrive, and
+		# finish() when the connection is closed
+		if self.server.event_driven:
+			return
+		try:
+			self.handle()
+		finally:
+			self.finish()
+	
+	def setup(self):
+		"""
+		Called before the handle() method to initialize the handler.
+		The default implementation initializes some instance variables
+		and adds a NimUser object to the server.
+		"""
+		# Initialize the client's host and port
+		self.host, self.port = self.client_address
+		# Initially there is no stored NimRequest object
+		self.request = None
+		# Initially there is no stored NimResponse object
+		self.response = None
+		# Frame the requests received from the client
+		self.reader = NimPacketReader(self.socket, NimRequest)
+		# Initially there are no packets waiting to be sent
+		self.outgoing = []
+		# Look up the handler for each method in the class's dispatch table
+		self.dispatch = self.get_dispatch()
+		# Add the user of this connection to the server
+		with self.server.lock:
+			self.user = self.server.add_user(self.socket)
+	
+	def handle(self):
+		"""
+		Service requests by a client until it disconnects.
+		"""
+		# Repeatedly parse and handle client requests until disconnection
+		while self.parse_request():
+			self.handle_one_request()
+	
+	def handle_buffered(self):
+		"""
+		Service every complete request that has been received from the client,
+		without waiting for more. Used by event-driven servers instead of
+		handle(). Raise a NimException if a request is malformed.
+		"""
+		while True:
+			# Pending response to client
+			self.response = None
+			self.request = self.reader.read_buffered()
+			if self.request is None:
+				return
+			self.handle_one_request()
+	
+	@classmethod
+	def get_dispatch(cls):
+		"""
+		Return the dispatch table of the handler class, which maps each method
+		with a do_* method to it and to a decoder of its parameters. The table
+		is built the first time it is needed for each class, so subclasses can
+		add methods just by defining them.
+		"""
+		dispatch = cls.__dict__.get('dispatch')
+		if dispatch is None:
+			dispatch = {}
+			for name in dir(cls):
+				if name.startswith('do_'):
+					method = name[3:]
+					dispatch[method] = (getattr(cls, name).__func__,
+						cls.compile_decoder(cls.signatures.get(method)))
+			cls.dispatch = dispatch
+		return dispatch
+	
+	@staticmethod
+	def compile_decoder(signature):
+		"""
+		Return a function which converts a tuple of parameter strings to the
+		types in a signature, raising a ValueError if there are not as many
+		parameters as types or one cannot be converted. Without a signature,
+		the parameters are left as strings.
+		"""
+		if signature is None:
+			return tuple
+		arity = len(signature)
+		message = 'expected {} parameters'.format(arity)
+		# Parameters which are all strings only need to be counted
+		if all(t is str for t in signature):
+			def decode(params):
+				if len(params) != arity:
+					raise ValueError(message)
+				return params
+		# Nim's methods take at most two parameters, which are converted
+		# directly instead of in a loop
+		elif arity == 1:
+			t0, = signature
+			def decode(params):
+				if len(params) != 1:
+					raise ValueError(message)
+				return (t0(params[0]),)
+		elif arity == 2:
+			t0, t1 = signature
+			def decode(params):
+				if len(params) != 2:
+					raise ValueError(message)
+				return (t0(params[0]), t1(params[1]))
+		else:
+			pairs = list(enumerate(signature))
+			def decode(params):
+				if len(params) != arity:
+					raise ValueError(message)
+				return tuple([t(params[i]) for (i, t) in pairs])
+		return decode
+	
+	def handle_one_request(self):
+		"""
+		Service the parsed request stored in self.request.
+		"""
+		# The user is active until the idle timeout after this request
+		started = self.user.active = time.time()
+		# Answer a waiting PING request before this one
+		if self.user.polling:
+			self.user.answer_poll()
+		request = self.request
+		method = request.method
+		entry = self.dispatch.get(method)
+		# Check that the client supports this version of Nim
+		if request.version > NIM_VERSION:
+			method_method = self.unsupported_version
+		# Check that the request method is supported
+		elif entry is None:
+			method_method = self.unsupported_method
+		else:
+			do_method, decode = entry
+			# Check the request parameters and store them converted to the
+			# method's signature, keeping the strings as they were sent
+			try:
+				request.args = decode(request.params)
+				method_method = do_method.__get__(self)
+			except ValueError as e:
+				method_method = self.invalid_params
+		# Call the appropriate method to handle this request, profiling it if
+		# the server is profiling requests
+		metrics = self.server.metrics
+		profiler = self.server.profiler
+		try:
+			if profiler:
+				profiler.call(method_method)
+			else:
+				method_method()
+		except Exception as e:
+			if metrics:
+				metrics.record_duration.get(method, metrics.record_other)(
+					time.time() - started)
+				metrics.record_error(method)
+			raise NimException(e.message)
+		# Send all the packets for this request at once
+		self.flush()
+		# Record the time taken; send_response() records errors, and
+		# answered() records waiting PING requests when they are answered
+		if self.response is None:
+			return
+		seconds = time.time() - started
+		if metrics:
+			metrics.record_duration.get(method, metrics.record_other)(seconds)
+		self.handled(request, self.response, seconds)
+	
+	def answered(self, request, response, seconds):
+		"""
+		Record a waiting PING request like the requests answered at once,
+		when it is answered with a response after waiting some seconds. This
+		can be called by any thread holding the user's lock, so it only
+		queues records.
+		"""
+		metrics = self.server.metrics
+		if metrics:
+			metrics.record_duration.get(request.method, metrics.record_other)(
+				seconds)
+		self.handled(request, response, seconds)
+	
+	def handled(self, request, response, seconds):
+		"""
+		Called after each request is handled and its response is sent, with
+		the response and the seconds taken to handle it. For a waiting PING
+		request, it is called when the request is answered, possibly by
+		another thread holding the user's lock, so it should not block. The
+		default implementation does nothing.
+		"""
+		pass
+	
+	def written(self):
+		"""
+		Called by the connections of event-driven servers when the data
+		waiting to be sent to a blocked socket has been sent. The default
+		implementation sends the user's messages which were waiting for it.
+		"""
+		self.user.flush()
+	
+	def finish(self):
+		"""
+		Called after the handle() method to clean up after the handler.
+		The default implementation removes the user from the server, if
+		they disconnected without saying goodbye.
+		"""
+		self.server.drop_user(self.user)
+	
+	def parse_request(self):
+		"""
+		Receive a request from the client and store it as a NimRequest object.
+		Return True if the request could be parsed, False otherwise.
+		"""
+		# Do not receive responses after connection is closed
+		if not self.socket:
+			raise ValueError('operation on closed connection')
 		# Pending response to client
 		self.response = None
-		# Store request as parsed NimRequest object, if possible
+		# Read request from client and store it as a parsed NimRequest object,
+		# if possible
 		try:
-			self.request = NimRequest(data)
-			return True
-		except NimException as e:
+			if self.user.polling:
+				self.wait_for_request()
+			self.request = self.reader.read()
+		except (socket.error, NimException) as e:
 			self.request = None
-			return False
+		return self.request is not None
+	
+	def wait_for_request(self):
+		"""
+		Wait until the client sends more data or the user's waiting PING
+		request times out, then answer the PING request. Used by servers
+		which are not event-driven.
+		"""
+		deadline = self.user.polling
+		# Do not wait if the next request has already been received
+		if self.reader.start == self.reader.end and deadline:
+			select.select([self.socket], [], [], max(0,
+				deadline - time.time()))
+		self.user.answer_poll()
 	
 	def send_response(self, status, body='', headers=None):
 		"""
-		Send a response to the client and store it as a NimResponse object.
-		Return True if the response could be parsed, False otherwise.
+		Queue a response to be sent to the client by the next flush() call,
+		and store it as a NimResponse object.
 		"""
 		# Do not send responses after connection is closed
 		if not self.socket:
 			raise ValueError('operation on closed connection')
-		# Check if the user has queued messages to be sent first
+		# Check if the user has queued messages to be sent first, unless they
+		# are pushed to the user
 		this_user = self.server.get_user(self.socket)
-		if this_user.queue:
-			self.send_response(CONTINUED, this_user.dequeue())
-		# Check that status code is valid
-		if status not in responses:
-			raise ValueError('no such status: {}'.format(status))
-		reason = responses[status]
-		# Convert header dictionary to CRLF-separated string
-		headers = headers or dict()
-		headers['Content-Length'] = len(body)
-		headers = ''.join("{}: {}\r\n".format(h, headers[h]) for h in headers)
+		if this_user.queue and not this_user.pushing:
+			self.outgoing.append(NimResponse.compose(CONTINUED,
+				this_user.dequeue()).data)
+		# Record errors answering requests, if the server collects metrics
+		if status >= ERROR and self.request and self.server.metrics:
+			self.server.metrics.record_error(self.request.method)
 		# Send constructed packet to client
-		data = 'NIM/{} {} {}\r\n{}\r\n{}'.format(NIM_VERSION, status,
-			reason, headers, body)
-		try:
-			self.socket.sendall(data)
-		except socket.error as e:
-			raise NimException(e.strerror)
+		response = NimResponse.compose(status, body, headers)
+		self.outgoing.append(response.data)
 		# Wait for request from client
 		self.request = None
-		# Store response as parsed NimResponse object, if possible
+		# Store response
+		self.response = response
+	
+	def flush(self):
+		"""
+		Send all the packets queued by send_response() to the client in a
+		single write.
+		"""
+		if not self.outgoing:
+			return
+		data = ''.join(self.outgoing)
+		del self.outgoing[:]
+		user = self.user
+		# Do not interleave with messages pushed to the user by other
+		# request handlers, and send the ones waiting to be sent first
 		try:
-			self.response = NimResponse(data)
-			return True
-		except NimException as e:
-			self.response = None
-			return False
+			with user.write_lock:
+				# Leave the pushed messages in the user's queue while the
+				# connection is blocked, so that its buffer stays bounded
+				if not getattr(self.socket, 'blocked', False):
+					with user.lock:
+						data = user.take_output() + data
+				self.socket.sendall(data)
+		except socket.error as e:
+			raise NimException(e.strerror)
+		# Push the messages queued while the socket was being written to
+		user.flush()
 	
 	def unsupported_version(self):
 		"""
@@ -438,6 +2160,31 @@ class BaseNimRequestHandler(SocketServer.BaseRequestHandler):
 		self.send_response(NOT_IMPLEMENTED,
 			'Unsupported method ({})'.format(self.request.method))
 	
+	def get_paging(self, cursor_type=str):
+		"""
+		Return the request's After header, converted to a type, and its Limit
+		header, as a number, or None for each which is not given. Raise a
+		ValueError if either is invalid.
+		"""
+		after = self.request.getheader('After')
+		limit = self.request.getheader('Limit')
+		if after is not None:
+			after = cursor_type(after)
+		if limit is not None:
+			limit = int(limit)
+			if limit < 1:
+				raise ValueError('limit must be positive')
+		return (after, limit)
+	
+	def invalid_params(self):
+		"""
+		Respond to a request with the wrong number or types of parameters.
+		"""
+		signature = self.signatures.get(self.request.method, ())
+		self.send_response(ERROR, 'Invalid parameters for {} (expected {})'
+			.format(self.request.method, ' '.join(t.__name__ for t in signature)
+			or 'none'))
+	
 	def do_LOGIN(self):
 		"""
 		Respond to a LOGIN request.
@@ -448,15 +2195,25 @@ class BaseNimRequestHandler(SocketServer.BaseRequestHandler):
 			self.send_response(METHOD_NOT_ALLOWED,
 				'You are already logged in!')
 			return
-		new_name = self.request.params[0]
-		# Check that the requested username is available
-		if self.server.username_taken(new_name):
-			self.send_response(IMPOSSIBLE,
-				"The username '{}' is already taken!".format(new_name))
-			return
-		# Log the user in with the requested username
-		self.server.name_user(this_user, new_name)
-		self.send_response(HELLO, 'Hello, {}!'.format(new_name))
+		new_name = self.request.args[0]
+		with self.server.lock:
+			# Check that the requested username is available
+			if self.server.username_taken(new_name):
+				self.send_response(IMPOSSIBLE,
+					"The username '{}' is already taken!".format(new_name))
+				return
+			# Log the user in with the requested username
+			self.server.name_user(this_user, new_name)
+		# Push messages to the user from now on if they asked for it
+		headers = {}
+		if self.request.getheader('Push') == 'on':
+			this_user.start_pushing()
+			headers['Push'] = 'on'
+		# Describe moves to the user as deltas if they asked for it
+		if self.request.getheader('Updates') == 'delta':
+			this_user.delta = True
+			headers['Updates'] = 'delta'
+		self.send_response(HELLO, 'Hello, {}!'.format(new_name), headers)
 	
 	def do_REMOVE(self):
 		"""
@@ -469,70 +2226,92 @@ class BaseNimRequestHandler(SocketServer.BaseRequestHandler):
 			self.send_response(METHOD_NOT_ALLOWED,
 				'You are not playing a game!')
 			return
-		n, s = self.request.params
-		# Attempt to make the move
-		status, body = this_game.move(this_user, n, s)
-		self.send_response(status, body)
-		# Notify the opponent and observers of the move
-		if status < ERROR:
-			opponent = this_game.playing
-			opponent.enqueue(body)
-			for observer in this_game.all_observers():
-				observer.enqueue(body)
+		n, s = self.request.args
+		recipients = ()
+		with this_game.lock:
+			# Check that the game did not end before it could be locked
+			if this_game.over:
+				self.send_response(METHOD_NOT_ALLOWED,
+					'You are not playing a game!')
+				return
+			# Attempt to make the move
+			status, body = this_game.move(this_user, n, s)
+			delta = this_game.get_delta(s) if status < ERROR else None
+			self.send_response(status, delta if this_user.delta and delta
+				else body)
+			# Notify the opponent and observers of the move
+			if status < ERROR:
+				recipients = this_game.broadcast(body, (this_game.playing,),
+					delta, True)
 		# Check if the move ended the game
 		if status == END_GAME:
-			self.server.end_game(this_game)
+			with self.server.lock:
+				self.server.end_game(this_game)
+		# Send the notifications now that no locks are held
+		for user in recipients:
+			user.flush()
 	
 	def do_BYE(self):
 		"""
 		Respond to a BYE request.
 		"""
 		try:
-			this_user = self.server.get_user(self.socket)
-			this_name = this_user.name or ''
+			this_name = self.user.name or ''
 			self.send_response(BYE, 'Goodbye{}!'.format(', ' +
 				this_name if this_name else ''))
 		finally:
-			this_user = self.server.get_user(self.socket)
-			this_game = this_user.game
-			# Check if the user was playing a game
-			if this_game:
-				# Notify the opponent and observers of the departure
-				message = '{} has quit.'.format(this_user.name)
-				this_game.player1.enqueue(message)
-				this_game.player2.enqueue(message)
-				for observer in this_game.all_observers():
-					observer.enqueue(message)
-				# End the game
-				self.server.end_game(this_game)
-			# Remove user from server
-			self.server.remove_user(this_user)
+			# Remove user from server, ending their game
+			self.server.drop_user(self.user)
 	
 	def do_GAMES(self):
 		"""
 		Respond to a GAMES request.
 		"""
-		games = []
-		# List all the ongoing games, if any
-		for game in self.server.all_games():
-			games.append('{} - {} vs. {}'.format(game.id,
-				game.player1.name, game.player2.name))
-		if not games:
-			games.append('There are no ongoing games.')
-		self.send_response(OK, "\n".join(games))
+		# List only the games after an ID and within a limit, if asked to
+		try:
+			after, limit = self.get_paging(int)
+		except ValueError as e:
+			self.send_response(ERROR, 'Invalid After or Limit header!')
+			return
+		# List all the ongoing games, if any, unless they have not changed
+		# since the revision the client last listed
+		with self.server.lock.shared:
+			revision = self.server.revision
+			if self.request.getheader('If-Revision') == str(revision):
+				page = None
+			else:
+				page = self.server.games_page(after, limit)
+		headers = {'Revision': revision}
+		if not page:
+			self.send_response(NOT_MODIFIED, '', headers)
+			return
+		body, next = page
+		# Tell the client where the next page of games starts
+		if next is not None:
+			headers['Next'] = next
+		self.send_response(OK, body, headers)
 	
 	def do_WHO(self):
 		"""
 		Respond to a WHO request.
 		"""
-		players = []
-		# List all the logged-in users available to play a game, if any
-		for player in self.server.all_users(logged_in=True, available=True):
-			if player.socket != self.socket:
-				players.append(player.name)
+		# List only the players whose names start with a prefix, come after a
+		# name, and fit within a limit, if asked to
+		prefix = self.request.getheader('Prefix', '')
+		try:
+			after, limit = self.get_paging()
+		except ValueError as e:
+			self.send_response(ERROR, 'Invalid After or Limit header!')
+			return
+		# List the logged-in users available to play a game, if any
+		with self.server.lock.shared:
+			players, more = self.server.available_users(prefix, after, limit,
+				self.user.name)
+		# Tell the client where the next page of players starts
+		headers = {'Next': players[-1]} if more else None
 		if not players:
 			players.append('There are no available players.')
-		self.send_response(OK, "\n".join(players))
+		self.send_response(OK, "\n".join(players), headers)
 	
 	def do_PLAY(self):
 		"""
@@ -544,78 +2323,128 @@ class BaseNimRequestHandler(SocketServer.BaseRequestHandler):
 			self.send_response(METHOD_NOT_ALLOWED,
 				'You are not logged in!')
 			return
-		# Check that the user is not already playing a game
-		if this_user.game:
+		opponent_name = self.request.args[0]
+		with self.server.lock:
+			# Check that the user is not already playing a game
+			if this_user.game:
+				self.send_response(METHOD_NOT_ALLOWED,
+					'You are already playing a game!')
+				return
+			opponent = self.server.get_user_named(opponent_name)
+			# Check that the requested opponent exists
+			if not opponent:
+				self.send_response(NOT_FOUND,
+					'There is no user named {}!'.format(opponent_name))
+				return
+			# Check that the requested opponent is not the user
+			if opponent is this_user:
+				self.send_response(FORBIDDEN,
+					'You cannot play with yourself!')
+				return
+			# Check that the requested opponent is not already playing a game
+			if opponent.game:
+				self.send_response(IMPOSSIBLE,
+					'{} is not available to play!'.format(opponent_name))
+				return
+			# Start a game between the user and opponent
+			new_game = self.server.start_game(this_user, opponent)
+		self.send_response(BEGIN_GAME, new_game.get_start(this_user))
+		# Notify the opponent of the game
+		opponent.enqueue(new_game.get_start(opponent))
+		opponent.flush()
+	
+	def do_MATCH(self):
+		"""
+		Respond to a MATCH request.
+		"""
+		this_user = self.user
+		# Check that the user is logged in
+		if not this_user.name:
 			self.send_response(METHOD_NOT_ALLOWED,
-				'You are already playing a game!')
+				'You are not logged in!')
 			return
-		opponent_name = self.request.params[0]
-		opponent = self.server.get_user_named(opponent_name)
-		# Check that the requested opponent exists
-		if not opponent:
-			self.send_response(NOT_FOUND,
-				'There is no user named {}!'.format(opponent_name))
-			return
-		# Check that the requested opponent is not the user
-		if opponent is this_user:
-			self.send_response(FORBIDDEN,
-				'You cannot play with yourself!')
-			return
-		# Check that the requested opponent is not already playing a game
-		if opponent.game:
-			self.send_response(IMPOSSIBLE,
-				'{} is not available to play!'.format(opponent_name))
-			return
-		# Start a game between the user and opponent
-		new_game = self.server.start_game(this_user, opponent)
-		body = new_game.get_state()
-		self.send_response(BEGIN_GAME, body)
-		# Notify the opponent of the game
-		opponent.enqueue(body)
+		# Match the user with opponents near their rating, if they gave one
+		try:
+			rating = self.request.getheader('Rating')
+			rating = int(rating) if rating is not None else None
+		except ValueError as e:
+			self.send_response(ERROR, 'Invalid Rating header!')
+			return
+		with self.server.lock:
+			# Check that the user is not already playing a game
+			if this_user.game:
+				self.send_response(METHOD_NOT_ALLOWED,
+					'You are already playing a game!')
+				return
+			# Check that the user is not already waiting for a match
+			if this_user in self.server.matchmaker:
+				self.send_response(IMPOSSIBLE,
+					'You are already waiting for an opponent!')
+				return
+			# Start a game with a waiting user, or wait for one
+			new_game = self.server.match_user(this_user, rating)
+		if not new_game:
+			self.send_response(OK, 'You are waiting for an opponent.')
+			return
+		self.send_response(BEGIN_GAME, new_game.get_start(this_user))
+		# Notify the opponent, who moves first, of the game
+		new_game.player1.enqueue(new_game.get_start(new_game.player1))
+		new_game.player1.flush()
 	
 	def do_OBSERVE(self):
 		"""
 		Respond to an OBSERVE request.
 		"""
-		id = self.request.params[0]
+		id = self.request.args[0]
 		game = self.server.get_game(id)
 		# Check that the requested game exists
 		if not game:
 			self.send_response(NOT_FOUND, 'There is no game {}!'.format(id))
 			return
 		this_user = self.server.get_user(self.socket)
-		# Check that the user is not already observing the game
-		if game.is_observing(this_user):
-			self.send_response(IMPOSSIBLE,
-				'You are already observing game {}!'.format(id))
-			return
-		# Check that the user is not playing the requested game
-		if game.is_playing(this_user):
-			self.send_response(FORBIDDEN,
-				'You cannot observe your own game!')
-			return
-		# Add the user as an observer of the game
-		game.add_observer(this_user)
-		self.send_response(OK, 'You are observing game {}.'.format(id))
+		with game.lock:
+			# Check that the game did not end before it could be locked
+			if game.over:
+				self.send_response(NOT_FOUND,
+					'There is no game {}!'.format(id))
+				return
+			# Check that the user is not already observing the game
+			if game.is_observing(this_user):
+				self.send_response(IMPOSSIBLE,
+					'You are already observing game {}!'.format(id))
+				return
+			# Check that the user is not playing the requested game
+			if game.is_playing(this_user):
+				self.send_response(FORBIDDEN,
+					'You cannot observe your own game!')
+				return
+			# Add the user as an observer of the game
+			game.add_observer(this_user)
+			body = 'You are observing game {}.'.format(id)
+			# Start users who are sent deltas with a snapshot of the game
+			if this_user.delta:
+				body += "\n" + game.get_snapshot()
+		self.send_response(OK, body)
 	
 	def do_UNOBSERVE(self):
 		"""
 		Respond to an UNOBSERVE request.
 		"""
-		id = self.request.params[0]
+		id = self.request.args[0]
 		game = self.server.get_game(id)
 		# Check that the requested game exists
 		if not game:
 			self.send_response(NOT_FOUND, 'There is no game {}!'.format(id))
 			return
 		this_user = self.server.get_user(self.socket)
-		# Check that the user is observing the game
-		if not game.is_observing(this_user):
-			self.send_response(IMPOSSIBLE,
-				'You are not observing game {}!'.format(id))
-			return
-		# Remove the user as an observer of the game
-		game.remove_observer(this_user)
+		with game.lock:
+			# Check that the user is observing the game
+			if not game.is_observing(this_user):
+				self.send_response(IMPOSSIBLE,
+					'You are not observing game {}!'.format(id))
+				return
+			# Remove the user as an observer of the game
+			game.remove_observer(this_user)
 		self.send_response(OK, 'You are no longer observing game {}.'.format(id))
 	
 	def do_PING(self):
@@ -623,5 +2452,572 @@ class BaseNimRequestHandler(SocketServer.BaseRequestHandler):
 		Respond to a PING request.
 		"""
 		this_user = self.server.get_user(self.socket)
+		# Wait for a message to be queued, if asked to and none are queued
+		try:
+			wait = min(float(self.request.getheader('Wait', 0)), self.max_wait)
+		except ValueError as e:
+			wait = 0
+		if wait > 0:
+			with this_user.lock:
+				if not this_user.queue:
+					# The request will be answered by the next enqueue() call,
+					# the next request, or the timeout
+					deadline = this_user.polling = time.time() + wait
+					this_user.poll_request = (self, self.request,
+						this_user.active)
+					if self.server.event_driven:
+						self.server.call_later(wait, this_user.answer_poll,
+							deadline)
+					return
 		# Remove the response message from the user's queue
 		self.send_response(OK, this_user.dequeue())
+	
+	def do_STATS(self):
+		"""
+		Respond to a STATS request.
+		"""
+		# Check that the server collects metrics
+		if not self.server.metrics:
+			self.send_response(NOT_IMPLEMENTED,
+				'This server does not collect statistics.')
+			return
+		self.send_response(OK, self.server.metrics.summary(self.server))
+	
+	def do_SYNC(self):
+		"""
+		Respond to a SYNC request.
+		"""
+		id = self.request.args[0]
+		game = self.server.get_game(id)
+		# Check that the requested game exists
+		if not game:
+			self.send_response(NOT_FOUND, 'There is no game {}!'.format(id))
+			return
+		with game.lock:
+			# Check that the game did not end before it could be locked
+			if game.over:
+				self.send_response(NOT_FOUND,
+					'There is no game {}!'.format(id))
+				return
+			# Send a snapshot of the game, which later deltas apply to
+			snapshot = game.get_snapshot()
+		self.send_response(OK, snapshot)
+
+class FrontEndNimServer(EpollNimServer):
+	"""
+	Extends EpollNimServer with front-end worker processes, which spread the
+	work of accepting connections, framing requests and writing responses
+	over several processor cores. The workers all listen on the same port
+	with SO_REUSEPORT (Linux only), and forward each complete request to this
+	process, which owns all the users and games and handles every request;
+	the responses are sent back through the workers. This is not a scale-out
+	mode: handling requests, which is most of the work, still uses a single
+	core, and each request takes an extra hop through a channel. It is not
+	one of nimserver.py's engines, and nimbench.py only benchmarks it when
+	asked to, until it shows a throughput gain.
+	"""
+	
+	def __init__(self, server_address, RequestHandlerClass, workers=None):
+		"""
+		Instantiate a Nim server with a number of front-end worker processes,
+		by default one for each processor.
+		"""
+		if not hasattr(socket, 'SO_REUSEPORT'):
+			raise NimException('SO_REUSEPORT is not supported on this platform')
+		EpollNimServer.__init__(self, server_address, RequestHandlerClass)
+		self.workers = workers or multiprocessing.cpu_count()
+		# Initially there are no worker processes
+		self.processes = []
+	
+	def server_bind(self):
+		"""
+		Bind the socket to the server address, allowing the worker processes
+		to bind to it as well.
+		"""
+		self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+		EpollNimServer.server_bind(self)
+	
+	def listen(self):
+		"""
+		Start the worker processes, and wait until they are all listening
+		for incoming connections.
+		"""
+		# This process does not listen itself; its socket only reserves the
+		# server address for the workers
+		self.epoll = select.epoll()
+		for _ in range(self.workers):
+			channel, worker_channel = socket.socketpair()
+			process = multiprocessing.Process(target=self.run_worker,
+				args=(worker_channel, channel))
+			process.daemon = True
+			process.start()
+			worker_channel.close()
+			self.processes.append(process)
+			# Wait for the worker to send its first message
+			if not NimChannel.receive_ready(channel):
+				raise NimException('unable to start worker process')
+			channel = NimChannel(channel, self, self.handle_message)
+			fd = channel.fileno()
+			self.connections[fd] = channel
+			self.epoll.register(fd, select.EPOLLIN | select.EPOLLOUT |
+				select.EPOLLET)
+	
+	def run_worker(self, channel, other_end):
+		"""
+		Accept connections and forward their requests in a worker process,
+		until this process closes its end of the channel to it.
+		"""
+		# The worker stops when this process closes the channel, not when
+		# interrupted
+		signal.signal(signal.SIGINT, signal.SIG_IGN)
+		# Close the sockets of this process inherited by the worker
+		other_end.close()
+		self.socket.close()
+		self.epoll.close()
+		for connection in self.connections.values():
+			connection.socket.close()
+		worker = NimWorkerServer(self.server_address, channel)
+		worker.listen()
+		try:
+			worker.serve_forever()
+		finally:
+			worker.server_close()
+	
+	def service_actions(self):
+		"""
+		Send the messages queued for the worker processes.
+		"""
+		for channel in self.connections.values():
+			channel.flush()
+	
+	def server_close(self):
+		"""
+		Close the channels to the worker processes, which stops them, and
+		close the socket.
+		"""
+		EpollNimServer.server_close(self)
+		for process in self.processes:
+			process.join(1)
+			if process.is_alive():
+				process.terminate()
+		self.processes = []
+	
+	def handle_message(self, channel, id, kind, data):
+		"""
+		Respond to a message about a client connection from a worker process.
+		"""
+		# A worker has accepted a new connection
+		if kind == NimChannel.OPEN:
+			host, _, port = data.rpartition(':')
+			channel.clients[id] = NimProxyConnection(channel, id,
+				(host, int(port)), self)
+			return
+		# The channel to a worker has been closed
+		if not id:
+			for connection in channel.clients.values():
+				connection.close()
+			return
+		connection = channel.clients.get(id)
+		if not connection:
+			return
+		# A worker has received requests
+		if kind == NimChannel.DATA:
+			connection.receive(data)
+		# A worker has sent data to a client
+		elif kind == NimChannel.WRITTEN:
+			connection.acknowledge(int(data))
+		# A client has disconnected from a worker
+		elif kind == NimChannel.CLOSE:
+			connection.close()
+
+class NimWorkerServer(EpollNimServer):
+	"""
+	Represents a worker process of a FrontEndNimServer. Accepts connections
+	and frames requests like EpollNimServer, but forwards them to the
+	FrontEndNimServer through a channel instead of handling them.
+	"""
+	
+	# The FrontEndNimServer collects the metrics of the requests it handles
+	collect_metrics = False
+	
+	def __init__(self, server_address, channel):
+		"""
+		Instantiate a worker of the FrontEndNimServer at an address, connected
+		to it by a channel socket.
+		"""
+		EpollNimServer.__init__(self, server_address, NimWorkerRequestHandler)
+		self.channel = NimChannel(channel, self, self.handle_message)
+		# The ID of the next connection to be accepted
+		self.next_client = 1
+	
+	def server_bind(self):
+		"""
+		Bind the socket to the same address as the FrontEndNimServer and the
+		other workers.
+		"""
+		self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+		EpollNimServer.server_bind(self)
+	
+	def listen(self):
+		"""
+		Start listening on the socket for incoming connections, and on the
+		channel for messages.
+		"""
+		EpollNimServer.listen(self)
+		# Tell the FrontEndNimServer that this worker is listening
+		self.channel.send_ready()
+		fd = self.channel.fileno()
+		self.connections[fd] = self.channel
+		self.epoll.register(fd, select.EPOLLIN | select.EPOLLOUT |
+			select.EPOLLET)
+	
+	def service_actions(self):
+		"""
+		Send the messages queued for the FrontEndNimServer.
+		"""
+		self.channel.flush()
+	
+	def handle_message(self, channel, id, kind, data):
+		"""
+		Respond to a message about a client connection from the
+		FrontEndNimServer.
+		"""
+		# Stop when the channel is closed
+		if not id:
+			self.running = False
+			return
+		connection = channel.clients.get(id)
+		if not connection:
+			return
+		if kind == NimChannel.DATA:
+			connection.handler.forward(data)
+		elif kind == NimChannel.CLOSE:
+			connection.close()
+
+class NimWorkerRequestHandler(BaseNimRequestHandler):
+	"""
+	Forwards the complete requests received by a NimWorkerServer connection
+	to the FrontEndNimServer, without parsing them.
+	"""
+	
+	def setup(self):
+		"""
+		Tell the FrontEndNimServer about the new connection.
+		"""
+		self.reader = NimPacketReader(self.socket, NimRequest)
+		self.channel = self.server.channel
+		# Initially no forwarded data has been sent without being
+		# acknowledged
+		self.unacknowledged = 0
+		self.id = self.server.next_client
+		self.server.next_client += 1
+		self.channel.clients[self.id] = self.socket
+		self.channel.send(self.id, NimChannel.OPEN,
+			'{}:{}'.format(*self.client_address[:2]))
+	
+	def handle_buffered(self):
+		"""
+		Forward every complete request that has been received from the client
+		in a single message. Raise a NimException if a request's headers are
+		too large.
+		"""
+		packets = []
+		while True:
+			data = self.reader.next_packet()
+			if data is None:
+				break
+			packets.append(data)
+		if packets:
+			self.channel.send(self.id, NimChannel.DATA, ''.join(packets))
+	
+	def forward(self, data):
+		"""
+		Send data forwarded by the FrontEndNimServer to the client.
+		"""
+		self.socket.sendall(data)
+		self.unacknowledged += len(data)
+		self.written()
+	
+	def written(self):
+		"""
+		Once no forwarded data is waiting to be sent to the client, tell the
+		FrontEndNimServer how much has been sent since it was last told, if it
+		is at least half of the channel's window, so that it can forward more
+		of the messages pushed to the client.
+		"""
+		if (self.unacknowledged >= NimChannel.window // 2 and
+			not self.socket.pending):
+			self.channel.send(self.id, NimChannel.WRITTEN,
+				str(self.unacknowledged))
+			self.unacknowledged = 0
+	
+	def finish(self):
+		"""
+		Tell the FrontEndNimServer that the connection was closed.
+		"""
+		if self.channel.clients.pop(self.id, None):
+			self.channel.send(self.id, NimChannel.CLOSE)
+
+class NimProxyConnection(object):
+	"""
+	Represents a connection to a FrontEndNimServer through one of its worker
+	processes. Passes the requests forwarded by the worker to a request
+	handler, and sends its responses back through the worker. Request handlers
+	use this in place of a socket.
+	"""
+	
+	def __init__(self, channel, id, client_address, server):
+		"""
+		Instantiate a connection and its request handler.
+		"""
+		self.channel = channel
+		self.id = id
+		self.closed = False
+		# Initially there is no forwarded data waiting to be read
+		self.received = collections.deque()
+		# Initially no data has been sent to the worker without the worker
+		# acknowledging that it was sent to the client
+		self.unacknowledged = 0
+		self.blocked = False
+		self.handler = server.RequestHandlerClass(self, client_address, server)
+	
+	def fileno(self):
+		"""
+		Return the ID of the connection in its worker, since the socket
+		belongs to the worker process.
+		"""
+		return self.id
+	
+	def recv_into(self, buffer):
+		"""
+		Copy forwarded data into a buffer.
+		"""
+		data = self.received[0]
+		n = min(len(buffer), len(data))
+		buffer[:n] = data[:n]
+		if n < len(data):
+			self.received[0] = data[n:]
+		else:
+			self.received.popleft()
+		return n
+	
+	def sendall(self, data):
+		"""
+		Send data to the client through the worker.
+		"""
+		if not self.closed:
+			self.channel.send(self.id, NimChannel.DATA, data)
+			self.unacknowledged += len(data)
+			self.blocked = self.unacknowledged >= NimChannel.window
+	
+	def send_nowait(self, data):
+		"""
+		Send data to the client through the worker, unless the channel's
+		window of data has been sent without the worker acknowledging it, and
+		return the number of bytes accepted. The request handler is told when
+		the worker acknowledges the data.
+		"""
+		if self.closed:
+			return len(data)
+		if self.blocked:
+			return 0
+		self.sendall(data)
+		return len(data)
+	
+	def acknowledge(self, sent):
+		"""
+		Record that the worker sent some bytes of data to the client, and
+		tell the request handler if it can send more.
+		"""
+		self.unacknowledged -= sent
+		if self.blocked and self.unacknowledged < NimChannel.window:
+			self.blocked = False
+			self.handler.written()
+	
+	def shutdown(self, how):
+		"""
+		Close the connection, since the socket belongs to the worker.
+		"""
+		self.close()
+	
+	def receive(self, data):
+		"""
+		Handle every complete request in data forwarded by the worker.
+		"""
+		self.received.append(data)
+		while self.received and not self.closed:
+			self.handler.reader.fill()
+			try:
+				self.handler.handle_buffered()
+			except NimException as e:
+				self.close()
+	
+	def close(self):
+		"""
+		Finish the request handler and tell the worker to close the
+		connection.
+		"""
+		if self.closed:
+			return
+		self.closed = True
+		self.handler.finish()
+		self.received.clear()
+		del self.channel.clients[self.id]
+		self.channel.send(self.id, NimChannel.CLOSE)
+
+class NimChannel(object):
+	"""
+	Carries messages about client connections between a FrontEndNimServer
+	and one of its workers over a Unix socket. Each message is a header with
+	the connection's ID, the kind of message and the length of its data,
+	followed by the data. Messages are queued by send() and sent together by
+	flush(). Workers acknowledge the data sent to their clients with WRITTEN
+	messages, so that data pushed to slow clients waits in their users'
+	queues instead of the workers' buffers.
+	"""
+	
+	# The format of message headers
+	header = struct.Struct('!IBI')
+	
+	# The kinds of messages
+	OPEN, DATA, CLOSE, READY, WRITTEN = range(5)
+	
+	# The most bytes which are forwarded to a client without its worker
+	# acknowledging that they were sent, before messages pushed to the client
+	# are left in its user's queue
+	window = 64 * 1024
+	
+	def __init__(self, socket, server, handle_message):
+		"""
+		Instantiate a channel which calls handle_message(channel, id, kind,
+		data) for each message received, and with an ID of 0 when closed.
+		"""
+		self.socket = socket
+		self.socket.setblocking(False)
+		self.server = server
+		self.handle_message = handle_message
+		self.closed = False
+		# Initially the ID:connection map is empty
+		self.clients = {}
+		# Initially no data has been received
+		self.buffer = bytearray()
+		# Initially there are no messages waiting to be sent
+		self.queued = []
+		self.pending = collections.deque()
+	
+	@classmethod
+	def receive_ready(cls, socket):
+		"""
+		Wait for a worker to send a READY message on a blocking socket.
+		Return True if it did, False otherwise.
+		"""
+		data = ''
+		while len(data) < cls.header.size:
+			received = socket.recv(cls.header.size - len(data))
+			if not received:
+				return False
+			data += received
+		return cls.header.unpack(data)[1] == cls.READY
+	
+	def send_ready(self):
+		"""
+		Tell the FrontEndNimServer that the worker is ready.
+		"""
+		self.socket.setblocking(True)
+		self.socket.sendall(self.header.pack(0, self.READY, 0))
+		self.socket.setblocking(False)
+	
+	def fileno(self):
+		"""
+		Return the file descriptor of the socket.
+		"""
+		return self.socket.fileno()
+	
+	def send(self, id, kind, data=''):
+		"""
+		Queue a message to be sent by the next flush() call.
+		"""
+		if self.closed:
+			return
+		self.queued.append(self.header.pack(id, kind, len(data)))
+		if data:
+			self.queued.append(data)
+	
+	def handle_event(self, event):
+		"""
+		Respond to the events reported by epoll for the socket.
+		"""
+		if event & select.EPOLLIN:
+			self.read()
+		if event & select.EPOLLOUT:
+			self.write()
+		if event & (select.EPOLLERR | select.EPOLLHUP):
+			self.close()
+	
+	def read(self):
+		"""
+		Receive data until none is left, and handle every complete message
+		received.
+		"""
+		while not self.closed:
+			try:
+				data = self.socket.recv(65536)
+			except socket.error as e:
+				if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+					return
+				data = ''
+			if not data:
+				self.close()
+				return
+			self.buffer += data
+			# Handle each complete message
+			start = 0
+			while len(self.buffer) - start >= self.header.size:
+				id, kind, length = self.header.unpack_from(self.buffer, start)
+				end = start + self.header.size + length
+				if end > len(self.buffer):
+					break
+				data = str(self.buffer[start+self.header.size:end])
+				start = end
+				self.handle_message(self, id, kind, data)
+			del self.buffer[:start]
+	
+	def flush(self):
+		"""
+		Send every queued message as soon as possible without blocking.
+		"""
+		if self.queued:
+			self.pending.append(''.join(self.queued))
+			self.queued = []
+			self.write()
+	
+	def write(self):
+		"""
+		Send as much waiting data as possible without blocking.
+		"""
+		while self.pending and not self.closed:
+			data = self.pending[0]
+			try:
+				sent = self.socket.send(data)
+			except socket.error as e:
+				if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+					return
+				self.close()
+				return
+			if sent < len(data):
+				self.pending[0] = data[sent:]
+				return
+			self.pending.popleft()
+	
+	def close(self):
+		"""
+		Close the channel and tell its owner.
+		"""
+		if self.closed:
+			return
+		self.closed = True
+		self.queued = []
+		self.pending.clear()
+		self.server.remove_connection(self)
+		self.socket.close()
+		self.handle_message(self, 0, self.CLOSE, '')
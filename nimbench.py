@@ -0,0 +1,414 @@
+#!/usr/bin/env python
+
+# Remy Oukaour, 107122849
+# CSE 310, Group 2
+
+"""
+Usage: nimbench.py [-h|--help] [-e|--engine ENGINE [ENGINE ...]]
+	[-c|--clients CLIENTS] [-w|--workers WORKERS] [-d|--duration SECONDS]
+	[--warmup SECONDS] [-r|--rate RATE] [-g|--games GAMES]
+	[-o|--output FILE]
+
+This is a load generator for the Nim server. It starts a local server with
+each engine, and drives simulated clients through NimClient connections:
+pairs of players who log in, look for each other, play games and wait for
+each other's moves, with an observer watching each game. It reports the
+throughput and latency percentiles of each method.
+
+By default, each client sends its next request as soon as it has a response
+to the last one (a closed loop). Given a rate, requests are instead sent on a
+fixed schedule (an open loop), and their latency is measured from when they
+were scheduled to be sent, so that a stalled server is charged for the
+requests it delayed, instead of omitting them.
+"""
+
+from __future__ import print_function
+
+import argparse
+import collections
+import json
+import math
+import multiprocessing
+import os
+import random
+import re
+import signal
+import socket
+import sys
+import threading
+import time
+from nim.nimlib import *
+from nim.client import *
+from nim.server import *
+
+# The server classes which can be benchmarked; the frontend engine is only
+# benchmarked when asked for, since it is not offered by nimserver.py until
+# it shows a throughput gain
+engines = {
+	'threading': ThreadingNimServer,
+	'async': AsyncNimServer,
+	'epoll': EpollNimServer,
+	'frontend': FrontEndNimServer
+}
+
+# The methods in the order they are reported
+report_order = ['LOGIN', 'WHO', 'PLAY', 'OBSERVE', 'REMOVE', 'PING', 'BYE']
+
+# The percentiles reported for each method
+percentiles = [('p50', 0.5), ('p95', 0.95), ('p99', 0.99), ('p999', 0.999)]
+
+# The format of the snapshot line in a PLAY response for a delta client
+snapshot_regex = re.compile(r'^snapshot ([0-9]+) [0-9]+((?: [0-9]+)+)$',
+	re.MULTILINE)
+
+class Recorder(object):
+	"""
+	Records the latency of each request, and whether it failed, for requests
+	scheduled to be sent during the measured interval.
+	"""
+	
+	def __init__(self, start, end):
+		"""
+		Instantiate a recorder which measures requests scheduled from start
+		until end.
+		"""
+		self.start = start
+		self.end = end
+		# The latencies of the requests of each method
+		self.latencies = collections.defaultdict(list)
+		# The number of failed requests of each method
+		self.errors = collections.Counter()
+	
+	def record(self, method, scheduled, finished, error):
+		"""
+		Record a request scheduled at one time which finished at another.
+		"""
+		if not self.start <= scheduled < self.end:
+			return
+		self.latencies[method].append(finished - scheduled)
+		if error:
+			self.errors[method] += 1
+
+class Schedule(object):
+	"""
+	Decides when a client sends its requests. Without an interval, each
+	request is sent as soon as possible; with one, requests are scheduled
+	every interval seconds, even if earlier ones were late.
+	"""
+	
+	def __init__(self, start, interval=None):
+		"""
+		Instantiate a schedule which starts at a time.
+		"""
+		self.interval = interval
+		self.next = start
+	
+	def wait(self):
+		"""
+		Wait until the next request should be sent, and return the time it
+		was scheduled for.
+		"""
+		if self.interval is None:
+			delay = self.next - time.time()
+			if delay > 0:
+				time.sleep(delay)
+			return max(self.next, time.time())
+		scheduled = self.next
+		self.next += self.interval
+		delay = scheduled - time.time()
+		if delay > 0:
+			time.sleep(delay)
+		return scheduled
+
+class SessionError(Exception):
+	"""
+	Raised when a request fails in a way which ends a session's visit.
+	"""
+
+class Session(object):
+	"""
+	Simulates two players and an observer, who repeatedly connect, play a
+	number of games, and say goodbye.
+	"""
+	
+	def __init__(self, address, name, recorder, schedule, deadline, games):
+		"""
+		Instantiate a session of clients which connect to an address and
+		play games until the deadline.
+		"""
+		self.address = address
+		self.name = name
+		self.recorder = recorder
+		self.schedule = schedule
+		self.deadline = deadline
+		self.games = games
+		# Initially the clients have not connected
+		self.clients = []
+		self.visits = 0
+	
+	def run(self):
+		"""
+		Visit the server until the deadline.
+		"""
+		while time.time() < self.deadline:
+			try:
+				self.visit()
+			except SessionError as e:
+				# Start again with new connections after a failure
+				time.sleep(0.01)
+			except (NimException, socket.error) as e:
+				time.sleep(0.01)
+			finally:
+				for client in self.clients:
+					client.disconnect()
+				self.clients = []
+	
+	def request(self, client, method, *args):
+		"""
+		Make a request when it is scheduled, record its latency, and return
+		its response. Raise a SessionError if the request failed.
+		"""
+		scheduled = self.schedule.wait()
+		name = method.upper()
+		try:
+			response = getattr(client, method)(*args)
+		except (NimException, ValueError) as e:
+			self.recorder.record(name, scheduled, time.time(), True)
+			raise SessionError(e)
+		error = response is None or response.status >= ERROR
+		self.recorder.record(name, scheduled, time.time(), error)
+		if response is None:
+			raise SessionError('connection closed')
+		return response
+	
+	def visit(self):
+		"""
+		Connect the players and the observer, play some games, and say
+		goodbye.
+		"""
+		self.visits += 1
+		names = ['{}v{}{}'.format(self.name, self.visits, role)
+			for role in 'abc']
+		self.clients = [NimClient(self.address) for _ in names]
+		for client in self.clients:
+			client.connect()
+		player1, player2, observer = self.clients
+		# The first player is sent deltas, to learn each game's ID
+		self.request(player1, 'login', names[0], None, True)
+		self.request(player2, 'login', names[1])
+		self.request(observer, 'login', names[2])
+		for _ in range(self.games):
+			if time.time() >= self.deadline:
+				break
+			self.play(names[1])
+		for client in self.clients:
+			self.request(client, 'bye')
+		self.clients = []
+	
+	def play(self, opponent):
+		"""
+		Play a game between the players, watched by the observer.
+		"""
+		player1, player2, observer = self.clients
+		self.request(player1, 'who')
+		response = self.request(player1, 'play', opponent)
+		match = snapshot_regex.search(response.body)
+		if response.status != BEGIN_GAME or not match:
+			raise SessionError('could not start a game')
+		id = int(match.group(1))
+		sets = map(int, match.group(2).split())
+		self.request(observer, 'observe', id)
+		players = [player1, player2]
+		moves = 0
+		while any(sets) and time.time() < self.deadline:
+			# Take a few objects from a random set
+			s = random.choice([i for i, size in enumerate(sets) if size])
+			n = random.randint(1, min(3, sets[s]))
+			self.request(players[moves % 2], 'remove', n, s + 1)
+			sets[s] -= n
+			moves += 1
+			# The other player checks for the move
+			self.request(players[moves % 2], 'ping')
+			if moves % 4 == 0:
+				self.request(observer, 'ping')
+		self.request(observer, 'ping')
+
+def run_worker(address, worker, sessions, start, warmup, duration, interval,
+	games, results):
+	"""
+	Run a number of sessions in threads, and put the recorded latencies and
+	errors into a queue.
+	"""
+	# Thousands of threads need smaller stacks than the default
+	threading.stack_size(256 * 1024)
+	recorder = Recorder(start + warmup, start + warmup + duration)
+	deadline = start + warmup + duration
+	threads = []
+	for i in range(sessions):
+		# Spread the first requests of open-loop sessions over an interval
+		first = start + random.random() * interval if interval else start
+		session = Session(address, 'w{}s{}'.format(worker, i), recorder,
+			Schedule(first, interval), deadline, games)
+		thread = threading.Thread(target=session.run)
+		thread.daemon = True
+		threads.append(thread)
+	for thread in threads:
+		thread.start()
+	for thread in threads:
+		thread.join()
+	results.put((dict(recorder.latencies), dict(recorder.errors)))
+
+def serve(engine, addresses):
+	"""
+	Run a Nim server with an engine, put its address into a queue, and serve
+	until interrupted.
+	"""
+	server = engines[engine](('127.0.0.1', 0), BaseNimRequestHandler)
+	server.daemon_threads = True
+	server.listen()
+	addresses.put(server.server_address)
+	try:
+		server.serve_forever()
+	except KeyboardInterrupt as e:
+		pass
+	finally:
+		server.server_close()
+
+def percentile(values, q):
+	"""
+	Return the smallest of the sorted values which at least a fraction q of
+	them do not exceed.
+	"""
+	if not values:
+		return 0.0
+	return values[max(int(math.ceil(q * len(values))) - 1, 0)]
+
+def summarize(latencies, errors, duration):
+	"""
+	Return a dictionary of the throughput, errors and latency percentiles
+	of some requests.
+	"""
+	latencies = sorted(latencies)
+	summary = {'requests': len(latencies), 'errors': errors,
+		'throughput': len(latencies) / float(duration),
+		'max': latencies[-1] if latencies else 0.0}
+	for name, q in percentiles:
+		summary[name] = percentile(latencies, q)
+	return summary
+
+def benchmark(engine, args):
+	"""
+	Benchmark a server with an engine and return a dictionary of the results.
+	"""
+	addresses = multiprocessing.Queue()
+	server = multiprocessing.Process(target=serve, args=(engine, addresses))
+	server.start()
+	address = addresses.get()
+	try:
+		sessions = max(args.clients // 3, 1)
+		interval = sessions / args.rate if args.rate else None
+		# Give the workers time to start their threads
+		start = time.time() + 1.0
+		results = multiprocessing.Queue()
+		workers = []
+		for worker in range(args.workers):
+			count = (sessions // args.workers +
+				(1 if worker < sessions % args.workers else 0))
+			if not count:
+				continue
+			workers.append(multiprocessing.Process(target=run_worker,
+				args=(address, worker, count, start, args.warmup,
+				args.duration, interval, args.games, results)))
+		for worker in workers:
+			worker.start()
+		latencies = collections.defaultdict(list)
+		errors = collections.Counter()
+		for _ in workers:
+			worker_latencies, worker_errors = results.get()
+			for method, values in worker_latencies.items():
+				latencies[method].extend(values)
+			errors.update(worker_errors)
+		for worker in workers:
+			worker.join()
+	finally:
+		# Interrupt the server so that it closes its worker processes
+		os.kill(server.pid, signal.SIGINT)
+		server.join(5)
+		if server.is_alive():
+			server.terminate()
+			server.join()
+	methods = dict((method, summarize(latencies[method], errors[method],
+		args.duration)) for method in latencies)
+	total = summarize([value for values in latencies.values()
+		for value in values], sum(errors.values()), args.duration)
+	return {'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'engine': engine,
+		'mode': 'open' if args.rate else 'closed', 'rate': args.rate,
+		'clients': sessions * 3, 'workers': args.workers,
+		'duration': args.duration, 'warmup': args.warmup,
+		'games': args.games, 'python': sys.version.split()[0],
+		'total': total, 'methods': methods}
+
+def print_results(results):
+	"""
+	Print a table of the results of a benchmark.
+	"""
+	print('{} engine, {} clients, {} loop{}: {:.0f} requests/s, {} errors'
+		.format(results['engine'], results['clients'], results['mode'],
+		' at {:g} requests/s'.format(results['rate']) if results['rate']
+		else '', results['total']['throughput'], results['total']['errors']))
+	print('{:<8} {:>8} {:>7} {:>9} {:>9} {:>9} {:>9} {:>9} {:>9}'.format(
+		'method', 'requests', 'errors', 'req/s', 'p50 ms', 'p95 ms',
+		'p99 ms', 'p999 ms', 'max ms'))
+	methods = results['methods']
+	for method in report_order + sorted(set(methods) - set(report_order)):
+		if method not in methods:
+			continue
+		summary = methods[method]
+		print('{:<8} {:>8} {:>7} {:>9.0f} {:>9.3f} {:>9.3f} {:>9.3f} {:>9.3f} '
+			'{:>9.3f}'.format(method, summary['requests'], summary['errors'],
+			summary['throughput'], summary['p50'] * 1e3,
+			summary['p95'] * 1e3, summary['p99'] * 1e3,
+			summary['p999'] * 1e3, summary['max'] * 1e3))
+	print()
+
+def main():
+	"""
+	Benchmark a server with each engine.
+	"""
+	argp = argparse.ArgumentParser(
+		description='Load generator and benchmark for the Nim server.',
+		formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+	argp.add_argument('-e', '--engine', choices=sorted(engines),
+		nargs='+', default=['threading', 'async', 'epoll'],
+		help='the engines to benchmark')
+	argp.add_argument('-c', '--clients', type=int, default=1200,
+		help='the number of simulated clients (two players and an observer '
+		'per game)')
+	argp.add_argument('-w', '--workers', type=int,
+		default=multiprocessing.cpu_count(),
+		help='the number of processes running clients')
+	argp.add_argument('-d', '--duration', metavar='SECONDS', type=float,
+		default=10.0,
+		help='the seconds to measure requests for')
+	argp.add_argument('--warmup', metavar='SECONDS', type=float, default=2.0,
+		help='the seconds to run before measuring requests')
+	argp.add_argument('-r', '--rate', type=float, default=None,
+		help='send this many requests per second in total on a fixed '
+		'schedule (default: send each request after the last response)')
+	argp.add_argument('-g', '--games', type=int, default=3,
+		help='the number of games each pair of players plays before saying '
+		'goodbye and logging in again')
+	argp.add_argument('-o', '--output', metavar='FILE', type=str,
+		default=None,
+		help='append the results of each engine to this file as a line of '
+		'JSON')
+	args = argp.parse_args()
+	for engine in args.engine:
+		results = benchmark(engine, args)
+		print_results(results)
+		if args.output:
+			with open(args.output, 'a') as file:
+				file.write(json.dumps(results, sort_keys=True) + "\n")
+
+if __name__ == '__main__':
+	main()
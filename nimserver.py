@@ -4,20 +4,30 @@
 # CSE 310, Group 2
 
 """
-Usage: nimserver.py [-h|--help] [-v|--version] [PORT=7849]
+Usage: nimserver.py [-h|--help] [-v|--version] [-e|--engine ENGINE]
+	[-i|--idle-timeout SECONDS] [-r|--read-timeout SECONDS] [-l|--log FILE]
+	[-s|--log-sample RATE] [-j|--log-json] [--log-size BYTES]
+	[--log-backups NUMBER] [-m|--metrics-port PORT] [--profile FILE]
+	[--profile-mode MODE] [--profile-seconds SECONDS]
+	[--profile-requests NUMBER] [HOST] [PORT=7849]
 
-This is a command-line server for the game of Nim.
+This is a command-line server for the game of Nim. Send it SIGUSR1 to start
+profiling the handling of requests, and again to stop early.
 """
 
 from __future__ import print_function
 
 import sys
 import argparse
+import signal
 import threading
 import socket
-from datetime import datetime
+import time
 from distutils.version import LooseVersion
 from nim import nimlib
+from nim.accesslog import *
+from nim.metrics import *
+from nim.profiler import *
 from nim.server import *
 from nimutils import *
 
@@ -32,6 +42,10 @@ WELCOME_BANNER = """                           W e l c o m e   t o . . .
 Have fun on this server!
 """
 
+# The welcome banner's response packet, which is the same for every client
+WELCOME_RESPONSE = nimlib.NimResponse.compose(nimlib.CONTINUED,
+	"\n" + WELCOME_BANNER)
+
 class NimTextRequestHandler(BaseNimRequestHandler):
 	"""
 	Represents a connection to a NimTextServer. An instance of this class is
@@ -43,136 +57,34 @@ class NimTextRequestHandler(BaseNimRequestHandler):
 		Called before the handle() method to initialize the handler.
 		"""
 		BaseNimRequestHandler.setup(self)
-		this_user = self.server.get_user(self.socket)
-		# Send the user a welcome banner
-		this_user.enqueue(WELCOME_BANNER)
-		host, port = self.client_address
+		# Send the user a welcome banner with the response to their first
+		# request
+		self.outgoing.append(WELCOME_RESPONSE.data)
 		thread = threading.current_thread()
-		# Print the connection information
-		print('Connection from {}:{} on socket {}, thread {}'.format(host,
-			port, self.socket.fileno(), thread.ident))
+		# Log the connection information
+		self.server.access_log.connected(self.host, self.port,
+			self.socket.fileno(), thread.ident)
 	
 	def finish(self):
 		"""
 		Called after the handle() method to clean up after the handler.
 		"""
 		BaseNimRequestHandler.finish(self)
-		host, port = self.client_address
 		thread = threading.current_thread()
-		# Print the disconnection information
-		print('Disconnection by {}:{} on socket {}, thread {}'.format(host,
-			port, self.socket.fileno(), thread.ident))
-	
-	def preamble(self):
-		"""
-		Print information about an individual request.
-		"""
-		host, port = self.client_address
-		timestamp = datetime.now().strftime('%Y-%m-%dT%H:%M:%S')
-		print('{}:{} [{}] "{}"'.format(host, port, timestamp,
-			self.request.request), end='')
-	
-	def conclusion(self):
-		"""
-		Print information about a response to an individual request.
-		"""
-		print(' {} {} {}'.format(self.response.status,
-			nimlib.responses[self.response.status],
-			repr(self.response.body)))
-	
-	def unsupported_version(self):
-		"""
-		Respond to a request sent by an unsupported version of Nim.
-		"""
-		self.preamble()
-		BaseNimRequestHandler.unsupported_version(self)
-		self.conclusion()
-	
-	def unsupported_method(self):
-		"""
-		Respond to a request using an unsupported method.
-		"""
-		self.preamble()
-		BaseNimRequestHandler.unsupported_method(self)
-		self.conclusion()
-	
-	def do_LOGIN(self):
-		"""
-		Respond to a LOGIN request.
-		"""
-		self.preamble()
-		BaseNimRequestHandler.do_LOGIN(self)
-		self.conclusion()
-	
-	def do_REMOVE(self):
-		"""
-		Respond to a REMOVE request.
-		"""
-		self.preamble()
-		BaseNimRequestHandler.do_REMOVE(self)
-		self.conclusion()
+		# Log the disconnection information
+		self.server.access_log.disconnected(self.host, self.port,
+			self.socket.fileno(), thread.ident)
 	
-	def do_BYE(self):
+	def handled(self, request, response, seconds):
 		"""
-		Respond to a BYE request.
+		Log an individual request with its response, to be formatted and
+		written by the access log's thread.
 		"""
-		self.preamble()
-		BaseNimRequestHandler.do_BYE(self)
-		self.conclusion()
-	
-	def do_GAMES(self):
-		"""
-		Respond to a GAMES request.
-		"""
-		self.preamble()
-		BaseNimRequestHandler.do_GAMES(self)
-		self.conclusion()
-	
-	def do_WHO(self):
-		"""
-		Respond to a WHO request.
-		"""
-		self.preamble()
-		BaseNimRequestHandler.do_WHO(self)
-		self.conclusion()
-	
-	def do_PLAY(self):
-		"""
-		Respond to a PLAY request.
-		"""
-		self.preamble()
-		BaseNimRequestHandler.do_PLAY(self)
-		self.conclusion()
-	
-	def do_OBSERVE(self):
-		"""
-		Respond to an OBSERVE request.
-		"""
-		self.preamble()
-		BaseNimRequestHandler.do_OBSERVE(self)
-		self.conclusion()
-	
-	def do_UNOBSERVE(self):
-		"""
-		Respond to an UNOBSERVE request.
-		"""
-		self.preamble()
-		BaseNimRequestHandler.do_UNOBSERVE(self)
-		self.conclusion()
-	
-	def do_PING(self):
-		"""
-		Respond to a PING request.
-		"""
-		this_user = self.server.get_user(self.socket)
-		message = this_user.get_queue() if this_user else None
-		# Only print the request information for non-empty responses
-		if message:
-			self.preamble()
-		BaseNimRequestHandler.do_PING(self)
-		# Only print the response information for non-empty responses
-		if message:
-			self.conclusion()
+		# Only log PING requests which were answered with queued messages
+		if request.method == 'PING' and not response.body:
+			return
+		self.server.access_log.requested(self.host, self.port, request,
+			response, seconds)
 
 class NimTextServer(object):
 	"""
@@ -182,6 +94,13 @@ class NimTextServer(object):
 	# The server version
 	version = LooseVersion('1.0')
 	
+	# The server classes which can handle connections
+	engines = {
+		'threading': ThreadingNimServer,
+		'async': AsyncNimServer,
+		'epoll': EpollNimServer
+	}
+	
 	def __init__(self):
 		"""
 		Instantiate a Nim text server.
@@ -198,13 +117,70 @@ class NimTextServer(object):
 		argp.add_argument('port', metavar='PORT', type=tcp_port_arg,
 			default=nimlib.NIM_PORT, nargs='?',
 			help='the port listened to by the Nim server')
+		argp.add_argument('-e', '--engine', choices=sorted(self.engines),
+			default='threading',
+			help='how the Nim server handles concurrent connections')
+		argp.add_argument('-i', '--idle-timeout', metavar='SECONDS',
+			type=float, default=None,
+			help='close connections which send no requests for this long')
+		argp.add_argument('-r', '--read-timeout', metavar='SECONDS',
+			type=float, default=None,
+			help='close connections which block a send or receive for this '
+			'long (threading engine only)')
+		argp.add_argument('-l', '--log', metavar='FILE', type=str,
+			default=None,
+			help='the access log file (default: standard output)')
+		argp.add_argument('-s', '--log-sample', metavar='RATE', type=float,
+			default=1.0,
+			help='the fraction of requests to log')
+		argp.add_argument('-j', '--log-json', action='store_true',
+			help='log each record as a line of JSON')
+		argp.add_argument('--log-size', metavar='BYTES', type=int,
+			default=10 * 1024 * 1024,
+			help='the size at which the access log file is rotated')
+		argp.add_argument('--log-backups', metavar='NUMBER', type=int,
+			default=5,
+			help='the number of rotated access log files to keep')
+		argp.add_argument('-m', '--metrics-port', metavar='PORT',
+			type=tcp_port_arg, default=None,
+			help='serve metrics in the Prometheus text format on this '
+			'localhost port')
+		argp.add_argument('--profile', metavar='FILE', type=str,
+			default='nimserver.prof',
+			help='the file to write profiles to when sent SIGUSR1')
+		argp.add_argument('--profile-mode', choices=[NimProfiler.CPROFILE,
+			NimProfiler.SAMPLE], default=NimProfiler.CPROFILE,
+			help='whether to trace requests with cProfile (pstats output) '
+			'or sample their stacks (collapsed stack output)')
+		argp.add_argument('--profile-seconds', metavar='SECONDS', type=float,
+			default=30.0,
+			help='the seconds to profile requests for')
+		argp.add_argument('--profile-requests', metavar='NUMBER', type=int,
+			default=None,
+			help='the number of requests to profile, if fewer are handled '
+			'in the given seconds')
 		argp.add_argument('-v', '--version', action='version',
 			version=fullversion)
 		# Parse the given arguments
 		args = argp.parse_args()
-		# Create a threaded Nim server to handle requests
-		self.server = ThreadingNimServer((args.host, args.port),
+		# Create a Nim server to handle requests
+		self.server = self.engines[args.engine]((args.host, args.port),
 			NimTextRequestHandler)
+		self.server.idle_timeout = args.idle_timeout
+		self.server.read_timeout = args.read_timeout
+		# Log connections and requests without waiting to write them
+		self.server.access_log = NimAccessLog(args.log, args.log_sample,
+			args.log_json, args.log_size, args.log_backups)
+		# Profile requests when sent SIGUSR1
+		self.profile_args = args
+		# Serve the metrics to localhost if asked to
+		self.metrics_server = None
+		if args.metrics_port is not None:
+			try:
+				self.metrics_server = NimMetricsServer(args.metrics_port,
+					self.server)
+			except socket.error as e:
+				raise nimlib.NimException(e.strerror)
 	
 	def serve_forever(self):
 		"""
@@ -214,6 +190,15 @@ class NimTextServer(object):
 		# Print information needed for clients to connect
 		print('Listening on {}:{}... (^C to shut down)'.format(
 			self.server.host, self.server.port))
+		if self.metrics_server:
+			self.metrics_server.start()
+			print('Serving metrics on http://127.0.0.1:{}/metrics'.format(
+				self.metrics_server.server_port))
+		# Toggle profiling when sent SIGUSR1, without interrupting system
+		# calls
+		if hasattr(signal, 'SIGUSR1'):
+			signal.signal(signal.SIGUSR1, self.toggle_profiling)
+			signal.siginterrupt(signal.SIGUSR1, False)
 		# Listen for requests until sent a shutdown signal or exception
 		try:
 			self.server.serve_forever()
@@ -224,6 +209,24 @@ class NimTextServer(object):
 			print(e)
 			print('Shutting down...')
 			self.server.shutdown()
+		finally:
+			# Write the profile and the records still waiting to be logged
+			self.server.stop_profiling()
+			self.server.access_log.close()
+	
+	def toggle_profiling(self, signum, frame):
+		"""
+		Start profiling requests, or stop if they are already being profiled.
+		"""
+		if self.server.profiler:
+			self.server.stop_profiling()
+			return
+		args = self.profile_args
+		self.server.start_profiling(args.profile, args.profile_mode,
+			args.profile_seconds, args.profile_requests,
+			lambda profiler: print(profiler.summary()))
+		print('Profiling requests to {}... (SIGUSR1 to stop)'.format(
+			args.profile))
 
 def main():
 	"""